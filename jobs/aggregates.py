@@ -0,0 +1,24 @@
+from __future__ import annotations
+import logging
+import time
+from argparse import ArgumentParser
+
+from twitscan import aggregates, migrations, telemetry
+
+
+def main() -> None:
+    parser = ArgumentParser(
+        description="rebuild the per user aggregate tables from the raw tables: python -m jobs.aggregates"
+    )
+    telemetry.add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    migrations.migrate()
+    started = time.time()
+    with telemetry.report(args.metrics, args.metrics_interval):
+        counts = aggregates.rebuild()
+    print(f"Rebuilt {counts} in {time.time() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+from __future__ import annotations
+import os
+import re
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+# run in the child: no database or api resource may exist right after the import
+CHECK = """
+import {module}
+from twitscan import context
+assert context._engine is None and context._session is None, "database opened"
+assert context._auth is None and context._api is None, "api built"
+assert "tweepy" not in __import__("sys").modules, "tweepy imported"
+"""
+
+CREDENTIALS = (
+    "TWITTER_CONSUMER_KEY",
+    "TWITTER_CONSUMER_SECRET",
+    "TWITTER_ACCESS_TOKEN",
+    "TWITTER_ACCESS_TOKEN_SECRET",
+)
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)")
+
+
+def import_times(module: str) -> dict[str, int]:
+    """
+    cumulative microseconds spent importing each module
+    in a fresh interpreter without twitter credentials
+    """
+    env = {key: value for key, value in os.environ.items() if key not in CREDENTIALS}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHECK.format(module=module)],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    lines = [_LINE.match(line) for line in result.stderr.splitlines()]
+    if result.returncode != 0:
+        raise RuntimeError(
+            "\n".join(
+                line for line in result.stderr.splitlines() if "import time" not in line
+            )
+        )
+    return {match.group(3): int(match.group(2)) for match in lines if match}
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("module", nargs="?", default="twitscan.query")
+    parser.add_argument("-r", "--runs", type=int, default=5)
+    parser.add_argument("-n", "--top", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [import_times(args.module) for _ in range(args.runs)]
+    totals = sorted(run[args.module] for run in runs)
+    print(
+        f"import {args.module}: best {totals[0] / 1000:.1f} ms, "
+        f"median {totals[len(totals) // 2] / 1000:.1f} ms over {args.runs} runs"
+    )
+    print("no engine, session or api created, tweepy not imported")
+    best = min(runs, key=lambda run: run[args.module])
+    packages = [(name, time) for name, time in best.items() if "." not in name]
+    for name, time in sorted(packages, key=lambda row: -row[1])[: args.top]:
+        print(f"{time / 1000:>8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+from __future__ import annotations
+import logging
+import os
+import time
+from argparse import ArgumentParser
+from collections import Counter
+
+from twitscan import aioscan, configure, migrations, query, scanner, telemetry
+from twitscan.credentials import Credential, CredentialPool
+from twitscan.fake import FakeTwitter, SyntheticGraph
+
+
+def main() -> None:
+    parser = ArgumentParser(
+        description="scan a synthetic graph through the fake api: python -m jobs.bench_scan"
+    )
+    parser.add_argument("--users", type=int, default=2000, help="users in the graph")
+    parser.add_argument(
+        "--friends", type=int, default=100, help="mean friends per user"
+    )
+    parser.add_argument("--statuses", type=int, default=50, help="tweets per user")
+    parser.add_argument("--scan", type=int, default=200, help="users to scan")
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="mean seconds per api call"
+    )
+    parser.add_argument(
+        "--window",
+        type=float,
+        default=1.0,
+        help="seconds per rate limit window, twitter's is 900",
+    )
+    parser.add_argument(
+        "--errors", type=float, default=0.0, help="share of calls failing with a 503"
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        default=False,
+        help="scan one user at a time with scanner.scan instead of aioscan",
+    )
+    parser.add_argument(
+        "--keys",
+        type=int,
+        default=0,
+        help="spread the calls over a pool of this many keys, each its own fake app",
+    )
+    parser.add_argument("--db", default="data/bench_scan.db")
+    parser.add_argument("--seed", type=int, default=0)
+    telemetry.add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    started = time.time()
+    graph = SyntheticGraph(
+        users=args.users, friends=args.friends, statuses=args.statuses, seed=args.seed
+    )
+    print(f"Built a graph of {args.users} users in {time.time() - started:.1f}s")
+    fakes = [
+        FakeTwitter(
+            graph,
+            latency=args.latency,
+            window=args.window,
+            error_rate=args.errors,
+            seed=args.seed + number,
+        )
+        for number in range(max(args.keys, 1))
+    ]
+    fake = fakes[0]
+    pool = (
+        CredentialPool(
+            [Credential(str(number), "", "", "", "") for number in range(args.keys)],
+            api_factory=lambda credential: fakes[int(credential.name)].api(),
+        )
+        if args.keys > 0
+        else None
+    )
+    if os.path.exists(args.db):
+        os.remove(args.db)
+    configure(
+        db_url=f"sqlite:///{args.db}",
+        # rate limits are waited out by the instrumented api, which times the waits
+        api_factory=(
+            pool.api
+            if pool is not None
+            else lambda: telemetry.instrument(fake.api(), wait_on_rate_limit=True)
+        ),
+    )
+    migrations.migrate()
+
+    # users following the most followed account, the followers of a main user
+    user_ids = [int(uid) for uid in graph.followers(1)[: args.scan]]
+    started = time.time()
+    with telemetry.report(args.metrics, args.metrics_interval):
+        if args.sync:
+            for uid in user_ids:
+                try:
+                    scanner.scan(user_id=uid)
+                except Exception as err:
+                    logging.debug(f"Scan of {uid} failed: {err!r}")
+            scanned = len(user_ids)
+        else:
+            results = aioscan.scan_many(
+                user_ids,
+                concurrency=args.concurrency,
+                api_factory=fake.api,
+                pool=pool,
+            )
+            scanned = sum(user is not None for user in results.values())
+    elapsed = time.time() - started
+
+    print(
+        f"Scanned {scanned} of {len(user_ids)} users in {elapsed:.1f}s, "
+        f"{len(user_ids) / elapsed:.1f} users/s"
+    )
+    calls = sum((service.calls for service in fakes), Counter())
+    rate_limited = sum((service.rate_limited for service in fakes), Counter())
+    errors = sum((service.errors for service in fakes), Counter())
+    print(f"Api calls: {dict(calls)}")
+    print(f"Rate limited: {dict(rate_limited)}, errors: {dict(errors)}")
+    if pool is not None:
+        for name, stats in pool.stats().items():
+            print(f"Key {name}: {stats['calls']} calls, parked {stats['parked']} times")
+    print(f"Rows: {query.db_info()}")
+
+
+if __name__ == "__main__":
+    main()
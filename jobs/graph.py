@@ -0,0 +1,30 @@
+from __future__ import annotations
+import logging
+from argparse import ArgumentParser
+
+from twitscan import graph, telemetry
+
+
+def main() -> None:
+    parser = ArgumentParser(
+        description="compute pagerank, communities and reach of the follow graph: python -m jobs.graph"
+    )
+    parser.add_argument(
+        "--hops",
+        type=int,
+        default=graph.HOPS,
+        help="follows between a user and the accounts counted in their reach",
+    )
+    telemetry.add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with telemetry.report(args.metrics, args.metrics_interval):
+        metrics = graph.refresh(hops=args.hops)
+    top = metrics.ids[metrics.pagerank.argsort()[::-1][:10]]
+    print(
+        f"Stored the metrics of {len(metrics.ids)} accounts, top pagerank: {top.tolist()}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,16 @@
+"""exports the pictures of ranked followers to data/images, hardlinked from the store"""
+
+from __future__ import annotations
+
 import pandas as pd
-from os import listdir
-import shutil
+
+from twitscan.images import Manifest, export
 
 df = pd.read_csv("data/ranked.tsv", sep="\t")
-followers: list[str] = df["follower"].to_list()
-pics = set(name.replace(".jpeg", "") for name in listdir("imgs/profiles"))
-
-for follower in followers:
-    if follower in pics:
-        shutil.copyfile(
-            f"imgs/profiles/{follower}.jpeg", f"data/images/{follower}.jpeg"
-        )
+manifest = Manifest()
+if "follower_id" in df.columns:
+    entries = manifest.by_user_ids(df["follower_id"].to_list()).values()
+else:
+    entries = manifest.by_screen_names(df["follower"].to_list()).values()
+print(f"Exported {export(entries, 'data/images')} of {len(df)} pictures")
+manifest.close()
@@ -1,5 +1,6 @@
 from __future__ import annotations
 import logging
+import multiprocessing
 from argparse import ArgumentParser
 import time
 import os
@@ -11,11 +12,23 @@ from tweepy import TweepError
 sys.path.append("../twitscan")
 from twitscan.errors import UserProtectedError
 from twitscan.models import Entourage, TwitscanUser
-from twitscan import scanner, session
+from twitscan import (
+    aioscan,
+    context,
+    entourage,
+    ingest,
+    jobqueue,
+    migrations,
+    scanner,
+    session,
+    telemetry,
+)
+
+ENTOURAGE_PAGE = 5000
 
 
 def handle_user_scan(
-    user_id: int | None = None, name: str | None = None
+    user_id: int | None = None, name: str | None = None, refresh: bool = False
 ) -> TwitscanUser | None:
     if all((type(obj) == None for obj in (user_id, name))):
         raise TypeError("User is neither string nor int")
@@ -23,7 +36,8 @@ def handle_user_scan(
     retries = 0
     while retries < 2:
         try:
-            twitter_user: TwitscanUser = scanner.scan(screen_name=name, user_id=user_id)
+            scan = ingest.rescan if refresh else scanner.scan
+            twitter_user: TwitscanUser = scan(screen_name=name, user_id=user_id)
             return twitter_user
         except UserProtectedError:
             logging.debug(f"User {user} is protected")
@@ -31,9 +45,9 @@ def handle_user_scan(
         except TweepError as err:
             logging.debug(f"Got tweepy error scanning {user}")
             logging.debug(f"\n\t{err}")
-            logging.debug("Sleeping for 5 seconds then trying to resume")
-            time.sleep(5)
-            retries += 1
+            delay = aioscan.backoff_delay(retries)
+            logging.debug(f"Sleeping for {delay:.1f} seconds then trying to resume")
+            time.sleep(delay)
             cmd = "cls" if os.name == "nt" else "clear"
             os.system(cmd)
             retries += 1
@@ -43,40 +57,143 @@ def handle_user_scan(
     return None
 
 
+def run_workers(
+    users: list[str],
+    workers: int,
+    concurrency: int,
+    refresh: bool,
+    level: int,
+    metrics: str | None = None,
+    metrics_interval: float = telemetry.INTERVAL,
+) -> None:
+    """scans through the job queue with worker processes, resuming any previous run"""
+    if refresh:
+        print(f"Queued {jobqueue.requeue_done()} scanned users for a refresh")
+    added = jobqueue.enqueue(screen_names=users, main=True, refresh=refresh)
+    print(f"Queued {added} new main users, jobs: {jobqueue.counts()}")
+    mp_context = multiprocessing.get_context("spawn")  # no sqlite connection is shared
+    processes = [
+        mp_context.Process(
+            target=jobqueue.work,
+            kwargs=dict(
+                concurrency=concurrency,
+                log_file="other/debug.log",
+                log_level=level,
+                metrics=metrics,
+                metrics_interval=metrics_interval,
+            ),
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        while any(process.is_alive() for process in processes):
+            time.sleep(10)
+            print(f"Jobs: {jobqueue.counts()}")
+    except KeyboardInterrupt:
+        logging.info("KeyboardInterrupt, terminating workers")
+        for process in processes:
+            process.terminate()
+    for process in processes:
+        process.join()
+    print(f"Jobs: {jobqueue.counts()}")
+    entourage.load_or_build()
+
+
+def scan_users(users: list[str], concurrency: int, refresh: bool) -> None:
+    """scans each main user then their followers, in this process"""
+    scanned_ids = set(map(lambda user: user.user_id, session.query(TwitscanUser).all()))
+    refreshed_ids: set[int] = set()  # users already rescanned by this run
+    skipped_ids = refreshed_ids if refresh else scanned_ids
+    for user in users:
+        print(f"Scanning main user {user}")
+        twitter_user: TwitscanUser | None = handle_user_scan(name=user, refresh=refresh)
+        if twitter_user is None:
+            print(f"Did not find main user {user} in DB")
+            continue
+        # the entourage of large accounts is stored in full, only scanning
+        # every one of their followers is out of the api budget
+        followers: list[int] = [
+            ff
+            for (ff,) in session.query(Entourage.friend_follower_id)
+            .filter(
+                Entourage.user_id == twitter_user.user_id, Entourage.follower.is_(True)
+            )
+            .yield_per(ENTOURAGE_PAGE)
+            if ff not in skipped_ids
+        ]
+        if len(followers) >= jobqueue.MAX_FOLLOWERS_SCANNED:
+            logging.debug(
+                f"Main user @{user} has more than allowed number of followers to scan, skipping them"
+            )
+            continue
+        progress = tqdm(total=len(followers))
+
+        def done(uid: int, _: TwitscanUser | None) -> None:
+            scanned_ids.add(uid)
+            refreshed_ids.add(uid)
+            progress.update()
+
+        aioscan.scan_many(
+            followers,
+            concurrency=concurrency,
+            on_done=done,
+            refresh=refresh,
+        )
+        progress.close()
+        if context.pool is not None:
+            logging.info(f"Credentials: {context.pool.stats()}")
+        entourage.load_or_build()
+
+
 def main() -> None:
     parser = ArgumentParser()
     parser.add_argument(
         "-d", "--debug", action="store_true", default=False, help="run in debug mode"
     )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=8,
+        help="number of follower scans in flight",
+    )
+    parser.add_argument(
+        "-r",
+        "--refresh",
+        action="store_true",
+        default=False,
+        help="rescan already scanned users for new tweets and entourage changes",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=0,
+        help="scan through the job queue with this many worker processes",
+    )
+    telemetry.add_arguments(parser)
 
     args = parser.parse_args()
     level = logging.DEBUG if args.debug else logging.INFO
     logging.basicConfig(filename="other/debug.log", level=level)
+    migrations.migrate()
 
     with open("data/users.txt", "r") as file:
         users = file.read().split("\n")
 
-    scanned_ids = set(map(lambda user: user.user_id, session.query(TwitscanUser).all()))
-    for user in users:
-        print(f"Scanning main user {user}")
-        twitter_user: TwitscanUser | None = handle_user_scan(name=user)
-        if twitter_user is None:
-            print(f"Did not find main user {user} in DB")
-            continue
-        followers: list[Entourage] = list(
-            filter(
-                lambda ent: ent.follower and ent.friend_follower_id not in scanned_ids,
-                twitter_user.entourage,
-            )
+    if args.workers > 0:
+        run_workers(
+            users,
+            args.workers,
+            args.concurrency,
+            args.refresh,
+            level,
+            args.metrics,
+            args.metrics_interval,
         )
+        return
 
-        if len(followers) >= 1600:
-            logging.debug(
-                f"Main user @{user} has more than allowed number of followers, skipping"
-            )
-            continue
-        for follower in tqdm(followers):
-            uid = follower.friend_follower_id
-            print(f"Scanning follower: {uid}")
-            handle_user_scan(user_id=uid)
-            scanned_ids.add(uid)
+    with telemetry.report(args.metrics, args.metrics_interval):
+        scan_users(users, args.concurrency, args.refresh)
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from twitscan import configure, context, migrations
+from twitscan.cache import features_cache
+from twitscan.fake import FakeTwitter, SyntheticGraph
+from twitscan.synthetic import populate
+
+SCANNED = 100  # graph users stored by the populated fixture
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    parser.addoption(
+        "--bench-scale",
+        default="10k",
+        help="rows of the benchmark database: 10k, 100k, 1m or 10m",
+    )
+
+
+@pytest.fixture
+def graph() -> SyntheticGraph:
+    return SyntheticGraph(users=300, friends=20, statuses=30, seed=1)
+
+
+@pytest.fixture
+def fake(graph: SyntheticGraph) -> FakeTwitter:
+    return FakeTwitter(graph, window=0.1)
+
+
+@pytest.fixture
+def db(tmp_path: Path, fake: FakeTwitter) -> Iterator[str]:
+    """empty migrated database, the api of the context answers from the fake service"""
+    url = f"sqlite:///{tmp_path}/twitter.db"
+    configure(db_url=url, api_factory=lambda: fake.api(wait_on_rate_limit=True))
+    migrations.migrate()
+    features_cache.clear()  # ids of another test's database
+    yield url
+    context.close()
+
+
+@pytest.fixture
+def populated(db: str, graph: SyntheticGraph) -> SyntheticGraph:
+    """the first users of the graph stored as if they were scanned"""
+    populate(graph, scanned=SCANNED)
+    return graph
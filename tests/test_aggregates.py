@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+from typing import Any
+
+from sqlalchemy import text
+
+from twitscan import aggregates, api, context, scanner
+from twitscan.fake import SyntheticGraph
+from twitscan.ingest import Ingestor, rescan
+
+
+def _aggregates() -> dict[str, list[tuple[Any, ...]]]:
+    with context.engine.connect() as conn:
+        return {
+            model.__table__.name: sorted(
+                tuple(row)
+                for row in conn.execute(text(f"SELECT * FROM {model.__table__.name}"))
+            )
+            for model, _ in aggregates.STATEMENTS
+        }
+
+
+def test_incremental_aggregates_match_rebuild(db: str, graph: SyntheticGraph) -> None:
+    user_ids = [
+        int(uid) for uid in graph.followers(1) if not graph.is_protected(int(uid))
+    ][:4]
+    scanner.scan(user_id=user_ids[0])
+    ingestor = Ingestor()
+    for user_id in user_ids[1:]:
+        ingestor.save_user(api.get_user(user_id=user_id))
+    graph.post(2)
+    rescan(user_id=user_ids[0])
+    rescan(user_id=user_ids[1])
+
+    incremental = _aggregates()
+    assert all(incremental.values())
+    aggregates.rebuild()
+    assert _aggregates() == incremental
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+
+import pytest
+
+from twitscan import aioscan
+from twitscan.aioscan import WINDOW, TokenBucket, backoff_delay
+
+
+class Clock:
+    """time.time and asyncio.sleep of the tests, sleeping moves the clock"""
+
+    def __init__(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        self.now = 1_000_000.0
+        self.slept: list[float] = []
+        monkeypatch.setattr(time, "time", lambda: self.now)
+        monkeypatch.setattr(aioscan.asyncio, "sleep", self.sleep)
+
+    async def sleep(self, delay: float) -> None:
+        self.slept.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    return Clock(monkeypatch)
+
+
+def test_bucket_refills_up_to_its_limit(clock: Clock) -> None:
+    bucket = TokenBucket("/friends/ids", 3)
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() == WINDOW + 1
+    clock.now += WINDOW / 2
+    assert bucket.take() == WINDOW / 2 + 1
+
+    clock.now += 3 * WINDOW  # several windows went by, still only limit calls
+    assert bucket.headroom() == 3
+    assert [bucket.take() for _ in range(4)] == [0.0, 0.0, 0.0, WINDOW + 1]
+
+
+def test_headers_lower_the_remaining_calls(clock: Clock) -> None:
+    bucket = TokenBucket("/users/show", 900)
+    reset = clock.now + 600
+    bucket.update({"x-rate-limit-remaining": "10", "x-rate-limit-reset": str(reset)})
+    assert (bucket.remaining, bucket.reset_at) == (10, reset)
+    bucket.take()
+    # a response sent before the take reports more calls than are left
+    bucket.update({"x-rate-limit-remaining": "10", "x-rate-limit-reset": str(reset)})
+    assert bucket.remaining == 9
+    bucket.update({"x-rate-limit-remaining": "2", "x-rate-limit-reset": str(reset)})
+    assert bucket.remaining == 2
+    bucket.update({"x-rate-limit-limit": "180"})
+    assert (bucket.limit, bucket.remaining) == (180, 2)
+    bucket.update(None)
+    assert bucket.remaining == 2
+
+    clock.now = reset
+    assert bucket.headroom() == 180
+
+
+def test_exhausted_bucket_waits_for_the_reset(clock: Clock) -> None:
+    bucket = TokenBucket("/favorites/list", 75)
+    reset = clock.now + 120
+    bucket.exhaust({"x-rate-limit-reset": str(reset)})
+    assert asyncio.run(bucket.acquire()) == 121
+    assert clock.slept == [121]
+    assert clock.now >= reset and bucket.remaining == 74
+    assert asyncio.run(bucket.acquire()) == 0.0
+
+    bucket.exhaust(None)  # a 429 without headers waits a whole window
+    assert asyncio.run(bucket.acquire()) == WINDOW + 1
+    assert bucket.waited == 121 + WINDOW + 1
+
+
+def test_backoff_delay_is_capped_full_jitter(monkeypatch: pytest.MonkeyPatch) -> None:
+    bounds: list[tuple[float, float]] = []
+
+    def uniform(low: float, high: float) -> float:
+        bounds.append((low, high))
+        return high
+
+    monkeypatch.setattr(random, "uniform", uniform)
+    assert [backoff_delay(attempt) for attempt in range(8)] == [
+        5.0,
+        10.0,
+        20.0,
+        40.0,
+        80.0,
+        160.0,
+        300.0,
+        300.0,
+    ]
+    assert {low for low, _ in bounds} == {0}
+    assert backoff_delay(2, base=1.0, cap=3.0) == 3.0
@@ -0,0 +1,175 @@
+"""
+Timings and python heap peaks of the query, ingestion and ranking hot paths
+on a synthetic database: python -m pytest tests/test_benchmarks.py --bench-scale 1m,
+--benchmark-autosave keeps every run and --benchmark-compare-fail=min:20% fails
+on a best run slower than the last saved one, peaks are in each run's extra_info
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Iterator, NamedTuple
+
+import pytest
+
+from twitscan import configure, context, migrations, proximity, query, scoring, session
+from twitscan.cache import FeatureCache, features_cache
+from twitscan.fake import LIMITS, FakeTwitter, SyntheticGraph
+from twitscan.ingest import Ingestor
+from twitscan.models import TwitscanUser
+from twitscan.scanner import FetchedUser, fetch_user
+from twitscan.sink import RankingSink
+from twitscan.synthetic import populate
+
+# graph settings giving roughly the number of rows in the name
+SCALES: dict[str, dict[str, int]] = {
+    "10k": dict(users=100, friends=30, statuses=20),
+    "100k": dict(users=400, friends=80, statuses=40),
+    "1m": dict(users=3000, friends=100, statuses=50),
+    "10m": dict(users=20000, friends=150, statuses=60),
+}
+SPARE = 100  # graph users left out of the database, ingested by the benchmark
+INGEST_BATCH = 5  # users saved per ingestion run
+PAIRS = 20  # proximity calls per run
+MAIN_USERS = (1, 10, 100)  # popular accounts come first in the graph
+ROUNDS = 5
+
+
+class Bench(NamedTuple):
+    graph: SyntheticGraph
+    fake: FakeTwitter
+    main: list[int]  # scanned main users
+    spare: list[int]  # graph users not stored yet
+
+
+@pytest.fixture(scope="session")
+def bench_db(
+    request: pytest.FixtureRequest, tmp_path_factory: pytest.TempPathFactory
+) -> tuple[SyntheticGraph, Path]:
+    """the synthetic database of the scale, generated once per session"""
+    scale: str = request.config.getoption("bench_scale")
+    settings = SCALES[scale]
+    graph = SyntheticGraph(**{**settings, "users": settings["users"] + SPARE})
+    path = tmp_path_factory.mktemp("bench") / f"bench-{scale}.db"
+    configure(db_url=f"sqlite:///{path}")
+    migrations.migrate()
+    populate(graph, scanned=settings["users"])
+    context.close()
+    return graph, path
+
+
+@pytest.fixture
+def bench(bench_db: tuple[SyntheticGraph, Path]) -> Iterator[Bench]:
+    graph, path = bench_db
+    # no rate limit, calls only cost their handling
+    fake = FakeTwitter(
+        graph,
+        limits={
+            method: (endpoint, sys.maxsize) for method, (endpoint, _) in LIMITS.items()
+        },
+    )
+    configure(db_url=f"sqlite:///{path}", api_factory=fake.api)
+    stored = {uid for (uid,) in session.query(TwitscanUser.user_id)}
+    yield Bench(
+        graph,
+        fake,
+        [uid for uid in MAIN_USERS if uid in stored],
+        [uid for uid in range(1, graph.users + 1) if uid not in stored],
+    )
+    context.close()
+
+
+def fresh() -> None:
+    """nothing a previous run loaded is reused"""
+    session.expire_all()
+    session.close()
+    features_cache.clear()
+
+
+def measure(
+    benchmark: Any, run: Callable[[], Any], setup: Callable[[], None] = fresh
+) -> None:
+    """timed rounds, then the python heap peak of one more traced run"""
+    benchmark.pedantic(run, setup=setup, rounds=ROUNDS, iterations=1)
+    setup()
+    tracemalloc.start()
+    try:
+        run()
+        _, benchmark.extra_info["peak_bytes"] = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+
+def test_query_proximity(benchmark: Any, bench: Bench) -> None:
+    def run() -> None:
+        user = query.user_by_id(bench.main[0])
+        assert user is not None
+        for fid in bench.graph.followers(bench.main[0])[:PAIRS].tolist():
+            other = query.user_by_id(fid)
+            if other is not None:
+                query.proximity(user, other)
+
+    measure(benchmark, run)
+
+
+def test_query_followers(benchmark: Any, bench: Bench) -> None:
+    measure(benchmark, lambda: query.followers(bench.main[0]))
+
+
+def test_query_statuses_by_hashtag(benchmark: Any, bench: Bench) -> None:
+    measure(benchmark, lambda: query.statuses_by_hashtag("tag0"))
+
+
+def test_query_db_info(benchmark: Any, bench: Bench) -> None:
+    measure(benchmark, query.db_info)
+
+
+def test_bulk_proximity(benchmark: Any, bench: Bench) -> None:
+    def run() -> None:
+        user = query.user_by_id(bench.main[0])
+        assert user is not None
+        proximity.bulk_proximity(user)
+
+    measure(benchmark, run)
+
+
+def test_ingest_save_user(benchmark: Any, bench: Bench) -> None:
+    batch: list[tuple[Any, FetchedUser]] = []
+
+    def fetch_batch() -> None:
+        fresh()
+        batch.clear()
+        for _ in range(min(INGEST_BATCH, len(bench.spare))):
+            raw = bench.fake.api().get_user(user_id=bench.spare.pop(0))
+            batch.append((raw, fetch_user(raw)))
+
+    def run() -> None:
+        assert batch, "no spare user left to ingest, lower the rounds or add spares"
+        ingestor = Ingestor()
+        for raw, fetched in batch:
+            ingestor.save_user(raw, fetched)
+
+    measure(benchmark, run, fetch_batch)
+
+
+def test_rank(benchmark: Any, bench: Bench, tmp_path: Path) -> None:
+    """bulk proximity of every main user through the sink, then the scoring pass"""
+
+    def run() -> None:
+        directory = str(tmp_path / f"ranking-{len(os.listdir(tmp_path))}")
+        sink = RankingSink(directory)
+        cache = FeatureCache()
+        try:
+            for uid in bench.main:
+                user = query.user_by_id(uid)
+                assert user is not None
+                sink.write_matrix(proximity.bulk_proximity(user, cache=cache))
+            scoring.rank(sink, path=os.path.join(directory, "ranked.tsv"))
+        finally:
+            cache.close()
+            sink.close()
+
+    measure(benchmark, run)
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import time
+
+import pytest
+
+from twitscan import telemetry
+from twitscan.credentials import Credential, CredentialPool
+from twitscan.fake import LIMITS, FakeTwitter, SyntheticGraph
+
+WINDOW = 60.0
+LOOKUPS = 4  # get_user calls per key and window
+
+
+class Clock:
+    """time.time and time.sleep of the pool and the fake service, sleeping moves the clock"""
+
+    def __init__(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        self.now = 1_000_000.0
+        self.slept: list[float] = []
+        monkeypatch.setattr(time, "time", lambda: self.now)
+        monkeypatch.setattr(time, "sleep", self.sleep)
+
+    def sleep(self, delay: float) -> None:
+        self.slept.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    return Clock(monkeypatch)
+
+
+def _pool(graph: SyntheticGraph, keys: int) -> tuple[CredentialPool, list[FakeTwitter]]:
+    """one fake service per key, each with its own rate limit windows"""
+    limits = {**LIMITS, "get_user": ("/users/show", LOOKUPS)}
+    services = [FakeTwitter(graph, window=WINDOW, limits=limits) for _ in range(keys)]
+    credentials = [
+        Credential(str(number), "key", "secret", "token", "token secret")
+        for number in range(keys)
+    ]
+    pool = CredentialPool(
+        credentials, lambda credential: services[int(credential.name)].api()
+    )
+    return pool, services
+
+
+def test_calls_are_spread_over_the_keys(graph: SyntheticGraph, clock: Clock) -> None:
+    pool, services = _pool(graph, 3)
+    api = pool.api()
+    for user_id in range(1, 3 * LOOKUPS + 1):
+        assert api.get_user(user_id=user_id).id == user_id
+    assert [service.calls["get_user"] for service in services] == [LOOKUPS] * 3
+    assert all(service.rate_limited["get_user"] == 0 for service in services)
+    assert {name: stats["calls"] for name, stats in pool.stats().items()} == {
+        "0": LOOKUPS,
+        "1": LOOKUPS,
+        "2": LOOKUPS,
+    }
+    key, delay = pool.reserve("get_user")
+    assert key is None and 0 < delay <= WINDOW + 2
+    assert clock.slept == []
+
+
+def test_rate_limited_key_is_skipped(graph: SyntheticGraph, clock: Clock) -> None:
+    pool, services = _pool(graph, 2)
+    # another client used up the window of the first key, the pool does not know
+    other = services[0].api()
+    for _ in range(LOOKUPS):
+        other.get_user(user_id=1)
+
+    api = pool.api()
+    for user_id in range(1, LOOKUPS + 1):
+        assert api.get_user(user_id=user_id).id == user_id
+    assert services[0].rate_limited["get_user"] == 1
+    assert services[1].calls["get_user"] == LOOKUPS
+    stats = pool.stats()
+    assert stats["0"]["parked"] == 1 and stats["0"]["remaining"]["get_user"] == 0
+    assert stats["1"]["remaining"]["get_user"] == 0
+    assert clock.slept == []
+
+
+def test_calls_wait_once_every_key_is_limited(
+    graph: SyntheticGraph, clock: Clock
+) -> None:
+    pool, services = _pool(graph, 2)
+    telemetry.registry.reset()
+    api = pool.api()
+    started = clock.now
+    for user_id in range(1, 2 * LOOKUPS + 2):
+        assert api.get_user(user_id=user_id).id == user_id
+    assert len(clock.slept) == 1
+    assert started + WINDOW <= clock.now <= started + WINDOW + 2
+    assert sum(service.calls["get_user"] for service in services) == 2 * LOOKUPS + 1
+    assert sum(service.rate_limited["get_user"] for service in services) == 0
+    waits = [
+        timer["count"]
+        for timer in telemetry.registry.snapshot()["timers"]
+        if timer["name"] == telemetry.RATE_LIMIT_WAITS
+    ]
+    assert waits == [1]
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+
+from twitscan import scanner, session
+from twitscan.entourage import EntourageIndex, load_or_build
+from twitscan.fake import SyntheticGraph
+from twitscan.ingest import rescan
+from twitscan.models import Entourage
+
+
+def _row(index: EntourageIndex, user_id: int) -> set[int]:
+    (pos,), (found,) = index.rows([user_id])
+    assert found, user_id
+    return set(index.account_ids[index.matrix[pos].indices].tolist())
+
+
+def test_rescan_reloads_index_row(
+    db: str, graph: SyntheticGraph, tmp_path: Path
+) -> None:
+    user_id = next(
+        int(uid) for uid in graph.followers(1) if not graph.is_protected(int(uid))
+    )
+    scanner.scan(user_id=user_id)
+    entourage = set(graph.friends(user_id).tolist()) | set(
+        graph.followers(user_id).tolist()
+    )
+    # relations missing from the store, as if the first scan had been interrupted
+    missing = sorted(entourage)[:3]
+    session.query(Entourage).filter(
+        Entourage.user_id == user_id, Entourage.friend_follower_id.in_(missing)
+    ).delete(synchronize_session=False)
+    session.commit()
+    path = str(tmp_path / "entourage.npz")
+    index = load_or_build(path)
+    assert _row(index, user_id) == entourage - set(missing)
+    assert load_or_build(path).user_ids.tolist() == index.user_ids.tolist()
+
+    rescan(user_id=user_id)
+    updated = load_or_build(path)
+    assert _row(updated, user_id) == entourage
+    assert np.array_equal(updated.sizes, EntourageIndex.build().sizes)
+    loaded = EntourageIndex.load(path)
+    assert loaded.update() is loaded  # no row reloaded while nothing was saved
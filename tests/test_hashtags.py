@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+from itertools import combinations
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import text
+
+from twitscan import aggregates, query, session
+from twitscan.fake import SyntheticGraph
+from twitscan.hashtags import HashtagIndex, load_or_build
+from twitscan.models import Hashtag, HashtagName, TwitscanStatus
+
+SIMILAR = 0.7  # jaccard above which pairs must share a bucket
+DISSIMILAR = 0.1  # and below which they should not
+
+
+def _index(tag_sets: list[set[int]]) -> HashtagIndex:
+    """one user per set of tag numbers, one status per user"""
+    tags = np.array(sorted({f"tag{t:03d}" for tags in tag_sets for t in tags}))
+    rows = np.repeat(np.arange(len(tag_sets)), [len(tags_) for tags_ in tag_sets])
+    cols = np.searchsorted(
+        tags, [f"tag{t:03d}" for tags_ in tag_sets for t in sorted(tags_)]
+    )
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+        shape=(len(tag_sets), len(tags)),
+    )
+    ids = np.arange(1, len(tag_sets) + 1, dtype=np.int64)
+    return HashtagIndex(tags, ids, ids, matrix, matrix.copy())
+
+
+def _jaccard(a: set[int], b: set[int]) -> float:
+    return len(a & b) / len(a | b)
+
+
+def test_candidates_recall_exact_jaccard() -> None:
+    rng = np.random.default_rng(3)
+    tag_sets: list[set[int]] = []
+    for _ in range(40):  # groups of users drawing most hashtags from a shared pool
+        pool = rng.choice(1000, 30, replace=False)
+        for _ in range(5):
+            keep = rng.random(30) < rng.uniform(0.8, 1.0)
+            tag_sets.append(set(pool[keep].tolist()))
+    index = _index(tag_sets)
+    candidates = {
+        int(user_id): set(index.candidates(int(user_id)).tolist())
+        for user_id in index.user_ids
+    }
+
+    similar = dissimilar = recalled = false_positives = 0
+    for a, b in combinations(range(len(tag_sets)), 2):
+        jaccard = _jaccard(tag_sets[a], tag_sets[b])
+        found = b + 1 in candidates[a + 1]
+        assert found == (a + 1 in candidates[b + 1])
+        if jaccard >= SIMILAR:
+            similar += 1
+            recalled += found
+        elif jaccard < DISSIMILAR:
+            dissimilar += 1
+            false_positives += found
+    assert similar > 100 and dissimilar > 10_000
+    assert recalled / similar > 0.95
+    assert false_positives / dissimilar < 0.01
+
+    user = tag_sets[0]
+    for other_id, estimate in index.similar(1):
+        assert abs(estimate - _jaccard(user, tag_sets[other_id - 1])) < 0.25
+    exact = np.array([_jaccard(user, other) for other in tag_sets])
+    approx = index.approx_common_hashtags(1, index.user_ids)
+    assert np.abs(approx - exact / (1 + exact)).max() < 0.15
+    common = index.common_hashtags(1, index.user_ids)
+    assert np.allclose(
+        common, [len(user & other) / (len(user) + len(other)) for other in tag_sets]
+    )
+
+
+def test_index_matches_tables(populated: SyntheticGraph) -> None:
+    index = HashtagIndex.build()
+    for tag in index.tags[:20].tolist():
+        assert index.statuses(tag).tolist() == sorted(
+            status.status_id for status in query.statuses_by_hashtag(tag)
+        )
+    for user_id in index.user_ids[:20].tolist():
+        user = query.user_by_id(user_id)
+        if user is not None:
+            assert index.hashtags(user_id) == query.hashtags_used(user)
+
+
+def test_swapped_hashtag_rebuilds_index(
+    populated: SyntheticGraph, tmp_path: Path
+) -> None:
+    path = str(tmp_path / "hashtags.npz")
+    index = load_or_build(path)
+    assert index.fingerprint is not None
+    reloaded = load_or_build(path)
+    assert reloaded.fingerprint is not None
+    assert reloaded.fingerprint.tolist() == index.fingerprint.tolist()
+
+    # the last row is replaced in one save: same row count and greatest rowid
+    status_id, tag_id = session.execute(
+        text(
+            "SELECT status_id, hashtag_dict_id FROM status_hashtag ORDER BY rowid DESC"
+        )
+    ).first()
+    other_status = (
+        session.query(TwitscanStatus)
+        .filter(TwitscanStatus.status_id.notin_(session.query(Hashtag.status_id)))
+        .first()
+    )
+    assert other_status is not None
+    session.query(Hashtag).filter(
+        Hashtag.status_id == status_id, Hashtag.hashtag_dict_id == tag_id
+    ).delete(synchronize_session=False)
+    session.add(Hashtag(status_id=other_status.status_id, hashtag_dict_id=tag_id))
+    session.flush()
+    author = session.query(TwitscanStatus.user_id).filter(
+        TwitscanStatus.status_id == status_id
+    )
+    aggregates.refresh([author.scalar(), other_status.user_id])
+    session.commit()
+
+    name = session.query(HashtagName.name).filter(HashtagName.hashtag_dict_id == tag_id)
+    rebuilt = load_or_build(path)
+    assert rebuilt.fingerprint is not None
+    # counting rows or reading the last rowid misses the swap
+    assert rebuilt.fingerprint[:2].tolist() == index.fingerprint[:2].tolist()
+    assert status_id in index.statuses(name.scalar())
+    assert status_id not in rebuilt.statuses(name.scalar())
+    assert other_status.status_id in rebuilt.statuses(name.scalar())
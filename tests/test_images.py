@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import sqlite3
+from pathlib import Path
+
+from twitscan.images import ImageStore, Manifest
+
+
+def test_manifest_moves_avatar_rows_to_the_store(tmp_path: Path) -> None:
+    picture = tmp_path / "profiles" / "alice.jpeg"
+    picture.parent.mkdir()
+    picture.write_bytes(b"jpeg bytes")
+    path = str(tmp_path / "manifest.db")
+    connection = sqlite3.connect(path)
+    # the manifest written before pictures were stored by content hash
+    connection.execute(
+        "CREATE TABLE avatar (user_id INTEGER PRIMARY KEY, url TEXT NOT NULL, "
+        "path TEXT NOT NULL, etag TEXT, last_modified TEXT, fetched_at REAL NOT NULL)"
+    )
+    connection.executemany(
+        "INSERT INTO avatar VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (1, "http://a/1.jpg", str(picture), '"v1"', "Mon, 01 Jan 2024", 10.0),
+            (2, "http://a/2.jpg", str(tmp_path / "gone.jpeg"), None, None, 20.0),
+        ],
+    )
+    connection.commit()
+    connection.close()
+
+    store = ImageStore(str(tmp_path / "store"))
+    manifest = Manifest(path, store)
+    entry = manifest.get(1)
+    assert entry is not None
+    assert (entry.screen_name, entry.url, entry.etag, entry.last_modified) == (
+        "alice",
+        "http://a/1.jpg",
+        '"v1"',
+        "Mon, 01 Jan 2024",
+    )
+    assert entry.digest in store
+    assert manifest.get(2) is None  # its file is gone, downloaded again
+    manifest.close()
+    # migrated once, reopening keeps the entries
+    manifest = Manifest(path, store)
+    assert manifest.get(1) == entry
+    manifest.close()
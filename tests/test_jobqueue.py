@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from twitscan import jobqueue, session
+from twitscan.aioscan import AsyncScanner
+from twitscan.fake import FakeTwitter, SyntheticGraph
+from twitscan.models import ScanJob
+
+
+def _state(job_id: int) -> ScanJob:
+    session.expire_all()
+    job: ScanJob | None = session.query(ScanJob).get(job_id)
+    assert job is not None
+    return job
+
+
+def test_concurrent_claims_never_share_a_job(db: str) -> None:
+    assert jobqueue.enqueue(range(1, 201)) == 200
+    claimed: dict[str, list[int]] = {}
+    start = threading.Barrier(4)
+
+    def claimer(worker: str) -> None:
+        ids = claimed.setdefault(worker, [])
+        start.wait()
+        try:
+            while True:
+                jobs = jobqueue.claim(worker, limit=7)
+                if not jobs:
+                    return
+                assert {job.lease for job in jobs} == {jobs[0].lease}
+                ids.extend(job.job_id for job in jobs)
+        finally:
+            session.remove()  # connection of this thread
+
+    threads = [threading.Thread(target=claimer, args=(f"w{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ids = [job_id for worker_ids in claimed.values() for job_id in worker_ids]
+    assert len(ids) == len(set(ids)) == 200
+    assert sum(1 for worker_ids in claimed.values() if worker_ids) > 1
+    assert jobqueue.counts()[jobqueue.LEASED] == 200
+
+
+def test_expired_lease_is_claimed_again(
+    db: str, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    jobqueue.enqueue([1, 2])
+    jobqueue.enqueue([3], main=True)
+    first = sorted(jobqueue.claim("a", limit=2, lease=60), key=lambda job: -job.main)
+    assert [job.user_id for job in first] == [3, 1]  # main users first
+    assert jobqueue.claim("b", limit=2, lease=60)[0].user_id == 2
+    assert jobqueue.claim("b", lease=60) == []
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 30)
+    jobqueue.renew("a", [first[0].job_id], lease=60)  # 3 is held until now + 90
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    again = jobqueue.claim("b", limit=2, lease=60, max_attempts=2)
+    assert sorted((job.user_id, job.attempts) for job in again) == [(1, 2), (2, 2)]
+    assert _state(first[0].job_id).lease.startswith("a:")
+    jobqueue.renew("a", [first[1].job_id], lease=600)  # no longer held by a
+    assert _state(first[1].job_id).lease.startswith("b:")
+
+    # a lease expiring after the last attempt fails the job instead
+    monkeypatch.setattr(time, "time", lambda: now + 200)
+    assert [job.user_id for job in jobqueue.claim("c", limit=3, max_attempts=2)] == [3]
+    assert jobqueue.counts()[jobqueue.FAILED] == 2
+    assert _state(again[0].job_id).error == "lease expired after the last attempt"
+
+
+def test_fail_retries_then_gives_up(db: str) -> None:
+    jobqueue.enqueue([1])
+    (job,) = jobqueue.claim("a")
+    jobqueue.fail(job, "over capacity", max_attempts=2)
+    retried = _state(job.job_id)
+    assert retried.state == jobqueue.PENDING and retried.lease is None
+    assert retried.available_at > time.time()  # after a backoff delay
+    assert jobqueue.claim("a") == []
+
+    session.query(ScanJob).update({ScanJob.available_at: 0.0})
+    session.commit()
+    (job,) = jobqueue.claim("a")
+    jobqueue.fail(job, "over capacity", max_attempts=2)
+    assert _state(job.job_id).state == jobqueue.FAILED
+
+
+def test_protected_and_permanent_errors_are_terminal(
+    db: str, graph: SyntheticGraph, fake: FakeTwitter
+) -> None:
+    protected = next(
+        uid for uid in range(1, graph.users + 1) if graph.is_protected(uid)
+    )
+    missing = graph.users + 1  # answered with a 404
+    jobqueue.enqueue([protected, missing])
+    scanner = AsyncScanner(concurrency=2, api_factory=lambda: fake.api())
+    try:
+        for job in jobqueue.claim("a", limit=2):
+            asyncio.run(jobqueue.run_job(scanner, job))
+    finally:
+        scanner.close()
+    states = dict(session.query(ScanJob.user_id, ScanJob.state))
+    assert states == {protected: jobqueue.PROTECTED, missing: jobqueue.FAILED}
+    assert _state(1).attempts == 1 and _state(2).attempts == 1
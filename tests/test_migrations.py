@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import sqlite3
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from sqlalchemy import text
+
+from twitscan import configure, context, migrations, query, session
+from twitscan.cache import features_cache
+from twitscan.models import HashtagName, Url
+
+# tables of the first release, before any migration
+BASELINE = """
+CREATE TABLE user (
+    user_id INTEGER PRIMARY KEY, screen_name VARCHAR NOT NULL, name VARCHAR,
+    created_at DATE NOT NULL, verified BOOLEAN NOT NULL, favorites_count INTEGER NOT NULL,
+    status_count INTEGER NOT NULL, friends_count INTEGER NOT NULL,
+    followers_count INTEGER NOT NULL, user_picture_url VARCHAR
+);
+CREATE TABLE status (
+    status_id INTEGER PRIMARY KEY, text VARCHAR, created_at DATE NOT NULL,
+    favorite_count INTEGER NOT NULL, retweet_count INTEGER NOT NULL,
+    in_reply_to_status_id INTEGER, in_reply_to_user_id INTEGER,
+    is_retweet BOOLEAN NOT NULL, user_id INTEGER NOT NULL REFERENCES user (user_id)
+);
+CREATE TABLE mention (
+    mention_id INTEGER PRIMARY KEY,
+    status_id INTEGER NOT NULL REFERENCES status (status_id), user_id INTEGER
+);
+CREATE TABLE hashtag (
+    hashtag_id INTEGER PRIMARY KEY,
+    status_id INTEGER NOT NULL REFERENCES status (status_id), hashtag_name VARCHAR
+);
+CREATE TABLE link (
+    link_id INTEGER PRIMARY KEY,
+    status_id INTEGER NOT NULL REFERENCES status (status_id), link VARCHAR
+);
+CREATE TABLE interaction (
+    interaction_id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES user (user_id),
+    status_id INTEGER REFERENCES status (status_id), fav BOOLEAN NOT NULL,
+    retweet BOOLEAN NOT NULL, comment BOOLEAN NOT NULL
+);
+CREATE TABLE friend (
+    entourage_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES user (user_id),
+    friend_follower_id INTEGER NOT NULL, friend BOOLEAN NOT NULL, follower BOOLEAN NOT NULL
+);
+"""
+HASHTAGS = [
+    (10, "Tag"),
+    (10, "tag"),  # both spellings on one status
+    (11, "TAG"),
+    (11, "python"),
+    (12, "tag"),
+    (13, "Python"),
+    (14, None),
+]
+LINKS = [
+    (10, "HTTP://Example.COM/Path"),
+    (11, "http://example.com/Path"),
+    (12, "http://example.com/path"),  # paths are case sensitive
+    (13, "https://News.Example.org/a?b=C"),
+    (14, ""),
+]
+
+
+@pytest.fixture
+def baseline(tmp_path: Path) -> Iterator[str]:
+    """database at the schema of the first release, with hashtags in every case"""
+    path = tmp_path / "baseline.db"
+    with sqlite3.connect(path) as conn:
+        conn.executescript(BASELINE)
+        conn.executemany(
+            "INSERT INTO user VALUES (?, ?, ?, '2015-01-01', 0, 0, 0, 0, 0, NULL)",
+            [(1, "user1", "User 1"), (2, "user2", "User 2")],
+        )
+        conn.executemany(
+            "INSERT INTO status (status_id, text, created_at, favorite_count, "
+            "retweet_count, is_retweet, user_id) VALUES (?, ?, '2015-01-02', 0, 0, 0, ?)",
+            [
+                (status_id, f"tweet {status_id}", status_id % 2 + 1)
+                for status_id in range(10, 16)
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO hashtag (status_id, hashtag_name) VALUES (?, ?)", HASHTAGS
+        )
+        conn.executemany("INSERT INTO link (status_id, link) VALUES (?, ?)", LINKS)
+    configure(db_url=f"sqlite:///{path}")
+    features_cache.clear()
+    yield str(path)
+    context.close()
+
+
+def _baseline_statuses(path: str, hashtag: str) -> list[int]:
+    """statuses tagged with any spelling of the hashtag, read from the old table"""
+    with sqlite3.connect(path) as conn:
+        return sorted(
+            status_id
+            for (status_id,) in conn.execute(
+                "SELECT DISTINCT status_id FROM hashtag WHERE lower(hashtag_name) = ?",
+                (hashtag.lower(),),
+            )
+        )
+
+
+def _ids(hashtag: str) -> list[int]:
+    return sorted(status.status_id for status in query.statuses_by_hashtag(hashtag))
+
+
+def test_migrate_interns_baseline_entities(baseline: str) -> None:
+    before = {tag: _baseline_statuses(baseline, tag) for tag in ("tag", "python")}
+    assert before == {"tag": [10, 11, 12], "python": [11, 13]}
+
+    assert migrations.migrate() == len(migrations.MIGRATIONS)
+    for tag, statuses in before.items():
+        assert _ids(tag) == _ids(tag.upper()) == _ids(tag.title()) == statuses
+    assert _ids("missing") == []
+    assert sorted(name for (name,) in session.query(HashtagName.name)) == [
+        "python",
+        "tag",
+    ]
+    rows = session.execute(
+        text("SELECT COUNT(*) FROM status_hashtag WHERE status_id = 10")
+    )
+    assert rows.scalar() == 1  # #Tag and #tag of status 10 are one hashtag
+
+    urls = sorted(url for (url,) in session.query(Url.url))
+    assert urls == [
+        "http://example.com/Path",
+        "http://example.com/path",
+        "https://news.example.org/a?b=C",
+    ]
+    links = session.execute(
+        text(
+            "SELECT s.status_id, u.url, d.name FROM status_url s "
+            "JOIN url_dict u ON u.url_id = s.url_id JOIN domain d ON d.domain_id = u.domain_id"
+        )
+    )
+    assert sorted(tuple(row) for row in links) == [
+        (10, "http://example.com/Path", "example.com"),
+        (11, "http://example.com/Path", "example.com"),
+        (12, "http://example.com/path", "example.com"),
+        (13, "https://news.example.org/a?b=C", "news.example.org"),
+    ]
+    tables = set(session.execute(text("SELECT name FROM sqlite_master")).scalars())
+    assert {"hashtag", "link"}.isdisjoint(tables)
+    # aggregates were rebuilt from the interned hashtags
+    user1, user2 = query.user_by_id(1), query.user_by_id(2)
+    assert user1 is not None and query.hashtags_used(user1) == {"tag"}
+    assert user2 is not None and query.hashtags_used(user2) == {"tag", "python"}
+    assert migrations.migrate() == len(migrations.MIGRATIONS)  # nothing left to apply
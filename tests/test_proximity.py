@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+import numpy as np
+import pytest
+
+from twitscan import proximity, query
+from twitscan.cache import FeatureCache
+from twitscan.entourage import EntourageIndex
+from twitscan.fake import SyntheticGraph
+
+
+@pytest.mark.parametrize("source", ["tables", "index", "cache", "cache_index"])
+def test_bulk_proximity_matches_query_proximity(
+    populated: SyntheticGraph, source: str
+) -> None:
+    user = query.user_by_id(1)
+    assert user is not None
+    cache = FeatureCache() if source.startswith("cache") else None
+    index = EntourageIndex.build() if source.endswith("index") else None
+    try:
+        matrix = proximity.bulk_proximity(user, index=index, cache=cache)
+    finally:
+        if cache is not None:
+            cache.close()
+    assert len(matrix.follower_ids) > 0
+    for follower_id, (_, row) in zip(matrix.follower_ids.tolist(), matrix.rows()):
+        follower = query.user_by_id(follower_id)
+        assert follower is not None
+        # the last features of query.proximity are those of the matrix, in order
+        assert np.allclose(query.proximity(user, follower)[13:], row), follower_id
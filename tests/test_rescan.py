@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+from tweepy.models import Status
+
+from twitscan import scanner, session
+from twitscan.fake import FakeTwitter, SyntheticGraph
+from twitscan.ingest import Ingestor, rescan
+from twitscan.models import TwitscanStatus
+
+
+def _stored_statuses(user_id: int) -> set[int]:
+    return {
+        status_id
+        for (status_id,) in session.query(TwitscanStatus.status_id).filter(
+            TwitscanStatus.user_id == user_id
+        )
+    }
+
+
+def _scannable(graph: SyntheticGraph) -> int:
+    return next(
+        int(uid) for uid in graph.followers(1) if not graph.is_protected(int(uid))
+    )
+
+
+def test_rescan_fetches_new_tweets(db: str, graph: SyntheticGraph) -> None:
+    user_id = _scannable(graph)
+    scanner.scan(user_id=user_id)
+    assert scanner.latest_status_id(user_id) == graph.timeline(user_id)[0]
+
+    graph.post(3)
+    rescan(user_id=user_id)
+    assert set(graph.timeline(user_id)) <= _stored_statuses(user_id)
+    assert scanner.latest_status_id(user_id) == graph.timeline(user_id)[0]
+
+
+def test_rescan_since_id_ignores_favorited_tweets(
+    db: str, graph: SyntheticGraph, fake: FakeTwitter
+) -> None:
+    user_id = _scannable(graph)
+    scanner.scan(user_id=user_id)
+    graph.post(3)
+    # the newest tweet is stored as someone else's favorite before the rescan
+    newest = graph.timeline(user_id)[0]
+    Ingestor().save_statuses([Status.parse(fake.api(), graph.status_json(newest))])
+    session.commit()
+
+    rescan(user_id=user_id)
+    assert set(graph.timeline(user_id)) <= _stored_statuses(user_id)
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import re
+from datetime import date
+
+from twitscan import search, session
+from twitscan.fake import SyntheticGraph
+from twitscan.models import TwitscanStatus, TwitscanUser
+
+FIRST_ID = 10**12  # above the ids of the synthetic graph
+
+
+def _status(number: int, text: str) -> TwitscanStatus:
+    status = TwitscanStatus(
+        status_id=FIRST_ID + number,
+        text=text,
+        created_at=date(2020, 1, 1),
+        favorite_count=0,
+        retweet_count=0,
+        is_retweet=False,
+        user_id=1,
+    )
+    session.add(status)
+    return status
+
+
+def _user(number: int, screen_name: str, name: str) -> TwitscanUser:
+    user = TwitscanUser(
+        user_id=FIRST_ID + number,
+        screen_name=screen_name,
+        name=name,
+        created_at=date(2020, 1, 1),
+        verified=False,
+        favorites_count=0,
+    )
+    session.add(user)
+    return user
+
+
+def _words(text: str) -> set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def _statuses(terms: str, **kwargs: bool) -> list[int]:
+    return [st.status_id for st, _ in search.search_statuses(terms, **kwargs)]
+
+
+def _users(terms: str) -> list[int]:
+    return [usr.user_id for usr, _ in search.search_users(terms)]
+
+
+def test_triggers_keep_fts_in_sync(populated: SyntheticGraph) -> None:
+    status = _status(1, "spotted a quokka near the river")
+    user = _user(1, "quokkafan", "River Watcher")
+    session.commit()
+    assert _statuses("quokka") == [status.status_id]
+    assert _users("river watcher") == [user.user_id]
+
+    status.text = "spotted a wombat instead"
+    user.name = "Hill Watcher"
+    session.commit()
+    assert _statuses("quokka") == []
+    assert _statuses("wombat") == [status.status_id]
+    assert _users("river") == []
+    assert _users("hill") == [user.user_id]
+
+    session.delete(status)
+    session.delete(user)
+    session.commit()
+    assert _statuses("wombat") == []
+    assert _users("quokkafan") == []
+    # the stored statuses were backfilled and are still indexed
+    assert len(_statuses("tweet", limit=None)) == session.query(TwitscanStatus).count()
+
+
+def test_phrase_and_prefix_matching(populated: SyntheticGraph) -> None:
+    first = _status(1, "quokka sightings by the river")
+    second = _status(2, "the river had no quokka sightings")
+    session.commit()
+    assert sorted(_statuses("river quokka")) == [first.status_id, second.status_id]
+    assert _statuses("river quokka", phrase=True) == []
+    assert sorted(_statuses("quokka sightings", phrase=True)) == [
+        first.status_id,
+        second.status_id,
+    ]
+    assert _statuses("no quokka", phrase=True) == [second.status_id]
+    assert _statuses("quok") == []
+    assert sorted(_statuses("quok", prefix=True)) == [
+        first.status_id,
+        second.status_id,
+    ]
+    assert _statuses("river ha", phrase=True, prefix=True) == [second.status_id]
+    assert search.match_expression("quokka's river!", prefix=True) == (
+        '"quokka"* "s"* "river"*'
+    )
+    assert search.match_expression("  ,; ") == ""
+    assert search.search_statuses("?!") == []
+
+
+def test_bm25_ranks_better_matches_first(populated: SyntheticGraph) -> None:
+    once = _status(1, "one marmot among many other words of a longer status text")
+    twice = _status(2, "marmot marmot seen")
+    screen_named = _user(1, "ferret", "Someone Else")
+    named = _user(2, "someone", "Ferret Keeper")
+    short_named = _user(3, "ferretkeeper", "Ferret")
+    session.commit()
+    ranked = search.search_statuses("marmot")
+    assert [st.status_id for st, _ in ranked] == [twice.status_id, once.status_id]
+    assert ranked[0][1] > ranked[1][1]
+    # screen names weigh twice as much as names
+    users = _users("ferret")
+    assert users[0] == screen_named.user_id
+    assert set(users) == {screen_named.user_id, named.user_id, short_named.user_id}
+    assert _users("ferret keeper") == [named.user_id]
+
+
+def test_search_matches_the_stored_words(populated: SyntheticGraph) -> None:
+    expected = sorted(
+        status_id
+        for status_id, text in session.query(
+            TwitscanStatus.status_id, TwitscanStatus.text
+        )
+        if {"user", "42"} <= _words(text)
+    )
+    assert expected
+    ranked = _statuses("42 user", limit=None)
+    assert sorted(ranked) == expected
+    assert _statuses("42 user", limit=3) == ranked[:3]
+    page = search.search_statuses("42 user", limit=2, offset=1)
+    assert [st.status_id for st, _ in page] == ranked[1:3]
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from twitscan.proximity import FEATURES, RATIOS
+from twitscan.sink import SCHEMA, RankingSink
+
+
+def _table(user: str, follower_ids: list[int]) -> pa.Table:
+    rows = len(follower_ids)
+    columns = {
+        "user": [user] * rows,
+        "follower": [f"user{fid}" for fid in follower_ids],
+        "follower_id": follower_ids,
+    }
+    for name in FEATURES:
+        columns[name] = np.full(rows, 0.5) if name in RATIOS else np.arange(rows)
+    return pa.table(columns, schema=SCHEMA)
+
+
+def _files(directory: Path) -> list[str]:
+    return sorted(
+        str(path.relative_to(directory))
+        for path in directory.rglob("*")
+        if path.is_file() and path.name != "_index.db"
+    )
+
+
+def test_interrupted_write_resumes(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    sink = RankingSink(str(tmp_path))
+    assert sink.write(_table("user1", [2, 3])) == 2
+
+    def crash(src: str, dst: str) -> None:
+        raise KeyboardInterrupt  # after write_table, before the index commit
+
+    with monkeypatch.context() as patched:
+        patched.setattr(os, "replace", crash)
+        with pytest.raises(KeyboardInterrupt):
+            sink.write(_table("user1", [3, 4, 5]))
+    # the part written before the crash is not visible
+    assert len(sink) == 2 and sink.scored("user1") == {2, 3}
+    assert sorted(sink.read()["follower_id"]) == [2, 3]
+    assert _files(tmp_path) == [
+        "user=user1/part-00000.parquet",
+        "user=user1/part-00001.parquet.tmp",
+    ]
+    sink.close()
+    (tmp_path / "user=user1" / "notes.txt").write_text("not a part")
+
+    resumed = RankingSink(str(tmp_path))
+    assert _files(tmp_path) == [
+        "user=user1/notes.txt",
+        "user=user1/part-00000.parquet",
+    ]
+    # pairs scored before the crash are skipped, numbering follows the committed parts
+    assert resumed.write(_table("user1", [2, 3, 4, 5])) == 2
+    assert resumed.write(_table("user1", [4, 5])) == 0
+    assert resumed.write(_table("user2", [1])) == 1
+    assert _files(tmp_path) == [
+        "user=user1/notes.txt",
+        "user=user1/part-00000.parquet",
+        "user=user1/part-00001.parquet",
+        "user=user2/part-00000.parquet",
+    ]
+    frame = resumed.read()
+    assert sorted(zip(frame["user"], frame["follower_id"])) == [
+        ("user1", 2),
+        ("user1", 3),
+        ("user1", 4),
+        ("user1", 5),
+        ("user2", 1),
+    ]
+    assert frame["common_entourage"].tolist() == [0.5] * 5
+    resumed.close()
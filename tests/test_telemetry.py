@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import re
+
+from twitscan.telemetry import API_CALLS, API_SECONDS, PHASE_SECONDS, Registry
+
+# samples allowed in a family of each type, quantiles are not exported
+SUFFIXES = {"counter": ("",), "gauge": ("",), "summary": ("_count", "_sum")}
+SAMPLE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$")
+
+
+def _families(exposition: str) -> dict[str, tuple[str, list[tuple[str, float]]]]:
+    """family name -> type and samples, checking the text format rules on the way"""
+    families: dict[str, tuple[str, list[tuple[str, float]]]] = {}
+    current: str | None = None
+    for line in exposition.splitlines():
+        if line.startswith("# TYPE "):
+            name, kind = line[len("# TYPE ") :].split()
+            assert name not in families, f"{name} declared twice"
+            families[name] = (kind, [])
+            current = name
+            continue
+        match = SAMPLE.match(line)
+        assert match is not None, line
+        assert current is not None, f"{line} before any TYPE"
+        kind, samples = families[current]
+        suffix = match.group(1)[len(current) :]
+        assert match.group(1).startswith(current), f"{line} outside of {current}"
+        assert suffix in SUFFIXES[kind], f"{line} in the {kind} {current}"
+        samples.append((match.group(1), float(match.group(3))))
+    return families
+
+
+def test_prometheus_families() -> None:
+    registry = Registry()
+    registry.inc(API_CALLS, endpoint="/users/show")
+    registry.inc(API_CALLS, 2, endpoint="/friends/ids")
+    registry.set("twitscan_jobs", 3, state="pending")
+    for phase, seconds in (("fetch", 0.5), ("commit", 0.25), ("fetch", 1.5)):
+        registry.observe(PHASE_SECONDS, seconds, function="save_user", phase=phase)
+    registry.observe(API_SECONDS, 0.125, endpoint='/users/"show"')
+
+    families = _families(registry.prometheus())
+    assert families[API_CALLS] == (
+        "counter",
+        [(API_CALLS, 2.0), (API_CALLS, 1.0)],
+    )
+    assert families["twitscan_jobs"] == ("gauge", [("twitscan_jobs", 3.0)])
+    kind, samples = families[PHASE_SECONDS]
+    assert kind == "summary"
+    assert sorted(samples) == sorted(
+        [
+            (f"{PHASE_SECONDS}_count", 1.0),
+            (f"{PHASE_SECONDS}_sum", 0.25),
+            (f"{PHASE_SECONDS}_count", 2.0),
+            (f"{PHASE_SECONDS}_sum", 2.0),
+        ]
+    )
+    assert sorted(families[f"{PHASE_SECONDS}_max"][1]) == [
+        (f"{PHASE_SECONDS}_max", 0.25),
+        (f"{PHASE_SECONDS}_max", 1.5),
+    ]
+    assert families[f"{API_SECONDS}_max"] == (
+        "gauge",
+        [(f"{API_SECONDS}_max", 0.125)],
+    )
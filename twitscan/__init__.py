@@ -1,7 +1,5 @@
 from __future__ import annotations
 
-from sqlalchemy.orm.session import Session
-
 """
 Twitscan library
 """
@@ -10,36 +8,210 @@ __author__ = "monkeyusage"
 __license__ = "MIT"
 import os
 from atexit import register
-from typing import Any
+from typing import TYPE_CHECKING, Any, Callable, cast
 
-import tweepy
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine.base import Engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm.session import Session
+from sqlalchemy.pool import QueuePool
+
+from twitscan.telemetry import instrument
+
+if TYPE_CHECKING:
+    import tweepy
+
+    from twitscan.credentials import CredentialPool
+
+DB_URL = "sqlite:///data/twitter.db"
+# write-ahead logging lets readers run while a scan writes,
+# synchronous=NORMAL only syncs at checkpoints which is safe in WAL mode
+PRAGMAS: dict[str, Any] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 2**20,
+    "cache_size": -64 * 2**10,  # negative sizes are in KiB
+    "temp_store": "MEMORY",
+}
+POOL_SIZE = 8
+BUSY_TIMEOUT = 30  # seconds a writer waits for another one to commit
+
+
+def readonly_url(db_url: str) -> str:
+    """url of a sqlite file opened read-only, no write lock can ever be taken"""
+    url = make_url(db_url)
+    return f"sqlite:///file:{url.database}?mode=ro&uri=true"
+
+
+def default_auth() -> tweepy.OAuthHandler:
+    """oauth handler from the TWITTER_* environment variables"""
+    import tweepy
+
+    auth = tweepy.OAuthHandler(
+        os.environ["TWITTER_CONSUMER_KEY"], os.environ["TWITTER_CONSUMER_SECRET"]
+    )
+    auth.set_access_token(
+        os.environ["TWITTER_ACCESS_TOKEN"], os.environ["TWITTER_ACCESS_TOKEN_SECRET"]
+    )
+    return auth
+
+
+def default_api(auth: tweepy.OAuthHandler) -> tweepy.API:
+    """api waiting out rate limits, the waits are timed apart from the calls"""
+    import tweepy
+
+    return cast(
+        "tweepy.API",
+        instrument(tweepy.API(auth, compression=True), wait_on_rate_limit=True),
+    )
 
-consumer_key = os.environ["TWITTER_CONSUMER_KEY"]
-consumer_secret = os.environ["TWITTER_CONSUMER_SECRET"]
-access_token = os.environ["TWITTER_ACCESS_TOKEN"]
-access_token_secret = os.environ["TWITTER_ACCESS_TOKEN_SECRET"]
 
-auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
-auth.set_access_token(access_token, access_token_secret)
+class Context:
+    """
+    database and api resources of the package, each one is created on first use
+    so that importing twitscan needs neither credentials nor a database file
+    """
 
+    def __init__(
+        self,
+        db_url: str | None = None,
+        api_factory: Callable[[], tweepy.API] | None = None,
+        pragmas: dict[str, Any] | None = None,
+        readonly: bool = False,
+    ):
+        self.db_url = db_url or os.environ.get("TWITSCAN_DB_URL", DB_URL)
+        self.api_factory = api_factory
+        self.pragmas = dict(PRAGMAS if pragmas is None else pragmas)
+        self.readonly = readonly
+        self._engine: Engine | None = None
+        self._session: scoped_session | None = None
+        self._auth: tweepy.OAuthHandler | None = None
+        self._api: tweepy.API | None = None
+        self._pool: CredentialPool | None = None
+        self._pool_loaded = False
 
-def config_db(test: bool = False) -> tuple[Engine, Session]:
-    engine: Engine = (
-        create_engine("sqlite://")
-        if test
-        else create_engine("sqlite:///data/twitter.db")
-    )  # test db is in memory
-    _Session: Any = sessionmaker()
-    _Session.configure(bind=engine)
-    session: Session = _Session()
-    return engine, session
+    def _set_pragmas(self, dbapi_connection: Any, _: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas.items():
+            if name == "journal_mode" and self.readonly:
+                continue  # persisted in the file by writers, readers can not set it
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
 
+    @property
+    def engine(self) -> Engine:
+        """
+        sqlite files get a pool of connections usable from any thread,
+        so that each thread's session holds its own connection
+        """
+        if self._engine is None:
+            url = make_url(self.db_url)
+            if url.get_backend_name() != "sqlite" or url.database in (
+                None,
+                "",
+                ":memory:",
+            ):
+                self._engine = create_engine(self.db_url)
+            else:
+                self._engine = create_engine(
+                    readonly_url(self.db_url) if self.readonly else self.db_url,
+                    poolclass=QueuePool,
+                    pool_size=POOL_SIZE,
+                    connect_args=dict(check_same_thread=False, timeout=BUSY_TIMEOUT),
+                )
+            if url.get_backend_name() == "sqlite" and self.pragmas:
+                event.listen(self._engine, "connect", self._set_pragmas)
+        return self._engine
 
-engine, session = config_db()
-test_engine, test_session = config_db(test=True)
+    @property
+    def session(self) -> scoped_session:
+        """one session per thread, all bound to the engine"""
+        if self._session is None:
+            self._session = scoped_session(sessionmaker(bind=self.engine))
+        return self._session
+
+    @property
+    def auth(self) -> tweepy.OAuthHandler:
+        if self._auth is None:
+            self._auth = default_auth()
+        return self._auth
+
+    @property
+    def pool(self) -> CredentialPool | None:
+        """keys of the credentials file, None without one, see twitscan.credentials"""
+        if not self._pool_loaded:
+            from twitscan.credentials import default_pool
+
+            self._pool = default_pool()
+            self._pool_loaded = True
+        return self._pool
+
+    @property
+    def api(self) -> tweepy.API:
+        """
+        every call is counted and timed per endpoint, see twitscan.telemetry,
+        calls go through the credential pool when there is one
+        """
+        if self._api is None:
+            if self.api_factory is not None:
+                api = self.api_factory()
+            elif self.pool is not None:
+                api = self.pool.api()
+            else:
+                api = default_api(self.auth)
+            self._api = cast("tweepy.API", instrument(api))
+        return self._api
+
+    def configure(
+        self,
+        db_url: str | None = None,
+        api_factory: Callable[[], tweepy.API] | None = None,
+        pragmas: dict[str, Any] | None = None,
+        readonly: bool | None = None,
+    ) -> None:
+        """replaces the given settings, resources built from the old ones are dropped"""
+        if db_url is not None or pragmas is not None or readonly is not None:
+            self.close()
+            self.db_url = db_url or self.db_url
+            self.pragmas = dict(pragmas) if pragmas is not None else self.pragmas
+            self.readonly = readonly if readonly is not None else self.readonly
+        if api_factory is not None:
+            self.api_factory = api_factory
+            self._api = None
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.remove()
+            self._session = None
+        if self._engine is not None:
+            self._engine.dispose()
+            self._engine = None
+
+
+class _Resource:
+    """stands for a context resource so that modules keep `from twitscan import session`"""
+
+    def __init__(self, name: str):
+        object.__setattr__(self, "_name", name)
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(getattr(context, self._name), attr)
+
+    def __setattr__(self, attr: str, value: Any) -> None:
+        setattr(getattr(context, self._name), attr, value)
+
+    def __repr__(self) -> str:
+        return f"<lazy twitscan {self._name}>"
+
+
+context = Context()
+configure = context.configure
+
+engine = cast(Engine, _Resource("engine"))
+session = cast(Session, _Resource("session"))
+auth = cast("tweepy.OAuthHandler", _Resource("auth"))
+api = cast("tweepy.API", _Resource("api"))
 
 config: dict[str, int] = {
     "MAX_FOLLOWERS": 200,
@@ -51,8 +223,4 @@ assert (
     config["MAX_TWEETS"] <= 200
 ), "Twitter API accepts retrieval of maximum 3200 tweets for each user"
 
-api = tweepy.API(
-    auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True, compression=True
-)
-
-register(session.close)
+register(context.close)
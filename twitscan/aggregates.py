@@ -0,0 +1,141 @@
+"""
+Per user aggregates of statuses, mentions and interactions, the facts proximity features
+are derived from; refreshed for the users a save touched, in the transaction of the save
+"""
+
+from __future__ import annotations
+
+import logging
+from typing import Any, Iterable
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine.base import Connection, Engine
+
+from twitscan import context, session
+from twitscan.models import (
+    FeatureVersion,
+    TargetInteractions,
+    TargetMentions,
+    UserAggregate,
+    UserHashtag,
+)
+
+CHUNK = 500  # ids per IN clause, below sqlite's bound parameters limit
+
+# table and the select computing its rows for the :ids users from the raw tables,
+# user_features comes last as it reads user_hashtags
+STATEMENTS: tuple[tuple[Any, str], ...] = (
+    (
+        UserHashtag,
+        "SELECT s.user_id, h.hashtag_dict_id, COUNT(*) FROM status_hashtag h "
+        "JOIN status s ON s.status_id = h.status_id WHERE s.user_id IN :ids "
+        "GROUP BY s.user_id, h.hashtag_dict_id",
+    ),
+    (
+        TargetMentions,
+        "SELECT s.user_id, m.user_id, COUNT(*) FROM mention m "
+        "JOIN status s ON s.status_id = m.status_id "
+        "WHERE s.user_id IN :ids AND m.user_id IS NOT NULL "
+        "GROUP BY s.user_id, m.user_id",
+    ),
+    (
+        TargetInteractions,
+        # attributed to the author of the interacted status, as in proximity
+        "SELECT i.user_id, s.user_id, SUM(i.fav), SUM(i.retweet), SUM(i.comment) "
+        "FROM interaction i JOIN status s ON s.status_id = i.status_id "
+        "WHERE i.user_id IN :ids GROUP BY i.user_id, s.user_id",
+    ),
+    (
+        UserAggregate,
+        "SELECT user_id, SUM(hashtags), SUM(mentions) FROM ("
+        "SELECT user_id, COUNT(*) AS hashtags, 0 AS mentions FROM user_hashtags "
+        "WHERE user_id IN :ids GROUP BY user_id UNION ALL "
+        "SELECT s.user_id, 0, COUNT(*) FROM mention m "
+        "JOIN status s ON s.status_id = m.status_id "
+        "WHERE s.user_id IN :ids GROUP BY s.user_id"
+        ") GROUP BY user_id",
+    ),
+)
+
+
+def _bump(conn: Connection, user_ids: list[int]) -> None:
+    table = FeatureVersion.__table__.name
+    for start in range(0, len(user_ids), CHUNK):
+        chunk = user_ids[start : start + CHUNK]
+        conn.execute(
+            text(f"INSERT OR IGNORE INTO {table} (user_id, version) VALUES (:id, 0)"),
+            [dict(id=user_id) for user_id in chunk],
+        )
+        conn.execute(
+            text(
+                f"UPDATE {table} SET version = version + 1 WHERE user_id IN :ids"
+            ).bindparams(bindparam("ids", expanding=True)),
+            dict(ids=chunk),
+        )
+
+
+def bump(user_ids: Iterable[int]) -> None:
+    """
+    new feature version for the given users inside the session's transaction,
+    for saves changing their entourage without refreshing the aggregates
+    """
+    ids = sorted(set(user_ids))
+    if ids:
+        session.flush()
+        _bump(session.connection(), ids)
+
+
+def _refresh(conn: Connection, user_ids: list[int]) -> None:
+    _bump(conn, user_ids)
+    for start in range(0, len(user_ids), CHUNK):
+        chunk = dict(ids=user_ids[start : start + CHUNK])
+        for model, select in STATEMENTS:
+            table = model.__table__
+            columns = ", ".join(column.name for column in table.columns)
+            for sql in (
+                f"DELETE FROM {table.name} WHERE user_id IN :ids",
+                f"INSERT INTO {table.name} ({columns}) {select}",
+            ):
+                conn.execute(
+                    text(sql).bindparams(bindparam("ids", expanding=True)), chunk
+                )
+
+
+def refresh(user_ids: Iterable[int]) -> None:
+    """
+    recomputes the aggregates of the given users inside the session's transaction
+    and bumps their feature version, called by the scanner before the commit of every save
+    """
+    ids = sorted(set(user_ids))
+    if ids:
+        session.flush()
+        _refresh(session.connection(), ids)
+
+
+def rebuild(bind: Engine | Connection | None = None) -> dict[str, int]:
+    """
+    recomputes every aggregate from the raw tables in one transaction,
+    for databases filled without the scanner, returns the rows per table
+    """
+    bind = bind if bind is not None else context.engine
+    if isinstance(bind, Engine):
+        with bind.begin() as conn:
+            return rebuild(conn)
+    for model, _ in STATEMENTS:
+        bind.execute(text(f"DELETE FROM {model.__table__.name}"))
+    ids = [
+        user_id
+        for (user_id,) in bind.execute(
+            text("SELECT user_id FROM status UNION SELECT user_id FROM interaction")
+        )
+        if user_id is not None
+    ]
+    _refresh(bind, ids)
+    counts: dict[str, int] = {
+        model.__table__.name: bind.execute(
+            text(f"SELECT COUNT(*) FROM {model.__table__.name}")
+        ).scalar()
+        for model, _ in STATEMENTS
+    }
+    logging.info(f"Rebuilt the aggregates of {len(ids)} users: {counts}")
+    return counts
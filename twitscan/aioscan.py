@@ -0,0 +1,337 @@
+"""
+Concurrent user scans with one rate-limit bucket per twitter endpoint
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Iterable
+
+import tweepy
+from tweepy import RateLimitError, TweepError
+from tweepy.models import User
+
+from twitscan import config, context, scanner, telemetry
+from twitscan.errors import UserProtectedError
+from twitscan.ingest import Ingestor
+from twitscan.models import TwitscanUser
+
+if TYPE_CHECKING:
+    from twitscan.credentials import ApiKey, CredentialPool
+
+# api method -> endpoint and its limit per 15 minutes window (user auth)
+ENDPOINTS: dict[str, tuple[str, int]] = {
+    "get_user": ("/users/show", 900),
+    "friends_ids": ("/friends/ids", 15),
+    "followers_ids": ("/followers/ids", 15),
+    "user_timeline": ("/statuses/user_timeline", 900),
+    "favorites": ("/favorites/list", 75),
+}
+WINDOW = 15 * 60
+
+
+def backoff_delay(attempt: int, base: float = 5.0, cap: float = 300.0) -> float:
+    """full jitter exponential backoff: uniform between 0 and base * 2 ** attempt"""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class TokenBucket:
+    """
+    remaining calls for one endpoint until its window resets,
+    corrected with the x-rate-limit-* headers of every response
+    """
+
+    def __init__(self, endpoint: str, limit: int):
+        self.endpoint = endpoint
+        self.limit = limit
+        self.remaining = limit
+        self.reset_at = time.time() + WINDOW
+        self.waited = 0.0
+
+    def headroom(self) -> int:
+        """calls left in the current window"""
+        now = time.time()
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + WINDOW
+        return self.remaining
+
+    def take(self) -> float:
+        """takes one call if one is left and returns 0, else the seconds until the reset"""
+        if self.headroom() > 0:
+            self.remaining -= 1
+            return 0.0
+        return self.reset_at - time.time() + 1
+
+    async def acquire(self) -> float:
+        """takes one call, returns the seconds waited for it"""
+        waited = 0.0
+        while True:
+            delay = self.take()
+            if not delay:
+                return waited
+            logging.debug(f"{self.endpoint} exhausted, waiting {delay:.0f}s")
+            self.waited += delay
+            waited += delay
+            await asyncio.sleep(delay)
+
+    def update(self, headers: Any) -> None:
+        if headers is None:
+            return
+        remaining = headers.get("x-rate-limit-remaining")
+        reset = headers.get("x-rate-limit-reset")
+        limit = headers.get("x-rate-limit-limit")
+        if limit is not None:
+            self.limit = int(limit)
+        if remaining is None or reset is None:
+            return
+        if float(reset) != self.reset_at:  # first response of this window
+            self.remaining = int(remaining)
+            self.reset_at = float(reset)
+        else:  # calls issued concurrently may already have been counted
+            self.remaining = min(self.remaining, int(remaining))
+
+    def exhaust(self, headers: Any) -> None:
+        self.remaining = 0
+        reset = headers.get("x-rate-limit-reset") if headers is not None else None
+        self.reset_at = float(reset) if reset is not None else time.time() + WINDOW
+
+
+def default_api() -> tweepy.API:
+    """api without tweepy's own rate-limit waits, those are scheduled per endpoint"""
+    return tweepy.API(context.auth, compression=True)
+
+
+class AsyncScanner:
+    """
+    runs the twitter calls of many user scans concurrently in worker threads,
+    each with its own api object, database writes stay on the event loop thread
+    and go through one bulk ingestor for the whole run;
+    with a credential pool the calls are spread over its keys instead,
+    the pool of the credentials file is used unless an api factory is given
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 8,
+        max_retries: int = 5,
+        api_factory: Callable[[], tweepy.API] = default_api,
+        ingestor: Ingestor | None = None,
+        pool: CredentialPool | None = None,
+    ):
+        self.concurrency = concurrency
+        self.ingestor = ingestor if ingestor is not None else Ingestor()
+        self.max_retries = max_retries
+        self.api_factory = api_factory
+        if pool is None and api_factory is default_api:
+            pool = context.pool
+        self.pool = pool
+        self.buckets = {
+            method: TokenBucket(endpoint, limit)
+            for method, (endpoint, limit) in ENDPOINTS.items()
+        }
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(concurrency * len(ENDPOINTS))
+
+    def _api(self) -> tweepy.API:
+        api: tweepy.API | None = getattr(self._local, "api", None)
+        if api is None:
+            api = self._local.api = telemetry.instrument(self.api_factory())
+        return api
+
+    def _call_sync(
+        self, key: ApiKey | None, method: str, args: Any, kwargs: Any
+    ) -> tuple[Any, Any]:
+        if key is not None and self.pool is not None:
+            return self.pool.execute(key, method, args, kwargs), None
+        api = self._api()
+        result = getattr(api, method)(*args, **kwargs)
+        response = getattr(api, "last_response", None)
+        return result, getattr(response, "headers", None)
+
+    async def call(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        bucket = self.buckets[method]
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            key: ApiKey | None = None
+            if self.pool is None:
+                waited = await bucket.acquire()
+            else:
+                key, waited = self.pool.reserve(method)
+                if key is None:  # every key is parked on this endpoint
+                    logging.debug(f"Every key exhausted on {method}, waiting")
+                    await asyncio.sleep(waited)
+            if waited:
+                telemetry.registry.observe(
+                    telemetry.RATE_LIMIT_WAITS, waited, endpoint=method
+                )
+            if self.pool is not None and key is None:
+                continue
+            try:
+                result, headers = await loop.run_in_executor(
+                    self._executor, self._call_sync, key, method, args, kwargs
+                )
+            except RateLimitError as err:
+                if key is None:  # the pool parks its keys itself
+                    response = getattr(err, "response", None)
+                    bucket.exhaust(getattr(response, "headers", None))
+                continue
+            except TweepError as err:
+                status = getattr(err.response, "status_code", None)
+                transient = status is None or status >= 500
+                if attempt >= self.max_retries or not transient:
+                    raise
+                delay = backoff_delay(attempt)
+                logging.debug(f"{method} failed ({err}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            if key is None:
+                bucket.update(headers)
+            return result
+
+    async def fetch_ids(self, method: str, user_id: int) -> set[int]:
+        """every page of friends_ids or followers_ids"""
+        ids: set[int] = set()
+        cursor = -1
+        while cursor != 0:
+            page, (_, cursor) = await self.call(method, user_id=user_id, cursor=cursor)
+            ids.update(page)
+        return ids
+
+    async def stream_entourage(self, user_id: int) -> None:
+        """async scanner.stream_entourage, pages are written on the event loop thread"""
+
+        async def stream(kind: str, method: str) -> None:
+            cursor = scanner.stored_cursor(user_id, kind)
+            while cursor != 0:
+                ids, (_, cursor) = await self.call(
+                    method, user_id=user_id, cursor=cursor
+                )
+                scanner.save_entourage_page(user_id, kind, ids, cursor)
+
+        await asyncio.gather(
+            *(stream(kind, method) for kind, method in scanner.ENTOURAGE_PAGES.items())
+        )
+
+    async def fetch(
+        self, raw_user: User, since_id: None | int = None, entourage: bool = True
+    ) -> scanner.FetchedUser:
+        """async scanner.fetch_user"""
+
+        async def no_ids() -> set[int]:
+            return set()
+
+        friends, followers, timeline, favorites = await asyncio.gather(
+            self.fetch_ids("friends_ids", raw_user.id) if entourage else no_ids(),
+            self.fetch_ids("followers_ids", raw_user.id) if entourage else no_ids(),
+            self.call(
+                "user_timeline",
+                screen_name=raw_user.screen_name,
+                count=config["MAX_TWEETS"],
+                since_id=since_id,
+                include_rts=True,
+                tweet_mode="extended",
+            ),
+            self.call("favorites", raw_user.screen_name),
+        )
+        return scanner.FetchedUser(
+            friends=friends,
+            followers=followers,
+            timeline=timeline,
+            favorites=favorites,
+        )
+
+    async def scan(
+        self, user_id: None | int = None, screen_name: None | str = None
+    ) -> TwitscanUser:
+        """async scanner.scan"""
+        maybe_user = (
+            scanner.check_user_id(user_id)
+            if user_id
+            else scanner.check_user_name(screen_name)
+        )
+        if maybe_user is not None:
+            return maybe_user
+        raw_user: User = (
+            await self.call("get_user", screen_name=screen_name)
+            if screen_name
+            else await self.call("get_user", user_id=user_id)
+        )
+        if raw_user.protected:
+            raise UserProtectedError(f"User {raw_user.screen_name} is protected")
+        _, fetched = await asyncio.gather(
+            self.stream_entourage(raw_user.id), self.fetch(raw_user, entourage=False)
+        )
+        existing = scanner.check_user_id(raw_user.id)  # scanned meanwhile
+        if existing is not None:
+            return existing
+        return self.ingestor.save_user(raw_user, fetched)
+
+    async def rescan(self, user_id: int) -> TwitscanUser:
+        """async ingest.rescan"""
+        stored = scanner.check_user_id(user_id)
+        if stored is None:
+            return await self.scan(user_id=user_id)
+        raw_user: User = await self.call("get_user", user_id=user_id)
+        if raw_user.protected:
+            raise UserProtectedError(f"User {raw_user.screen_name} is protected")
+        fetched = await self.fetch(raw_user, scanner.latest_status_id(user_id))
+        return self.ingestor.refresh_user(raw_user, fetched)
+
+    async def scan_many(
+        self,
+        user_ids: Iterable[int],
+        on_done: Callable[[int, TwitscanUser | None], None] | None = None,
+        refresh: bool = False,
+    ) -> dict[int, TwitscanUser | None]:
+        """
+        scans users with at most `concurrency` scans in flight, already stored users
+        are rescanned incrementally when refresh is set,
+        protected users and users failing after retries map to None
+        """
+        results: dict[int, TwitscanUser | None] = {}
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def one(user_id: int) -> None:
+            async with semaphore:
+                user: TwitscanUser | None = None
+                try:
+                    user = await (
+                        self.rescan(user_id) if refresh else self.scan(user_id=user_id)
+                    )
+                except UserProtectedError:
+                    logging.debug(f"User {user_id} is protected")
+                except TweepError as err:
+                    logging.debug(f"Got tweepy error scanning {user_id}\n\t{err}")
+                results[user_id] = user
+                if on_done is not None:
+                    on_done(user_id, user)
+
+        await asyncio.gather(*(one(uid) for uid in user_ids))
+        return results
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+def scan_many(
+    user_ids: Iterable[int],
+    concurrency: int = 8,
+    on_done: Callable[[int, TwitscanUser | None], None] | None = None,
+    refresh: bool = False,
+    api_factory: Callable[[], tweepy.API] = default_api,
+    pool: CredentialPool | None = None,
+) -> dict[int, TwitscanUser | None]:
+    """blocking entry point for scripts"""
+    engine = AsyncScanner(concurrency=concurrency, api_factory=api_factory, pool=pool)
+    try:
+        return asyncio.run(engine.scan_many(user_ids, on_done, refresh))
+    finally:
+        engine.close()
@@ -0,0 +1,283 @@
+"""
+Bounded cache of per-user derived features, invalidated when a user is rescanned,
+with an optional on-disk tier shared by successive runs and checked against the
+feature versions the writers bump
+"""
+
+from __future__ import annotations
+
+import logging
+import pickle
+import sqlite3
+from collections import OrderedDict
+from sys import getsizeof
+from typing import Iterable, NamedTuple, TypedDict
+
+import numpy as np
+
+from twitscan import scanner, session
+from twitscan.models import (
+    Entourage,
+    FeatureVersion,
+    HashtagName,
+    TargetInteractions,
+    TargetMentions,
+    UserAggregate,
+    UserHashtag,
+)
+
+CACHE_PATH = "data/features.db"
+BUDGET = 64 * 2**20  # bytes
+CHUNK = 500  # ids per IN clause, below sqlite's bound parameters limit
+
+
+class UserFeatures(TypedDict):
+    entourage: np.ndarray  # sorted friend and follower ids
+    hashtags: frozenset[str]
+    mentions: dict[int, int]  # mentioned user id -> mentions
+    mentions_total: int
+    interactions: dict[int, tuple[int, int, int]]  # author id -> favs, rts, comments
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    disk_hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+    entries: int
+    size: int  # estimated bytes held in memory
+
+
+def _empty() -> UserFeatures:
+    return UserFeatures(
+        entourage=np.zeros(0, dtype=np.int64),
+        hashtags=frozenset(),
+        mentions={},
+        mentions_total=0,
+        interactions={},
+    )
+
+
+def _chunks(ids: list[int]) -> Iterable[list[int]]:
+    for start in range(0, len(ids), CHUNK):
+        yield ids[start : start + CHUNK]
+
+
+def compute_features(user_ids: Iterable[int]) -> dict[int, UserFeatures]:
+    """features of many users with one query per aggregate table and chunk of ids"""
+    ids = sorted(set(user_ids))
+    computed = {uid: _empty() for uid in ids}
+    entourages: dict[int, list[int]] = {uid: [] for uid in ids}
+    hashtags: dict[int, set[str]] = {uid: set() for uid in ids}
+    for chunk in _chunks(ids):
+        for uid, ff in session.query(
+            Entourage.user_id, Entourage.friend_follower_id
+        ).filter(Entourage.user_id.in_(chunk)):
+            entourages[uid].append(ff)
+        for uid, name in (
+            session.query(UserHashtag.user_id, HashtagName.name)
+            .join(
+                HashtagName, HashtagName.hashtag_dict_id == UserHashtag.hashtag_dict_id
+            )
+            .filter(UserHashtag.user_id.in_(chunk))
+        ):
+            hashtags[uid].add(name)
+        for uid, mentioned, count in session.query(
+            TargetMentions.user_id, TargetMentions.target_id, TargetMentions.mentions
+        ).filter(TargetMentions.user_id.in_(chunk)):
+            computed[uid]["mentions"][mentioned] = count
+        for uid, total in session.query(
+            UserAggregate.user_id, UserAggregate.mentions
+        ).filter(UserAggregate.user_id.in_(chunk)):
+            computed[uid]["mentions_total"] = total
+        for uid, author, favs, rts, cmts in session.query(
+            TargetInteractions.user_id,
+            TargetInteractions.author_id,
+            TargetInteractions.favs,
+            TargetInteractions.retweets,
+            TargetInteractions.comments,
+        ).filter(TargetInteractions.user_id.in_(chunk)):
+            computed[uid]["interactions"][author] = (favs, rts, cmts)
+    for uid in ids:
+        computed[uid]["entourage"] = np.unique(
+            np.array(entourages[uid], dtype=np.int64)
+        )
+        computed[uid]["hashtags"] = frozenset(hashtags[uid])
+    return computed
+
+
+def fingerprints(user_ids: Iterable[int]) -> dict[int, str]:
+    """
+    feature versions of the users, bumped by every save changing what the features
+    are derived from, a disk entry written before a save by any process no longer matches
+    """
+    ids = sorted(set(user_ids))
+    versions = {uid: 0 for uid in ids}
+    for chunk in _chunks(ids):
+        versions.update(
+            session.query(FeatureVersion.user_id, FeatureVersion.version).filter(
+                FeatureVersion.user_id.in_(chunk)
+            )
+        )
+    return {uid: str(version) for uid, version in versions.items()}
+
+
+def estimate_size(features: UserFeatures) -> int:
+    """approximate bytes held by a features record"""
+    size = getsizeof(features) + features["entourage"].nbytes
+    size += getsizeof(features["hashtags"])
+    size += sum(getsizeof(tag) for tag in features["hashtags"])
+    size += getsizeof(features["mentions"]) + 64 * len(features["mentions"])
+    size += getsizeof(features["interactions"]) + 200 * len(features["interactions"])
+    return size
+
+
+class DiskTier:
+    """pickled features in a sqlite file next to the database"""
+
+    def __init__(self, path: str = CACHE_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS features "
+            "(user_id INTEGER PRIMARY KEY, fingerprint TEXT NOT NULL, data BLOB NOT NULL)"
+        )
+        self.connection.commit()
+
+    def get_many(self, stamps: dict[int, str]) -> dict[int, UserFeatures]:
+        found: dict[int, UserFeatures] = {}
+        for chunk in _chunks(list(stamps)):
+            rows = self.connection.execute(
+                "SELECT user_id, fingerprint, data FROM features "
+                f"WHERE user_id IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            for uid, fingerprint, data in rows:
+                if stamps[uid] == fingerprint:
+                    found[uid] = pickle.loads(data)
+        return found
+
+    def put_many(self, records: dict[int, tuple[str, UserFeatures]]) -> None:
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO features VALUES (?, ?, ?)",
+            [
+                (uid, fingerprint, pickle.dumps(features, pickle.HIGHEST_PROTOCOL))
+                for uid, (fingerprint, features) in records.items()
+            ],
+        )
+        self.connection.commit()
+
+    def delete(self, user_id: int) -> None:
+        self.connection.execute("DELETE FROM features WHERE user_id = ?", (user_id,))
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class FeatureCache:
+    """
+    least recently used features kept under a memory budget,
+    entries are dropped from both tiers when scanner reports the user changed
+    """
+
+    def __init__(self, budget: int = BUDGET, path: str | None = None):
+        self.budget = budget
+        self.disk = DiskTier(path) if path is not None else None
+        self.size = 0
+        self.hits = self.disk_hits = self.misses = 0
+        self.evictions = self.invalidations = 0
+        self._entries: OrderedDict[int, tuple[UserFeatures, int]] = OrderedDict()
+        scanner.invalidation_hooks.append(self.invalidate)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: int) -> UserFeatures:
+        return self.get_many([user_id])[user_id]
+
+    def get_many(self, user_ids: Iterable[int]) -> dict[int, UserFeatures]:
+        found: dict[int, UserFeatures] = {}
+        missing: list[int] = []
+        for uid in dict.fromkeys(user_ids):
+            entry = self._entries.get(uid)
+            if entry is None:
+                missing.append(uid)
+                continue
+            self._entries.move_to_end(uid)
+            found[uid] = entry[0]
+            self.hits += 1
+        if not missing:
+            return found
+
+        stamps = fingerprints(missing) if self.disk is not None else {}
+        if self.disk is not None:
+            stored = self.disk.get_many(stamps)
+            self.disk_hits += len(stored)
+            found.update(stored)
+            for uid, features in stored.items():
+                self._put(uid, features)
+            missing = [uid for uid in missing if uid not in stored]
+        self.misses += len(missing)
+        computed = compute_features(missing)
+        found.update(computed)
+        for uid, features in computed.items():
+            self._put(uid, features)
+        if self.disk is not None and computed:
+            self.disk.put_many(
+                {uid: (stamps[uid], features) for uid, features in computed.items()}
+            )
+        return found
+
+    def _put(self, user_id: int, features: UserFeatures) -> None:
+        self._drop(user_id)
+        size = estimate_size(features)
+        self._entries[user_id] = (features, size)
+        self.size += size
+        while self.size > self.budget and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, user_id: int) -> bool:
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return False
+        self.size -= entry[1]
+        return True
+
+    def invalidate(self, user_id: int) -> None:
+        if self._drop(user_id):
+            self.invalidations += 1
+        if self.disk is not None:
+            self.disk.delete(user_id)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            self.hits,
+            self.disk_hits,
+            self.misses,
+            self.evictions,
+            self.invalidations,
+            len(self._entries),
+            self.size,
+        )
+
+    def close(self) -> None:
+        if self.invalidate in scanner.invalidation_hooks:
+            scanner.invalidation_hooks.remove(self.invalidate)
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+        logging.debug(f"feature cache closed with {self.stats()}")
+
+
+features_cache = FeatureCache()
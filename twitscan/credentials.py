@@ -0,0 +1,236 @@
+"""
+Pool of twitter app/user credentials, each call goes to the key with the most calls
+left on its endpoint so that the rate limits of every key add up
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Iterable, NamedTuple
+
+import tweepy
+from tweepy import RateLimitError
+
+from twitscan import telemetry
+from twitscan.aioscan import ENDPOINTS, TokenBucket
+
+CREDENTIALS_PATH = "data/credentials.json"
+CREDENTIALS_ENV = "TWITSCAN_CREDENTIALS"
+DEFAULT_LIMIT = 15  # calls per window of endpoints missing from ENDPOINTS
+KEY_CALLS = "twitscan_credential_calls_total"
+KEY_PARKED = "twitscan_credential_parked_total"
+KEY_REMAINING = "twitscan_credential_remaining"
+
+
+class Credential(NamedTuple):
+    name: str
+    consumer_key: str
+    consumer_secret: str
+    access_token: str
+    access_token_secret: str
+
+
+def load(path: str) -> list[Credential]:
+    """
+    credentials from a json list of objects with the fields of Credential,
+    the name defaults to the position of the key in the list
+    """
+    with open(path) as file:
+        entries = json.load(file)
+    credentials = [
+        Credential(
+            name=str(entry.get("name", number)),
+            consumer_key=entry["consumer_key"],
+            consumer_secret=entry["consumer_secret"],
+            access_token=entry["access_token"],
+            access_token_secret=entry["access_token_secret"],
+        )
+        for number, entry in enumerate(entries)
+    ]
+    names = [credential.name for credential in credentials]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicated credential names in {path}: {names}")
+    return credentials
+
+
+def key_api(credential: Credential) -> tweepy.API:
+    """api of one key, rate limits are waited out by the pool"""
+    auth = tweepy.OAuthHandler(credential.consumer_key, credential.consumer_secret)
+    auth.set_access_token(credential.access_token, credential.access_token_secret)
+    return tweepy.API(auth, compression=True)
+
+
+class ApiKey:
+    """one credential and the remaining calls of each endpoint it has called"""
+
+    def __init__(self, credential: Credential):
+        self.credential = credential
+        self.name = credential.name
+        self.buckets: dict[str, TokenBucket] = {}
+        self.calls = 0
+        self.parked = 0
+
+    def bucket(self, method: str) -> TokenBucket:
+        bucket = self.buckets.get(method)
+        if bucket is None:
+            endpoint, limit = ENDPOINTS.get(method, (method, DEFAULT_LIMIT))
+            bucket = self.buckets[method] = TokenBucket(endpoint, limit)
+        return bucket
+
+
+class CredentialPool:
+    """
+    keys sharing the calls of the scanners: a call takes one call of the key with
+    the most headroom on its endpoint, a key rate limited on an endpoint is parked
+    there until the window resets, and a call waits only once every key is parked
+    """
+
+    def __init__(
+        self,
+        credentials: Iterable[Credential],
+        api_factory: Callable[[Credential], tweepy.API] = key_api,
+    ):
+        self.keys = [ApiKey(credential) for credential in credentials]
+        if not self.keys:
+            raise ValueError("A credential pool needs at least one credential")
+        self.api_factory = api_factory
+        self._lock = threading.Lock()
+        self._local = threading.local()  # tweepy apis are not shared between threads
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+        api_factory: Callable[[Credential], tweepy.API] = key_api,
+    ) -> CredentialPool:
+        return cls(load(path), api_factory)
+
+    def _api(self, key: ApiKey) -> Any:
+        apis: dict[str, Any] | None = getattr(self._local, "apis", None)
+        if apis is None:
+            apis = self._local.apis = {}
+        api = apis.get(key.name)
+        if api is None:
+            api = apis[key.name] = telemetry.instrument(
+                self.api_factory(key.credential)
+            )
+        return api
+
+    def reserve(self, method: str) -> tuple[ApiKey | None, float]:
+        """
+        takes one call of the key with the most headroom on the method's endpoint,
+        or returns no key and the seconds until the first parked key resets
+        """
+        with self._lock:
+            key = max(self.keys, key=lambda other: other.bucket(method).headroom())
+            if key.bucket(method).take():
+                reset_at = min(other.bucket(method).reset_at for other in self.keys)
+                return None, reset_at - time.time() + 1
+            key.calls += 1
+        telemetry.registry.inc(KEY_CALLS, key=key.name, endpoint=method)
+        return key, 0.0
+
+    def execute(self, key: ApiKey, method: str, args: Any, kwargs: Any) -> Any:
+        """
+        one call with a reserved key, its budget is corrected from the response
+        headers and the key is parked on the endpoint when it is rate limited
+        """
+        api = self._api(key)
+        try:
+            result = getattr(api, method)(*args, **kwargs)
+        except RateLimitError as err:
+            headers = getattr(getattr(err, "response", None), "headers", None)
+            with self._lock:
+                bucket = key.bucket(method)
+                bucket.exhaust(headers)
+                key.parked += 1
+            logging.info(
+                f"Parked key {key.name} on {method} for "
+                f"{bucket.reset_at - time.time():.0f}s"
+            )
+            telemetry.registry.inc(KEY_PARKED, key=key.name, endpoint=method)
+            telemetry.registry.set(KEY_REMAINING, 0, key=key.name, endpoint=method)
+            raise
+        self._local.last_response = getattr(api, "last_response", None)
+        headers = getattr(self._local.last_response, "headers", None)
+        with self._lock:
+            bucket = key.bucket(method)
+            bucket.update(headers)
+            remaining = bucket.remaining
+        telemetry.registry.set(KEY_REMAINING, remaining, key=key.name, endpoint=method)
+        return result
+
+    def call(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        """blocking call, waiting when every key is parked on the endpoint"""
+        while True:
+            key, delay = self.reserve(method)
+            if key is None:
+                logging.warning(
+                    f"Every key is rate limited on {method}, sleeping for {delay:.0f}s"
+                )
+                with telemetry.registry.timer(
+                    telemetry.RATE_LIMIT_WAITS, endpoint=method
+                ):
+                    time.sleep(delay)
+                continue
+            try:
+                return self.execute(key, method, args, kwargs)
+            except RateLimitError:
+                continue
+
+    def api(self) -> PooledAPI:
+        return PooledAPI(self)
+
+    def last_response(self) -> Any:
+        """response of the last call of this thread, whichever key made it"""
+        return getattr(self._local, "last_response", None)
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """calls, parkings and the remaining calls per endpoint of every key"""
+        with self._lock:
+            return {
+                key.name: {
+                    "calls": key.calls,
+                    "parked": key.parked,
+                    "remaining": {
+                        method: bucket.headroom()
+                        for method, bucket in sorted(key.buckets.items())
+                    },
+                }
+                for key in self.keys
+            }
+
+
+class PooledAPI:
+    """tweepy.API stand-in sending every call through a credential pool"""
+
+    instrumented = True  # the api of each key is
+
+    def __init__(self, pool: CredentialPool):
+        self.pool = pool
+
+    @property
+    def last_response(self) -> Any:
+        return self.pool.last_response()
+
+    def __getattr__(self, method: str) -> Callable[..., Any]:
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.pool.call(method, *args, **kwargs)
+
+
+def default_pool() -> CredentialPool | None:
+    """pool of the credentials file, if there is one, else None"""
+    path = os.environ.get(CREDENTIALS_ENV, CREDENTIALS_PATH)
+    if not os.path.exists(path):
+        return None
+    pool = CredentialPool.load(path)
+    logging.info(f"Loaded {len(pool)} credentials from {path}")
+    return pool
@@ -0,0 +1,235 @@
+"""
+Sparse user x account adjacency index built from the friend table, rows are reloaded
+when the feature version of their user moves
+"""
+
+from __future__ import annotations
+
+from os.path import exists
+from typing import Iterable, NamedTuple
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import func
+
+from twitscan import session
+from twitscan.models import Entourage, FeatureVersion
+
+INDEX_PATH = "data/entourage.npz"
+
+
+class EntourageScores(NamedTuple):
+    intersection: np.ndarray
+    jaccard: np.ndarray
+    overlap: np.ndarray
+    common: np.ndarray  # intersection / (|a| + |b|), as in query.proximity
+
+
+def _divide(num: np.ndarray, den: np.ndarray) -> np.ndarray:
+    num = np.asarray(num, dtype=np.float64)
+    ratio: np.ndarray = np.divide(num, den, out=np.zeros_like(num), where=den != 0)
+    return ratio
+
+
+class EntourageIndex:
+    """
+    rows are scanned users sorted by id, columns are every account seen in an entourage;
+    an entry is 1 when the account is a friend or a follower of the row's user,
+    versions are the feature versions of the users when their row was loaded
+    """
+
+    def __init__(
+        self,
+        user_ids: np.ndarray,
+        account_ids: np.ndarray,
+        matrix: sparse.csr_matrix,
+        versions: np.ndarray | None = None,
+    ):
+        self.user_ids = user_ids
+        self.account_ids = account_ids
+        self.matrix = matrix
+        # unknown versions never match, those rows are reloaded by the next update
+        self.versions = (
+            versions
+            if versions is not None
+            else np.full(len(user_ids), -1, dtype=np.int64)
+        )
+        self.sizes = np.asarray(matrix.getnnz(axis=1), dtype=np.float64)
+
+    @classmethod
+    def empty(cls) -> EntourageIndex:
+        ids = np.zeros(0, dtype=np.int64)
+        return cls(ids, ids, sparse.csr_matrix((0, 0), dtype=np.uint8))
+
+    @classmethod
+    def build(cls) -> EntourageIndex:
+        """loads the whole friend table"""
+        return cls.empty().update()
+
+    @classmethod
+    def load(cls, path: str = INDEX_PATH) -> EntourageIndex:
+        with np.load(path) as npz:
+            shape = tuple(npz["shape"])
+            matrix = sparse.csr_matrix(
+                (npz["data"], npz["indices"], npz["indptr"]), shape=shape
+            )
+            versions = npz["versions"] if "versions" in npz.files else None
+            return cls(npz["user_ids"], npz["account_ids"], matrix, versions)
+
+    def save(self, path: str = INDEX_PATH) -> None:
+        np.savez_compressed(
+            path,
+            data=self.matrix.data,
+            indices=self.matrix.indices,
+            indptr=self.matrix.indptr,
+            shape=np.array(self.matrix.shape),
+            user_ids=self.user_ids,
+            account_ids=self.account_ids,
+            versions=self.versions,
+        )
+
+    def update(self, user_ids: Iterable[int] | None = None) -> EntourageIndex:
+        """
+        (re)loads the entourage of the given users, or of every user missing from the index
+        or whose feature version moved since their row was loaded, returns the updated index
+        """
+        if user_ids is None:
+            # read before the edges, rows of a save committed in between reload next time
+            current: dict[int, int] = dict(
+                session.query(
+                    Entourage.user_id, func.coalesce(FeatureVersion.version, 0)
+                )
+                .outerjoin(FeatureVersion, FeatureVersion.user_id == Entourage.user_id)
+                .distinct()
+                .all()
+            )
+            indexed = dict(zip(self.user_ids.tolist(), self.versions.tolist()))
+            wanted = np.array(
+                sorted(
+                    uid
+                    for uid, version in current.items()
+                    if indexed.get(uid) != version
+                ),
+                dtype=np.int64,
+            )
+            # users whose whole entourage is gone leave the index
+            dropped = np.setdiff1d(self.user_ids, np.fromiter(current, dtype=np.int64))
+        else:
+            wanted = np.unique(np.fromiter(user_ids, dtype=np.int64))
+            current = {uid: 0 for uid in wanted.tolist()}
+            current.update(
+                session.query(FeatureVersion.user_id, FeatureVersion.version)
+                .filter(FeatureVersion.user_id.in_(wanted.tolist()))
+                .all()
+            )
+            dropped = np.zeros(0, dtype=np.int64)
+        if len(wanted) == 0 and len(dropped) == 0:
+            return self
+
+        edges = (
+            session.query(Entourage.user_id, Entourage.friend_follower_id)
+            .filter(Entourage.user_id.in_(wanted.tolist()))
+            .all()
+        )
+        edge_users = np.array([e[0] for e in edges], dtype=np.int64)
+        edge_accounts = np.array([e[1] for e in edges], dtype=np.int64)
+
+        # merge column vocabularies, then remap the existing columns onto it
+        account_ids = np.union1d(self.account_ids, edge_accounts)
+        kept = ~np.isin(self.user_ids, np.union1d(wanted, dropped))
+        old = self.matrix[np.flatnonzero(kept)].tocoo()
+        old_users = self.user_ids[kept]
+
+        user_ids_ = np.union1d(old_users, wanted)
+        rows = np.concatenate(
+            (
+                np.searchsorted(user_ids_, old_users[old.row]),
+                np.searchsorted(user_ids_, edge_users),
+            )
+        )
+        cols = np.concatenate(
+            (
+                np.searchsorted(account_ids, self.account_ids[old.col]),
+                np.searchsorted(account_ids, edge_accounts),
+            )
+        )
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.uint8), (rows, cols)),
+            shape=(len(user_ids_), len(account_ids)),
+        )
+        matrix.data[:] = 1  # duplicated friend rows were summed
+        versions = np.zeros(len(user_ids_), dtype=np.int64)
+        versions[np.searchsorted(user_ids_, old_users)] = self.versions[kept]
+        versions[np.searchsorted(user_ids_, wanted)] = [
+            current[uid] for uid in wanted.tolist()
+        ]
+        return EntourageIndex(user_ids_, account_ids, matrix, versions)
+
+    def rows(self, user_ids: Iterable[int]) -> tuple[np.ndarray, np.ndarray]:
+        """row positions of the given users and a mask of those present in the index"""
+        ids = np.fromiter(user_ids, dtype=np.int64)
+        if len(self.user_ids) == 0:
+            return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.user_ids, ids), len(self.user_ids) - 1)
+        return pos, self.user_ids[pos] == ids
+
+    def scores(self, user_id: int, other_ids: Iterable[int]) -> EntourageScores:
+        """common entourage scores between one user and each of the other users"""
+        others = np.fromiter(other_ids, dtype=np.int64)
+        inter = np.zeros(len(others))
+        size_b = np.zeros(len(others))
+        (row_a,), (found_a,) = self.rows([user_id])
+        pos, found = self.rows(others)
+        size_b[found] = self.sizes[pos[found]]
+        size_a = self.sizes[row_a] if found_a else 0.0
+        if found_a and found.any():
+            a = self.matrix[row_a].T.astype(np.int32)
+            inter[found] = (
+                (self.matrix[pos[found]].astype(np.int32) @ a).toarray().ravel()
+            )
+        return EntourageScores(
+            intersection=inter,
+            jaccard=_divide(inter, size_a + size_b - inter),
+            overlap=_divide(inter, np.minimum(size_a, size_b)),
+            common=_divide(inter, size_a + size_b),
+        )
+
+    def pairwise(
+        self, user_ids: Iterable[int] | None = None
+    ) -> tuple[np.ndarray, sparse.csr_matrix, sparse.csr_matrix, sparse.csr_matrix]:
+        """
+        all pairs intersections, jaccard and overlap as sparse matrices,
+        only pairs sharing at least one account are stored
+        """
+        if user_ids is None:
+            ids, sub, sizes = self.user_ids, self.matrix, self.sizes
+        else:
+            pos, found = self.rows(user_ids)
+            pos = pos[found]
+            ids, sub, sizes = self.user_ids[pos], self.matrix[pos], self.sizes[pos]
+        sub = sub.astype(np.int32)
+        inter = (sub @ sub.T).tocoo()
+        a, b = sizes[inter.row], sizes[inter.col]
+        shape = inter.shape
+
+        def like(values: np.ndarray) -> sparse.csr_matrix:
+            return sparse.csr_matrix((values, (inter.row, inter.col)), shape=shape)
+
+        return (
+            ids,
+            inter.tocsr(),
+            like(_divide(inter.data, a + b - inter.data)),
+            like(_divide(inter.data, np.minimum(a, b))),
+        )
+
+
+def load_or_build(path: str = INDEX_PATH) -> EntourageIndex:
+    """
+    loads the persisted index, adds newly scanned users to it, reloads the users saved
+    since and saves it back
+    """
+    index = EntourageIndex.load(path) if exists(path) else EntourageIndex.empty()
+    updated = index.update()
+    if updated is not index or not exists(path):
+        updated.save(path)
+    return updated
@@ -0,0 +1,486 @@
+"""
+Offline stand-in for the twitter v1.1 endpoints used by the scanners, answering from
+a deterministic synthetic social graph with simulated latency and rate limits
+"""
+
+from __future__ import annotations
+
+import math
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, NamedTuple
+
+import numpy as np
+from tweepy import RateLimitError, TweepError
+from tweepy.models import ResultSet, Status, User
+from tweepy.parsers import ModelParser
+
+from twitscan.aioscan import ENDPOINTS, WINDOW
+
+# api method -> endpoint and its limit per window (user auth)
+LIMITS: dict[str, tuple[str, int]] = {
+    **ENDPOINTS,
+    "lookup_users": ("/users/lookup", 900),
+}
+IDS_PAGE = 5000  # ids per friends/ids and followers/ids page
+LOOKUP_SIZE = 100  # users per users/lookup call
+MAX_COUNT = 200  # statuses per timeline or favorites page
+EPOCH = datetime(2015, 1, 1)
+TIME_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"
+DOMAINS = ("example.com", "news.example.org", "blog.example.net", "Video.Example.com")
+
+
+class SyntheticGraph:
+    """
+    users 1..n following each other with a popularity skew, and their tweets;
+    everything derives from the seed, two graphs built with the same arguments are equal
+    """
+
+    def __init__(
+        self,
+        users: int = 1000,
+        friends: int = 100,
+        statuses: int = 50,
+        favorites: int = 20,
+        hashtags: int = 500,
+        protected: float = 0.02,
+        seed: int = 0,
+    ):
+        self.users = users
+        self.statuses = statuses
+        self.favorites = favorites
+        self.hashtags = hashtags
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        counts = np.minimum(rng.poisson(friends, users), users - 1)
+        src = np.repeat(np.arange(1, users + 1, dtype=np.int64), counts)
+        # squaring the uniform draw makes low ids the popular accounts
+        dst = 1 + (users * rng.random(len(src)) ** 2).astype(np.int64)
+        edges = np.unique((src * (users + 1) + dst)[src != dst])
+        follower, followed = edges // (users + 1), edges % (users + 1)
+        order = np.argsort(followed, kind="stable")
+        self._friends = followed  # grouped by follower
+        self._followers = follower[order]  # grouped by followed user
+        bounds = np.arange(users + 2)
+        self._friend_ptr = np.searchsorted(follower, bounds)
+        self._follower_ptr = np.searchsorted(followed[order], bounds)
+        self._protected = rng.random(users + 1) < protected
+
+    def __contains__(self, user_id: int) -> bool:
+        return 1 <= user_id <= self.users
+
+    def friends(self, user_id: int) -> np.ndarray:
+        return self._friends[self._friend_ptr[user_id] : self._friend_ptr[user_id + 1]]
+
+    def followers(self, user_id: int) -> np.ndarray:
+        return self._followers[
+            self._follower_ptr[user_id] : self._follower_ptr[user_id + 1]
+        ]
+
+    def edges(self) -> tuple[np.ndarray, np.ndarray]:
+        """follower and followed user ids of every follow, grouped by follower"""
+        follower = np.repeat(
+            np.arange(self.users + 1, dtype=np.int64), np.diff(self._friend_ptr)
+        )
+        return follower, self._friends
+
+    def random_friends(
+        self, user_ids: np.ndarray, rng: np.random.Generator
+    ) -> np.ndarray:
+        """one random friend of each user, 0 for users following nobody"""
+        if len(self._friends) == 0:
+            return np.zeros(len(user_ids), dtype=np.int64)
+        start = self._friend_ptr[user_ids]
+        count = self._friend_ptr[user_ids + 1] - start
+        picked = start + (rng.random(len(user_ids)) * count).astype(np.int64)
+        return np.where(
+            count > 0, self._friends[np.minimum(picked, len(self._friends) - 1)], 0
+        )
+
+    def is_protected(self, user_id: int) -> bool:
+        return bool(self._protected[user_id])
+
+    def user_id(self, screen_name: str) -> int | None:
+        if not screen_name.startswith("user") or not screen_name[4:].isdigit():
+            return None
+        user_id = int(screen_name[4:])
+        return user_id if user_id in self else None
+
+    def post(self, count: int = 1) -> None:
+        """every user tweets count more times, for incremental rescans"""
+        self.statuses += count
+
+    def status_id(self, user_id: int, number: int) -> int:
+        """ids grow with the tweet number, so newer tweets have greater ids"""
+        return (number + 1) * (self.users + 1) + user_id
+
+    def author(self, status_id: int) -> tuple[int, int]:
+        return status_id % (self.users + 1), status_id // (self.users + 1) - 1
+
+    def user_json(self, user_id: int) -> dict[str, Any]:
+        return {
+            "id": user_id,
+            "id_str": str(user_id),
+            "screen_name": f"user{user_id}",
+            "name": f"User {user_id}",
+            "created_at": (EPOCH - timedelta(days=user_id % 3000)).strftime(
+                TIME_FORMAT
+            ),
+            "verified": user_id % 97 == 0,
+            "protected": self.is_protected(user_id),
+            "followers_count": len(self.followers(user_id)),
+            "friends_count": len(self.friends(user_id)),
+            "statuses_count": self.statuses,
+            "favourites_count": self.favorites,
+            "profile_image_url": f"http://pbs.twimg.com/profile_images/{user_id}/photo_normal.jpg",
+        }
+
+    def _tweet_of_friend(
+        self, user_id: int, newest: int, rng: random.Random
+    ) -> int | None:
+        """a tweet of a random friend, numbered at most newest"""
+        friends = self.friends(user_id)
+        if len(friends) == 0:
+            return None
+        friend = int(friends[rng.randrange(len(friends))])
+        return self.status_id(friend, rng.randrange(newest + 1))
+
+    def status_json(self, status_id: int, plain: bool = False) -> dict[str, Any]:
+        """
+        v1.1 extended status, replies and retweets point at tweets of friends,
+        a plain status is neither
+        """
+        user_id, number = self.author(status_id)
+        rng = random.Random(f"{self.seed}:{status_id}")
+        friends = self.friends(user_id)
+        status: dict[str, Any] = {
+            "id": status_id,
+            "id_str": str(status_id),
+            "created_at": (
+                EPOCH + timedelta(hours=number, minutes=user_id % 60)
+            ).strftime(TIME_FORMAT),
+            "user": self.user_json(user_id),
+            "favorite_count": int(rng.paretovariate(1.5)) - 1,
+            "retweet_count": int(rng.paretovariate(2.0)) - 1,
+            "in_reply_to_status_id": None,
+            "in_reply_to_user_id": None,
+            "lang": "en",
+        }
+        roll = rng.random()
+        original = None if plain else self._tweet_of_friend(user_id, number, rng)
+        if original is not None and roll < 0.15:
+            retweeted = self.status_json(original, plain=True)
+            status["retweeted_status"] = retweeted
+            status["full_text"] = (
+                f"RT @{retweeted['user']['screen_name']}: {retweeted['full_text']}"
+            )
+            status["entities"] = retweeted["entities"]
+            return status
+        if original is not None and roll < 0.3:
+            status["in_reply_to_status_id"] = original
+            status["in_reply_to_user_id"] = self.author(original)[0]
+        tags = sorted(
+            {
+                f"Tag{int(self.hashtags * rng.random() ** 3)}"
+                for _ in range(rng.choice((0, 0, 1, 1, 2, 3)))
+            }
+        )
+        mentioned = [
+            int(friends[rng.randrange(len(friends))])
+            for _ in range(rng.choice((0, 0, 0, 1, 2)) if len(friends) else 0)
+        ]
+        urls = (
+            [f"https://{rng.choice(DOMAINS)}/{rng.randrange(10**6)}"]
+            if rng.random() < 0.2
+            else []
+        )
+        status["full_text"] = " ".join(
+            [f"@user{uid}" for uid in mentioned]
+            + [f"tweet {number} of user {user_id}"]
+            + [f"#{tag}" for tag in tags]
+            + urls
+        )
+        status["entities"] = {
+            "hashtags": [{"text": tag} for tag in tags],
+            "user_mentions": [
+                {"id": uid, "id_str": str(uid), "screen_name": f"user{uid}"}
+                for uid in mentioned
+            ],
+            "urls": [{"url": url, "expanded_url": url} for url in urls],
+        }
+        return status
+
+    def timeline(self, user_id: int) -> list[int]:
+        """status ids of the user, newest first"""
+        return [
+            self.status_id(user_id, number)
+            for number in range(self.statuses - 1, -1, -1)
+        ]
+
+    def liked(self, user_id: int) -> list[int]:
+        """status ids of friends' tweets the user liked, newest first"""
+        rng = random.Random(f"{self.seed}:favorites:{user_id}")
+        liked = {
+            self._tweet_of_friend(user_id, self.statuses - 1, rng)
+            for _ in range(self.favorites)
+        }
+        return sorted((sid for sid in liked if sid is not None), reverse=True)
+
+
+class FakeResponse(NamedTuple):
+    status_code: int
+    headers: dict[str, str]
+    text: str = ""
+
+
+class FakeTwitter:
+    """
+    the service side: rate limit windows shared by every api object it hands out,
+    call counters, latency and injected server errors
+    """
+
+    def __init__(
+        self,
+        graph: SyntheticGraph,
+        latency: float = 0.0,
+        window: float = WINDOW,
+        limits: dict[str, tuple[str, int]] = LIMITS,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.graph = graph
+        self.latency = latency
+        self.window = window
+        self.limits = limits
+        self.error_rate = error_rate
+        self.calls: Counter[str] = Counter()
+        self.rate_limited: Counter[str] = Counter()
+        self.errors: Counter[str] = Counter()
+        self._windows: dict[str, tuple[float, int]] = {}  # method -> reset, calls
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def api(self, wait_on_rate_limit: bool = False) -> FakeAPI:
+        """an api object, usable as an api_factory of the context or AsyncScanner"""
+        return FakeAPI(self, wait_on_rate_limit)
+
+    def admit(self, method: str) -> FakeResponse:
+        """counts the call in its window, a 429 once the window is used up"""
+        _, limit = self.limits[method]
+        with self._lock:
+            now = time.time()
+            reset, calls = self._windows.get(method, (now + self.window, 0))
+            if now >= reset:
+                reset, calls = now + self.window, 0
+            status = 200
+            if calls >= limit:
+                status = 429
+                self.rate_limited[method] += 1
+            else:
+                calls += 1
+                self.calls[method] += 1
+                if self.error_rate and self._random.random() < self.error_rate:
+                    status = 503
+                    self.errors[method] += 1
+            self._windows[method] = (reset, calls)
+        headers = {
+            "x-rate-limit-limit": str(limit),
+            "x-rate-limit-remaining": str(limit - calls),
+            "x-rate-limit-reset": str(math.ceil(reset)),
+        }
+        return FakeResponse(status, headers)
+
+    def delay(self) -> None:
+        if self.latency > 0:
+            time.sleep(self.latency * self._random.uniform(0.5, 1.5))
+
+
+class FakeAPI:
+    """
+    answers the tweepy.API calls of the scanners with tweepy models parsed from v1.1 json,
+    failures raise the tweepy errors the real api raises with a response and its headers
+    """
+
+    def __init__(self, service: FakeTwitter, wait_on_rate_limit: bool = False):
+        self.service = service
+        self.graph = service.graph
+        self.wait_on_rate_limit = wait_on_rate_limit
+        self.parser = ModelParser()
+        self.last_response: FakeResponse | None = None
+
+    def _request(self, method: str) -> None:
+        while True:
+            response = self.service.admit(method)
+            self.service.delay()
+            self.last_response = response
+            if response.status_code == 429:
+                if self.wait_on_rate_limit:
+                    reset = float(response.headers["x-rate-limit-reset"])
+                    time.sleep(max(0.0, reset - time.time()))
+                    continue
+                raise RateLimitError("Rate limit exceeded", response, 88)
+            if response.status_code >= 500:
+                raise TweepError("Over capacity", response, 130)
+            return
+
+    def _error(self, status_code: int, message: str, code: int) -> TweepError:
+        headers = self.last_response.headers if self.last_response is not None else {}
+        self.last_response = FakeResponse(status_code, headers, message)
+        return TweepError(message, self.last_response, code)
+
+    def _resolve(
+        self,
+        id: int | str | None = None,
+        user_id: int | None = None,
+        screen_name: str | None = None,
+    ) -> int:
+        if id is not None:
+            user_id, screen_name = (
+                (int(id), None) if str(id).isdigit() else (None, str(id))
+            )
+        found = (
+            int(user_id)
+            if user_id is not None
+            else self.graph.user_id(screen_name or "")
+        )
+        if found is None or found not in self.graph:
+            raise self._error(404, "User not found.", 50)
+        return found
+
+    def _readable(self, user_id: int) -> None:
+        if self.graph.is_protected(user_id):
+            raise self._error(401, "Not authorized.", 179)
+
+    def get_user(
+        self,
+        id: int | str | None = None,
+        user_id: int | None = None,
+        screen_name: str | None = None,
+    ) -> User:
+        self._request("get_user")
+        uid = self._resolve(id, user_id, screen_name)
+        return User.parse(self, self.graph.user_json(uid))
+
+    def lookup_users(
+        self,
+        user_ids: list[int] | None = None,
+        screen_names: list[str] | None = None,
+        **_: Any,
+    ) -> ResultSet:
+        self._request("lookup_users")
+        wanted = list(user_ids or []) + [
+            self.graph.user_id(name) for name in screen_names or []
+        ]
+        if len(wanted) > LOOKUP_SIZE:
+            raise self._error(403, "Too many terms specified in query.", 18)
+        found = [
+            uid
+            for uid in dict.fromkeys(wanted)
+            if uid is not None and uid in self.graph
+        ]
+        if not found:
+            raise self._error(404, "No user matches for specified terms.", 17)
+        return User.parse_list(self, [self.graph.user_json(uid) for uid in found])
+
+    def _ids(
+        self,
+        ids: np.ndarray,
+        cursor: int | None,
+        count: int,
+    ) -> list[int] | tuple[list[int], tuple[int, int]]:
+        """a page of ids, with (previous, next) cursors when a cursor was given"""
+        start = 0 if cursor in (None, -1) else int(cursor)
+        end = start + min(count, IDS_PAGE)
+        page: list[int] = ids[start:end].tolist()
+        if cursor is None:
+            return page
+        return page, (-start if start else 0, end if end < len(ids) else 0)
+
+    def friends_ids(
+        self,
+        id: int | str | None = None,
+        user_id: int | None = None,
+        screen_name: str | None = None,
+        cursor: int | None = None,
+        count: int = IDS_PAGE,
+    ) -> list[int] | tuple[list[int], tuple[int, int]]:
+        self._request("friends_ids")
+        uid = self._resolve(id, user_id, screen_name)
+        self._readable(uid)
+        return self._ids(self.graph.friends(uid), cursor, count)
+
+    def followers_ids(
+        self,
+        id: int | str | None = None,
+        user_id: int | None = None,
+        screen_name: str | None = None,
+        cursor: int | None = None,
+        count: int = IDS_PAGE,
+    ) -> list[int] | tuple[list[int], tuple[int, int]]:
+        self._request("followers_ids")
+        uid = self._resolve(id, user_id, screen_name)
+        self._readable(uid)
+        return self._ids(self.graph.followers(uid), cursor, count)
+
+    def _statuses(
+        self,
+        status_ids: list[int],
+        count: int,
+        since_id: int | None,
+        max_id: int | None,
+        tweet_mode: str | None = "extended",
+    ) -> ResultSet:
+        selected = [
+            sid
+            for sid in status_ids
+            if (since_id is None or sid > since_id)
+            and (max_id is None or sid <= max_id)
+        ][: min(count, MAX_COUNT)]
+        statuses = []
+        for sid in selected:
+            status = self.graph.status_json(sid)
+            if tweet_mode != "extended":
+                status["text"] = status.pop("full_text")[:140]
+            statuses.append(status)
+        return Status.parse_list(self, statuses)
+
+    def user_timeline(
+        self,
+        id: int | str | None = None,
+        user_id: int | None = None,
+        screen_name: str | None = None,
+        since_id: int | None = None,
+        max_id: int | None = None,
+        count: int = 20,
+        include_rts: bool = True,
+        tweet_mode: str | None = None,
+        **_: Any,
+    ) -> ResultSet:
+        self._request("user_timeline")
+        uid = self._resolve(id, user_id, screen_name)
+        self._readable(uid)
+        timeline = self.graph.timeline(uid)
+        if not include_rts:
+            timeline = [
+                sid
+                for sid in timeline
+                if "retweeted_status" not in self.graph.status_json(sid)
+            ]
+        return self._statuses(timeline, count, since_id, max_id, tweet_mode)
+
+    def favorites(
+        self,
+        screen_name: str | None = None,
+        user_id: int | None = None,
+        max_id: int | None = None,
+        count: int = 20,
+        since_id: int | None = None,
+        **_: Any,
+    ) -> ResultSet:
+        self._request("favorites")
+        uid = self._resolve(None, user_id, screen_name)
+        self._readable(uid)
+        return self._statuses(self.graph.liked(uid), count, since_id, max_id)
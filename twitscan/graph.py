@@ -0,0 +1,327 @@
+"""
+Directed follow graph of every account seen in the friend table, as one sparse matrix,
+with pagerank, components, communities and k-hop reach stored in the graph_metric table
+"""
+
+from __future__ import annotations
+
+import logging
+import time
+from datetime import datetime
+from typing import Iterable, NamedTuple
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from sqlalchemy.engine.base import Engine
+
+from twitscan import context, session
+from twitscan.models import GraphMetric
+
+FETCH_SIZE = 2**20  # friend rows per fetch while loading
+DAMPING = 0.85
+HOPS = 2
+REACH_CELLS = 2**24  # bound of the accounts x users reached by a batch
+CHUNK = 500  # ids per IN clause, below sqlite's bound parameters limit
+
+
+class GraphMetrics(NamedTuple):
+    ids: np.ndarray  # account ids, sorted
+    in_degree: np.ndarray
+    out_degree: np.ndarray
+    pagerank: np.ndarray
+    component: np.ndarray  # weakly connected component, numbered by decreasing size
+    community: np.ndarray
+    reach: np.ndarray  # accounts within `hops` follows of a scanned user, -1 otherwise
+
+
+def _renumber_by_size(labels: np.ndarray) -> np.ndarray:
+    """label 0 is the largest group, 1 the next one..."""
+    _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    rank = np.empty(len(counts), dtype=np.int64)
+    rank[np.argsort(-counts, kind="stable")] = np.arange(len(counts))
+    return rank[inverse]
+
+
+class FollowGraph:
+    """
+    rows and columns are accounts sorted by id,
+    an entry (i, j) is 1 when account i follows account j
+    """
+
+    def __init__(self, ids: np.ndarray, matrix: sparse.csr_matrix):
+        self.ids = ids
+        self.matrix = matrix
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def edges(self) -> int:
+        return int(self.matrix.nnz)
+
+    @classmethod
+    def from_edges(cls, follower: np.ndarray, followed: np.ndarray) -> FollowGraph:
+        ids = np.union1d(follower, followed)
+        rows, cols = np.searchsorted(ids, follower), np.searchsorted(ids, followed)
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(len(ids), len(ids)),
+        )
+        matrix.data[:] = 1  # a relation stored from both of its ends was summed
+        return cls(ids, matrix)
+
+    @classmethod
+    def build(cls, bind: Engine | None = None) -> FollowGraph:
+        """loads the whole friend table, a row is an edge in each direction it flags"""
+        bind = bind if bind is not None else context.engine
+        followers: list[np.ndarray] = []
+        followed: list[np.ndarray] = []
+        connection = bind.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT user_id, friend_follower_id, friend, follower FROM friend"
+            )
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                user, other, friend, follower = np.array(rows, dtype=np.int64).T
+                friend, follower = friend.astype(bool), follower.astype(bool)
+                followers += [user[friend], other[follower]]
+                followed += [other[friend], user[follower]]
+        finally:
+            connection.close()
+        if not followers:
+            empty = np.zeros(0, dtype=np.int64)
+            return cls.from_edges(empty, empty)
+        return cls.from_edges(np.concatenate(followers), np.concatenate(followed))
+
+    def positions(self, user_ids: Iterable[int]) -> tuple[np.ndarray, np.ndarray]:
+        """positions of the given accounts and a mask of those present in the graph"""
+        ids = np.fromiter(user_ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return pos, self.ids[pos] == ids
+
+    def in_degree(self) -> np.ndarray:
+        return np.bincount(self.matrix.indices, minlength=len(self))
+
+    def out_degree(self) -> np.ndarray:
+        return np.diff(self.matrix.indptr)
+
+    def pagerank(
+        self, damping: float = DAMPING, tol: float = 1e-9, max_iter: int = 100
+    ) -> np.ndarray:
+        """
+        power iteration where an account passes its rank to the accounts it follows,
+        the rank of accounts following nobody is spread over every account
+        """
+        n = len(self)
+        if n == 0:
+            return np.zeros(0)
+        out = self.out_degree().astype(np.float64)
+        dangling = out == 0
+        inverse = np.divide(1.0, out, out=np.zeros(n), where=~dangling)
+        transposed = self.matrix.T.tocsr()
+        rank = np.full(n, 1.0 / n)
+        for iteration in range(max_iter):
+            spread = damping * (transposed @ (rank * inverse))
+            spread += (1.0 - damping + damping * rank[dangling].sum()) / n
+            delta = np.abs(spread - rank).sum()
+            rank = spread
+            if delta < tol * n:
+                break
+        logging.info(f"Pagerank converged after {iteration + 1} iterations")
+        return rank
+
+    def components(self) -> np.ndarray:
+        """weakly connected components"""
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        _, labels = connected_components(self.matrix, directed=True, connection="weak")
+        return _renumber_by_size(labels)
+
+    def undirected(self) -> sparse.csr_matrix:
+        """1 for accounts following each other in either direction"""
+        both = (self.matrix + self.matrix.T).tocsr()
+        both.data[:] = 1
+        both.setdiag(0)
+        both.eliminate_zeros()
+        return both
+
+    def communities(
+        self, max_iter: int = 30, tol: float = 1e-3, seed: int = 0
+    ) -> np.ndarray:
+        """
+        label propagation on the undirected graph: every account takes the label
+        most frequent among its neighbours, ties broken at random; half of the
+        accounts move at each step so that bipartite parts do not oscillate
+        """
+        n = len(self)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        rng = np.random.default_rng(seed)
+        adjacency = self.undirected()
+        rows = np.repeat(np.arange(n), np.diff(adjacency.indptr))
+        labels = np.arange(n)
+        for iteration in range(max_iter):
+            # neighbour label counts of each account, summed per (account, label)
+            votes = sparse.csr_matrix(
+                (adjacency.data, (rows, labels[adjacency.indices])), shape=(n, n)
+            )
+            votes.sum_duplicates()
+            counts = np.diff(votes.indptr)
+            has = counts > 0
+            noisy = votes.data + rng.random(len(votes.data)) * 0.5
+            best = np.maximum.reduceat(noisy, votes.indptr[:-1][has])
+            winner = noisy == np.repeat(best, counts[has])
+            chosen = np.full(n, -1)
+            chosen[np.repeat(np.arange(n), counts)[winner]] = votes.indices[winner]
+            moving = has & (rng.random(n) < 0.5) & (chosen != labels)
+            labels[moving] = chosen[moving]
+            if moving.sum() < tol * n:
+                break
+        logging.info(f"Label propagation stopped after {iteration + 1} iterations")
+        return _renumber_by_size(labels)
+
+    def modularity(self, labels: np.ndarray) -> float:
+        """newman modularity of a partition of the undirected graph"""
+        adjacency = self.undirected()
+        degree = np.diff(adjacency.indptr).astype(np.float64)
+        total = degree.sum()
+        if total == 0:
+            return 0.0
+        coo = adjacency.tocoo()
+        inside = np.bincount(
+            labels[coo.row][labels[coo.row] == labels[coo.col]],
+            minlength=labels.max() + 1,
+        )
+        volume = np.bincount(labels, weights=degree, minlength=labels.max() + 1)
+        return float((inside / total - (volume / total) ** 2).sum())
+
+    def reach(self, user_ids: Iterable[int], hops: int = HOPS) -> np.ndarray:
+        """
+        number of accounts following each user within the given hops,
+        followers of followers for 2; the frontiers of a batch of users
+        are advanced together by one sparse product per hop
+        """
+        pos, found = self.positions(user_ids)
+        reached = np.full(len(pos), -1, dtype=np.int64)
+        seeds = np.flatnonzero(found)
+        followed_by = self.matrix.T.tocsr()  # row j lists the followers of j
+        batch = max(1, REACH_CELLS // max(len(self), 1))
+        for start in range(0, len(seeds), batch):
+            chunk = seeds[start : start + batch]
+            # one row per user, of the accounts reached so far
+            visited = sparse.csr_matrix(
+                (
+                    np.ones(len(chunk), dtype=np.float32),
+                    (np.arange(len(chunk)), pos[chunk]),
+                ),
+                shape=(len(chunk), len(self)),
+            )
+            frontier = visited
+            for _ in range(hops):
+                following = frontier @ followed_by
+                frontier = (following - following.multiply(visited)).tocsr()
+                frontier.eliminate_zeros()
+                if frontier.nnz == 0:
+                    break
+                frontier.data[:] = 1
+                visited = visited + frontier
+            reached[chunk] = visited.getnnz(axis=1) - 1
+        return reached
+
+    def metrics(
+        self, scanned: Iterable[int] | None = None, hops: int = HOPS
+    ) -> GraphMetrics:
+        """every metric of every account, reach only for the scanned users"""
+        started = time.time()
+        pagerank = self.pagerank()
+        component = self.components()
+        community = self.communities()
+        logging.info(
+            f"Found {component.max(initial=-1) + 1} components "
+            f"and {community.max(initial=-1) + 1} communities "
+            f"(modularity {self.modularity(community):.3f}) "
+            f"in {time.time() - started:.1f}s"
+        )
+        started = time.time()
+        reach = np.full(len(self), -1, dtype=np.int64)
+        if scanned is not None:
+            pos, found = self.positions(scanned)
+            reach[pos[found]] = self.reach(self.ids[pos[found]], hops)
+            logging.info(
+                f"Computed the {hops}-hop reach of {found.sum()} users "
+                f"in {time.time() - started:.1f}s"
+            )
+        return GraphMetrics(
+            ids=self.ids,
+            in_degree=self.in_degree(),
+            out_degree=self.out_degree(),
+            pagerank=pagerank,
+            component=component,
+            community=community,
+            reach=reach,
+        )
+
+
+def save(metrics: GraphMetrics, bind: Engine | None = None) -> int:
+    """replaces the content of graph_metric in one transaction, returns the rows written"""
+    bind = bind if bind is not None else context.engine
+    computed_at = datetime.utcnow().isoformat(sep=" ")
+    connection = bind.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM graph_metric")
+        cursor.executemany(
+            "INSERT INTO graph_metric (user_id, in_degree, out_degree, pagerank, "
+            "component, community, reach, computed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            zip(
+                metrics.ids.tolist(),
+                metrics.in_degree.tolist(),
+                metrics.out_degree.tolist(),
+                metrics.pagerank.tolist(),
+                metrics.component.tolist(),
+                metrics.community.tolist(),
+                [None if r < 0 else r for r in metrics.reach.tolist()],
+                [computed_at] * len(metrics.ids),
+            ),
+        )
+        connection.commit()
+    finally:
+        connection.close()
+    return len(metrics.ids)
+
+
+def refresh(hops: int = HOPS, bind: Engine | None = None) -> GraphMetrics:
+    """computes the metrics of the whole friend table and stores them"""
+    bind = bind if bind is not None else context.engine
+    started = time.time()
+    graph = FollowGraph.build(bind)
+    logging.info(
+        f"Loaded {len(graph)} accounts and {graph.edges} follows "
+        f"in {time.time() - started:.1f}s"
+    )
+    with bind.connect() as conn:
+        scanned = [user_id for (user_id,) in conn.execute("SELECT user_id FROM user")]
+    metrics = graph.metrics(scanned, hops)
+    started = time.time()
+    written = save(metrics, bind)
+    logging.info(f"Stored {written} graph metrics in {time.time() - started:.1f}s")
+    return metrics
+
+
+def graph_metrics(user_ids: Iterable[int]) -> dict[int, GraphMetric]:
+    """stored metrics of the given accounts, by id"""
+    ids = list(dict.fromkeys(user_ids))
+    found: dict[int, GraphMetric] = {}
+    for start in range(0, len(ids), CHUNK):
+        for metric in session.query(GraphMetric).filter(
+            GraphMetric.user_id.in_(ids[start : start + CHUNK])
+        ):
+            found[metric.user_id] = metric
+    return found
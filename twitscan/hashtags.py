@@ -0,0 +1,327 @@
+"""
+Hashtag inverted index, per user hashtag sets and MinHash/LSH similarity search
+"""
+
+from __future__ import annotations
+
+from argparse import ArgumentParser
+from os.path import exists
+from typing import Any, Iterable
+from zlib import crc32
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import func, text
+
+from twitscan import query, session
+from twitscan.models import FeatureVersion, Hashtag, HashtagName, TwitscanStatus
+from twitscan.scanner import canonical_hashtag
+
+INDEX_PATH = "data/hashtags.npz"
+PERMUTATIONS = 64
+BANDS = 16  # PERMUTATIONS / BANDS rows per band, candidates from jaccard ~0.5 upwards
+CHUNK = 100_000  # hashtag uses hashed at once when signing
+EMPTY = np.iinfo(np.uint64).max
+
+_rng = np.random.default_rng(0x7A9)
+_A = _rng.integers(1, 2**63, PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+_B = _rng.integers(0, 2**63, PERMUTATIONS, dtype=np.uint64)
+_MIX = _rng.integers(1, 2**63, PERMUTATIONS // BANDS, dtype=np.uint64) | np.uint64(1)
+
+
+def _hash_tags(tags: np.ndarray) -> np.ndarray:
+    return np.array([crc32(tag.encode()) for tag in tags], dtype=np.uint64)
+
+
+def minhash(user_tags: sparse.csr_matrix, tag_hashes: np.ndarray) -> np.ndarray:
+    """one signature row per user, users without hashtags are left at EMPTY"""
+    signatures = np.full((user_tags.shape[0], PERMUTATIONS), EMPTY, dtype=np.uint64)
+    indptr = user_tags.indptr
+    rows = np.flatnonzero(np.diff(indptr))
+    start = 0
+    while start < len(rows):
+        # grow the chunk of users until it covers about CHUNK hashtag uses
+        stop = np.searchsorted(indptr[rows + 1], indptr[rows[start]] + CHUNK, "right")
+        stop = max(stop, start + 1)
+        chunk = rows[start:stop]
+        lo, hi = indptr[chunk[0]], indptr[chunk[-1] + 1]
+        x = tag_hashes[user_tags.indices[lo:hi]]
+        with np.errstate(over="ignore"):
+            hashed = (x[:, None] * _A[None, :] + _B[None, :]) >> np.uint64(32)
+        signatures[chunk] = np.minimum.reduceat(hashed, indptr[chunk] - lo, axis=0)
+        start = stop
+    return signatures
+
+
+def fingerprint() -> np.ndarray:
+    """
+    status hashtag rows, their greatest rowid and the sum of the feature versions,
+    which grows with every save as the writers bump the versions of the authors it touched
+    """
+    rows, last = session.execute(
+        text(f"SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM {Hashtag.__tablename__}")
+    ).fetchone()
+    versions = session.query(func.coalesce(func.sum(FeatureVersion.version), 0))
+    return np.array([rows, last, versions.scalar()], dtype=np.int64)
+
+
+def _band_keys(signatures: np.ndarray) -> np.ndarray:
+    """(BANDS, users) bucket keys"""
+    width = PERMUTATIONS // BANDS
+    bands = signatures.reshape(len(signatures), BANDS, width)
+    with np.errstate(over="ignore"):
+        keys: np.ndarray = (bands * _MIX[None, None, :]).sum(axis=2, dtype=np.uint64)
+    return keys.T
+
+
+class HashtagIndex:
+    """
+    user_tags is a users x hashtags count matrix, status_tags a statuses x hashtags one,
+    rows follow user_ids / status_ids and columns follow tags, all sorted,
+    the fingerprint is that of the database the index was built from
+    """
+
+    def __init__(
+        self,
+        tags: np.ndarray,
+        user_ids: np.ndarray,
+        status_ids: np.ndarray,
+        user_tags: sparse.csr_matrix,
+        status_tags: sparse.csr_matrix,
+        signatures: np.ndarray | None = None,
+        fingerprint: np.ndarray | None = None,
+    ):
+        self.fingerprint = fingerprint
+        self.tags = tags
+        self.user_ids = user_ids
+        self.status_ids = status_ids
+        self.user_tags = user_tags
+        self.status_tags = status_tags
+        self.tag_users = user_tags.tocsc()
+        self.tag_statuses = status_tags.tocsc()
+        self.sizes = np.asarray(user_tags.getnnz(axis=1), dtype=np.float64)
+        self.signatures = (
+            signatures
+            if signatures is not None
+            else minhash(user_tags, _hash_tags(tags))
+        )
+        self.band_keys = _band_keys(self.signatures)
+        self.band_order = np.argsort(self.band_keys, axis=1, kind="stable")
+        self.sorted_keys = np.take_along_axis(self.band_keys, self.band_order, axis=1)
+
+    @classmethod
+    def build(cls) -> HashtagIndex:
+        built_from = (
+            fingerprint()
+        )  # before the read, a save in between rebuilds next time
+        uses = (
+            session.query(HashtagName.name, Hashtag.status_id, TwitscanStatus.user_id)
+            .select_from(Hashtag)
+            .join(HashtagName, HashtagName.hashtag_dict_id == Hashtag.hashtag_dict_id)
+            .join(TwitscanStatus, TwitscanStatus.status_id == Hashtag.status_id)
+            .all()
+        )
+        names = np.array([use[0] for use in uses], dtype=str)
+        statuses = np.array([use[1] for use in uses], dtype=np.int64)
+        users = np.array([use[2] for use in uses], dtype=np.int64)
+        tags, tag_col = np.unique(names, return_inverse=True)
+        status_ids, status_row = np.unique(statuses, return_inverse=True)
+        user_ids, user_row = np.unique(users, return_inverse=True)
+        ones = np.ones(len(uses), dtype=np.int32)
+        user_tags = sparse.csr_matrix(
+            (ones, (user_row, tag_col)), shape=(len(user_ids), len(tags))
+        )
+        status_tags = sparse.csr_matrix(
+            (ones, (status_row, tag_col)), shape=(len(status_ids), len(tags))
+        )
+        return cls(tags, user_ids, status_ids, user_tags, status_tags, None, built_from)
+
+    @classmethod
+    def load(cls, path: str = INDEX_PATH) -> HashtagIndex:
+        with np.load(path) as npz:
+
+            def csr(name: str) -> sparse.csr_matrix:
+                return sparse.csr_matrix(
+                    (
+                        npz[f"{name}_data"],
+                        npz[f"{name}_indices"],
+                        npz[f"{name}_indptr"],
+                    ),
+                    shape=tuple(npz[f"{name}_shape"]),
+                )
+
+            return cls(
+                npz["tags"],
+                npz["user_ids"],
+                npz["status_ids"],
+                csr("user_tags"),
+                csr("status_tags"),
+                npz["signatures"],
+                npz["fingerprint"] if "fingerprint" in npz.files else None,
+            )
+
+    def save(self, path: str = INDEX_PATH) -> None:
+        arrays: dict[str, Any] = {}
+        if self.fingerprint is not None:
+            arrays["fingerprint"] = self.fingerprint
+        for name in ("user_tags", "status_tags"):
+            matrix: sparse.csr_matrix = getattr(self, name)
+            arrays[f"{name}_data"] = matrix.data
+            arrays[f"{name}_indices"] = matrix.indices
+            arrays[f"{name}_indptr"] = matrix.indptr
+            arrays[f"{name}_shape"] = np.array(matrix.shape)
+        np.savez_compressed(
+            path,
+            tags=self.tags,
+            user_ids=self.user_ids,
+            status_ids=self.status_ids,
+            signatures=self.signatures,
+            **arrays,
+        )
+
+    def _tag(self, hashtag: str) -> int | None:
+        hashtag = canonical_hashtag(hashtag)
+        pos = int(np.searchsorted(self.tags, hashtag))
+        if pos < len(self.tags) and self.tags[pos] == hashtag:
+            return pos
+        return None
+
+    def _rows(self, user_ids: Iterable[int]) -> tuple[np.ndarray, np.ndarray]:
+        ids = np.fromiter(user_ids, dtype=np.int64)
+        if len(self.user_ids) == 0:
+            return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.user_ids, ids), len(self.user_ids) - 1)
+        return pos, self.user_ids[pos] == ids
+
+    def statuses(self, hashtag: str) -> np.ndarray:
+        """ids of the statuses using the hashtag"""
+        col = self._tag(hashtag)
+        if col is None:
+            return np.zeros(0, dtype=np.int64)
+        start, end = self.tag_statuses.indptr[col : col + 2]
+        return np.sort(self.status_ids[self.tag_statuses.indices[start:end]])
+
+    def users(self, hashtag: str) -> np.ndarray:
+        """ids of the users who tweeted the hashtag"""
+        col = self._tag(hashtag)
+        if col is None:
+            return np.zeros(0, dtype=np.int64)
+        start, end = self.tag_users.indptr[col : col + 2]
+        return np.sort(self.user_ids[self.tag_users.indices[start:end]])
+
+    def hashtags(self, user_id: int) -> set[str]:
+        (row,), (found,) = self._rows([user_id])
+        if not found:
+            return set()
+        start, end = self.user_tags.indptr[row : row + 2]
+        return set(self.tags[self.user_tags.indices[start:end]].tolist())
+
+    def common_hashtags(self, user_id: int, other_ids: Iterable[int]) -> np.ndarray:
+        """exact |a & b| / (|a| + |b|) of query.proximity, one per other user"""
+        others = np.fromiter(other_ids, dtype=np.int64)
+        inter, total = np.zeros(len(others)), np.zeros(len(others))
+        (row,), (found_a,) = self._rows([user_id])
+        pos, found = self._rows(others)
+        total[found] = self.sizes[pos[found]]
+        if found_a:
+            total += self.sizes[row]
+            a = (self.user_tags[row] > 0).T.astype(np.int32)
+            b = (self.user_tags[pos[found]] > 0).astype(np.int32)
+            inter[found] = (b @ a).toarray().ravel()
+        return np.divide(inter, total, out=np.zeros_like(inter), where=total != 0)
+
+    def estimate_jaccard(self, user_id: int, other_ids: Iterable[int]) -> np.ndarray:
+        """MinHash estimate of the jaccard similarity of hashtag sets"""
+        others = np.fromiter(other_ids, dtype=np.int64)
+        estimate = np.zeros(len(others))
+        (row,), (found_a,) = self._rows([user_id])
+        pos, found = self._rows(others)
+        if not found_a or self.sizes[row] == 0:
+            return estimate
+        equal = self.signatures[pos[found]] == self.signatures[row][None, :]
+        estimate[found] = equal.mean(axis=1)
+        estimate[found & (self.sizes[pos] == 0)] = 0.0
+        return estimate
+
+    def approx_common_hashtags(
+        self, user_id: int, other_ids: Iterable[int]
+    ) -> np.ndarray:
+        """common_hashtags derived from the jaccard estimate, as |a & b| / (|a| + |b|) = J / (1 + J)"""
+        jaccard = self.estimate_jaccard(user_id, other_ids)
+        result: np.ndarray = jaccard / (1 + jaccard)
+        return result
+
+    def candidates(self, user_id: int) -> np.ndarray:
+        """ids of the users sharing at least one LSH bucket with the user"""
+        (row,), (found,) = self._rows([user_id])
+        if not found or self.sizes[row] == 0:
+            return np.zeros(0, dtype=np.int64)
+        rows: list[np.ndarray] = []
+        for band in range(BANDS):
+            key = self.band_keys[band, row]
+            keys = self.sorted_keys[band]
+            start = np.searchsorted(keys, key, "left")
+            end = np.searchsorted(keys, key, "right")
+            rows.append(self.band_order[band, start:end])
+        found_rows = np.unique(np.concatenate(rows))
+        found_rows = found_rows[(found_rows != row) & (self.sizes[found_rows] > 0)]
+        candidates: np.ndarray = self.user_ids[found_rows]
+        return candidates
+
+    def similar(
+        self, user_id: int, threshold: float = 0.0, limit: int | None = None
+    ) -> list[tuple[int, float]]:
+        """users with similar hashtag usage and their estimated jaccard, most similar first"""
+        ids = self.candidates(user_id)
+        estimate = self.estimate_jaccard(user_id, ids)
+        order = np.argsort(-estimate, kind="stable")
+        ranked = [
+            (int(ids[i]), float(estimate[i])) for i in order if estimate[i] >= threshold
+        ]
+        return ranked[:limit] if limit is not None else ranked
+
+
+def load_or_build(path: str = INDEX_PATH) -> HashtagIndex:
+    """loads the persisted index, rebuilds and saves it when statuses were saved since"""
+    if exists(path):
+        index = HashtagIndex.load(path)
+        if index.fingerprint is not None and np.array_equal(
+            index.fingerprint, fingerprint()
+        ):
+            return index
+    index = HashtagIndex.build()
+    index.save(path)
+    return index
+
+
+def main() -> None:
+    parser = ArgumentParser(
+        description="users with a hashtag usage similar to a user's"
+    )
+    parser.add_argument("screen_name")
+    parser.add_argument(
+        "-k", "--limit", type=int, default=10, help="most similar users printed"
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=0.0,
+        help="lowest estimated jaccard similarity of the hashtag sets",
+    )
+    args = parser.parse_args()
+    user = query.user_by_screen_name(args.screen_name)
+    if user is None:
+        exit(f"Did not find {args.screen_name} in the database")
+    index = load_or_build()
+    similar = index.similar(user.user_id, args.threshold, args.limit)
+    common = index.approx_common_hashtags(user.user_id, [uid for uid, _ in similar])
+    print("user\tjaccard\tcommon_hashtags")
+    for (user_id, jaccard), ratio in zip(similar, common.tolist()):
+        other = query.user_by_id(user_id)  # authors of favorites may not be scanned
+        name = other.screen_name if other is not None else user_id
+        print(f"{name}\t{jaccard:.3f}\t{ratio:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,494 @@
+"""
+Profile pictures of main users and their followers, downloaded by a pool of async workers
+sharing one connection pool, revalidated with conditional requests against a local manifest
+and kept once per distinct content in a store exported through hardlinks
+"""
+
+from __future__ import annotations
+
+import asyncio
+import errno
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import time
+from typing import Any, AsyncIterator, Iterable, NamedTuple
+from urllib.parse import urlencode
+from uuid import uuid4
+
+import aiohttp
+from sqlalchemy.orm import aliased
+
+from twitscan import session
+from twitscan.aioscan import backoff_delay
+from twitscan.models import Entourage, TwitscanUser
+
+STORE_DIR = "imgs/store"
+MANIFEST_PATH = "imgs/manifest.db"
+PROFILES_DIR = "imgs/profiles"  # pictures by screen name of earlier downloads
+# api key of the scraperapi proxy, requests go direct without it
+PROXY_ENV = "scraperapi_proxy"
+CONCURRENCY = 8
+MAX_ATTEMPTS = 4
+CHUNK_SIZE = 64 * 2**10
+CHUNK = 500  # ids per IN clause, below sqlite's bound parameters limit
+TIMEOUT = 60  # seconds per download
+RETRIED = {429, 500, 502, 503, 504}
+
+
+class Avatar(NamedTuple):
+    user_id: int
+    screen_name: str
+    url: str
+
+
+class ManifestEntry(NamedTuple):
+    user_id: int
+    screen_name: str
+    url: str
+    digest: str  # name of the picture's blob in the store
+    etag: str | None
+    last_modified: str | None
+    fetched_at: float
+
+
+class FetchStats(NamedTuple):
+    downloaded: int
+    unchanged: int  # answered 304 not modified
+    skipped: int  # same url as the stored picture, not requested
+    failed: int
+
+
+def avatar_url(picture_url: str) -> str:
+    """the 400x400 version of the picture, the api gives the 48x48 one"""
+    return picture_url.replace("_normal", "_400x400")
+
+
+def avatars(screen_names: Iterable[str]) -> list[Avatar]:
+    """main users and their followers having a picture, in a single query"""
+    names = list(dict.fromkeys(screen_names))
+    main = aliased(TwitscanUser)
+    followers = (
+        session.query(
+            TwitscanUser.user_id,
+            TwitscanUser.screen_name,
+            TwitscanUser.user_picture_url,
+        )
+        .join(Entourage, Entourage.friend_follower_id == TwitscanUser.user_id)
+        .join(main, main.user_id == Entourage.user_id)
+        .filter(main.screen_name.in_(names), Entourage.follower)
+    )
+    mains = (
+        session.query(
+            TwitscanUser.user_id,
+            TwitscanUser.screen_name,
+            TwitscanUser.user_picture_url,
+        )
+        .filter(TwitscanUser.screen_name.in_(names))
+        .all()
+    )
+    for name in set(names) - {screen_name for _, screen_name, _ in mains}:
+        logging.warning(f"{name} is not in database")
+    found = {
+        user_id: Avatar(user_id, screen_name, avatar_url(url))
+        for user_id, screen_name, url in [*mains, *followers]
+        if url
+    }
+    return list(found.values())
+
+
+class ImageStore:
+    """
+    content-addressed pictures: each distinct file is stored once under its sha256,
+    so the default avatar shared by thousands of users takes the space of one
+    """
+
+    def __init__(self, directory: str = STORE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def __contains__(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def _partial(self) -> str:
+        return os.path.join(self.directory, f"{uuid4().hex}.tmp")
+
+    def _commit(self, partial: str, digest: str) -> str:
+        """moves a complete temporary file to its blob, unless the blob already exists"""
+        if digest in self:
+            os.remove(partial)
+        else:
+            os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+            os.replace(partial, self.path(digest))
+        return digest
+
+    async def put_stream(self, chunks: AsyncIterator[bytes]) -> str:
+        """writes the chunks to disk while hashing them, returns the digest"""
+        partial = self._partial()
+        sha = hashlib.sha256()
+        try:
+            with open(partial, "wb") as file:
+                async for chunk in chunks:
+                    sha.update(chunk)
+                    file.write(chunk)
+            return self._commit(partial, sha.hexdigest())
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+    def put_file(self, path: str) -> str:
+        """adds a copy of a file, which stays where it is"""
+        sha = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        if digest not in self:
+            partial = self._partial()
+            shutil.copyfile(path, partial)
+            self._commit(partial, digest)
+        return digest
+
+    def link(self, digest: str, target: str) -> None:
+        """
+        makes target a hardlink to the blob, replacing what was there;
+        a copy when the target is on another file system
+        """
+        partial = f"{target}.tmp"
+        if os.path.exists(partial):
+            os.remove(partial)
+        try:
+            os.link(self.path(digest), partial)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(self.path(digest), partial)
+        os.replace(partial, target)
+
+    def prune(self, referenced: set[str]) -> int:
+        """
+        removes blobs no manifest entry refers to, returns how many;
+        not to be run while pictures are being downloaded to the store
+        """
+        removed = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name not in referenced:
+                    os.remove(os.path.join(root, name))
+                    removed += 1
+        return removed
+
+
+class Manifest:
+    """picture of each user, with the validators the server sent"""
+
+    def __init__(self, path: str = MANIFEST_PATH, store: ImageStore | None = None):
+        """store: where the pictures of an older avatar table are moved"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS picture (user_id INTEGER PRIMARY KEY, "
+            "screen_name TEXT NOT NULL, url TEXT NOT NULL, digest TEXT NOT NULL, "
+            "etag TEXT, last_modified TEXT, fetched_at REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS ix_picture_screen_name ON picture (screen_name);"
+        )
+        tables = {
+            name
+            for (name,) in self.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        }
+        if "avatar" in tables:
+            self._migrate_avatars(store if store is not None else ImageStore())
+
+    def _migrate_avatars(self, store: ImageStore) -> None:
+        """
+        moves the rows of the avatar table, whose pictures were <screen name>.jpeg files,
+        to the picture table with their validators, rows whose file is gone are dropped
+        and their pictures downloaded again
+        """
+        blobs = [
+            (user_id, os.path.splitext(os.path.basename(path))[0], store.put_file(path))
+            for user_id, path in self.connection.execute(
+                "SELECT user_id, path FROM avatar"
+            ).fetchall()
+            if os.path.exists(path)
+        ]
+        self.connection.execute(
+            "CREATE TEMP TABLE avatar_blob (user_id INTEGER PRIMARY KEY, "
+            "screen_name TEXT NOT NULL, digest TEXT NOT NULL)"
+        )
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO avatar_blob VALUES (?, ?, ?)", blobs
+            )
+            moved = self.connection.execute(
+                "INSERT OR IGNORE INTO picture SELECT a.user_id, b.screen_name, a.url, "
+                "b.digest, a.etag, a.last_modified, a.fetched_at FROM avatar a "
+                "JOIN avatar_blob b ON b.user_id = a.user_id"
+            ).rowcount
+            self.connection.execute("DROP TABLE avatar")
+        self.connection.execute("DROP TABLE avatar_blob")
+        logging.info(f"Moved {moved} pictures of the avatar table to the store")
+
+    def _select(self, where: str, values: list[Any]) -> list[ManifestEntry]:
+        entries: list[ManifestEntry] = []
+        for start in range(0, len(values), CHUNK):
+            chunk = values[start : start + CHUNK]
+            entries += [
+                ManifestEntry(*row)
+                for row in self.connection.execute(
+                    f"SELECT {', '.join(ManifestEntry._fields)} FROM picture "
+                    f"WHERE {where} IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                )
+            ]
+        return entries
+
+    def get(self, user_id: int) -> ManifestEntry | None:
+        entries = self._select("user_id", [user_id])
+        return entries[0] if entries else None
+
+    def by_user_ids(self, user_ids: Iterable[int]) -> dict[int, ManifestEntry]:
+        return {
+            entry.user_id: entry
+            for entry in self._select("user_id", list(dict.fromkeys(user_ids)))
+        }
+
+    def by_screen_names(self, screen_names: Iterable[str]) -> dict[str, ManifestEntry]:
+        """latest picture known under each screen name"""
+        entries = self._select("screen_name", list(dict.fromkeys(screen_names)))
+        return {
+            entry.screen_name: entry
+            for entry in sorted(entries, key=lambda entry: entry.fetched_at)
+        }
+
+    def digests(self) -> set[str]:
+        return {
+            digest
+            for (digest,) in self.connection.execute("SELECT digest FROM picture")
+        }
+
+    def put(self, entry: ManifestEntry) -> None:
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO picture VALUES (?, ?, ?, ?, ?, ?, ?)", entry
+            )
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def _request_url(url: str) -> str:
+    key = os.environ.get(PROXY_ENV)
+    if not key:
+        return url
+    # keep_headers forwards the conditional request headers
+    query = urlencode(dict(api_key=key, url=url, keep_headers="true"))
+    return f"http://api.scraperapi.com?{query}"
+
+
+class ImageFetcher:
+    def __init__(
+        self,
+        store: ImageStore | None = None,
+        manifest: Manifest | None = None,
+        concurrency: int = CONCURRENCY,
+        pause: tuple[float, float] = (0.0, 0.0),
+        refresh: bool = False,
+    ):
+        """
+        pause: seconds range each worker waits before a request,
+        refresh: revalidates pictures whose url did not change as well
+        """
+        self.store = store if store is not None else ImageStore()
+        self.manifest = manifest if manifest is not None else Manifest(store=self.store)
+        self.concurrency = concurrency
+        self.pause = pause
+        self.refresh = refresh
+        self.counts = dict(downloaded=0, unchanged=0, skipped=0, failed=0)
+
+    async def fetch(self, client: aiohttp.ClientSession, avatar: Avatar) -> str:
+        """downloads one picture unless the stored one is current, returns the outcome"""
+        entry = self.manifest.get(avatar.user_id)
+        if entry is not None and (
+            entry.url != avatar.url or entry.digest not in self.store
+        ):
+            entry = None  # new picture or lost blob, downloaded unconditionally
+        if entry is not None and not self.refresh:
+            if entry.screen_name != avatar.screen_name:
+                self.manifest.put(entry._replace(screen_name=avatar.screen_name))
+            return "skipped"
+        headers: dict[str, str] = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        for attempt in range(MAX_ATTEMPTS):
+            if self.pause[1] > 0:
+                await asyncio.sleep(random.uniform(*self.pause))
+            try:
+                async with client.get(
+                    _request_url(avatar.url), headers=headers
+                ) as response:
+                    if response.status == 304 and entry is not None:
+                        self.manifest.put(
+                            entry._replace(
+                                screen_name=avatar.screen_name, fetched_at=time.time()
+                            )
+                        )
+                        return "unchanged"
+                    if response.status == 200:
+                        digest = await self.store.put_stream(
+                            response.content.iter_chunked(CHUNK_SIZE)
+                        )
+                        self.manifest.put(
+                            ManifestEntry(
+                                avatar.user_id,
+                                avatar.screen_name,
+                                avatar.url,
+                                digest,
+                                response.headers.get("ETag"),
+                                response.headers.get("Last-Modified"),
+                                time.time(),
+                            )
+                        )
+                        return "downloaded"
+                    if response.status not in RETRIED:
+                        logging.warning(
+                            f"Picture of {avatar.screen_name} failed with {response.status}"
+                        )
+                        return "failed"
+                    reason = f"status {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                reason = repr(err)
+            delay = backoff_delay(attempt, base=1.0, cap=60.0)
+            logging.info(
+                f"Picture of {avatar.screen_name}: {reason}, retrying in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+        logging.warning(
+            f"Picture of {avatar.screen_name} failed after {MAX_ATTEMPTS} attempts"
+        )
+        return "failed"
+
+    async def _worker(
+        self, client: aiohttp.ClientSession, queue: asyncio.Queue[Avatar]
+    ) -> None:
+        while True:
+            try:
+                avatar = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                self.counts[await self.fetch(client, avatar)] += 1
+            finally:
+                queue.task_done()
+
+    async def run(self, avatars: Iterable[Avatar]) -> FetchStats:
+        queue: asyncio.Queue[Avatar] = asyncio.Queue()
+        for avatar in avatars:
+            queue.put_nowait(avatar)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=TIMEOUT)
+        ) as client:
+            await asyncio.gather(
+                *(self._worker(client, queue) for _ in range(self.concurrency))
+            )
+        return FetchStats(**self.counts)
+
+
+def fetch_avatars(
+    screen_names: Iterable[str],
+    store_dir: str = STORE_DIR,
+    manifest_path: str = MANIFEST_PATH,
+    concurrency: int = CONCURRENCY,
+    pause: tuple[float, float] = (0.0, 0.0),
+    refresh: bool = False,
+) -> FetchStats:
+    """downloads the pictures of the given main users and their followers"""
+    manifest = Manifest(manifest_path)
+    try:
+        fetcher = ImageFetcher(
+            ImageStore(store_dir), manifest, concurrency, pause, refresh
+        )
+        return asyncio.run(fetcher.run(avatars(screen_names)))
+    finally:
+        manifest.close()
+
+
+def adopt(
+    directory: str = PROFILES_DIR,
+    store: ImageStore | None = None,
+    manifest: Manifest | None = None,
+) -> int:
+    """
+    adds the <screen name>.jpeg pictures of earlier downloads to the store,
+    for the users in the database without a manifest entry, returns how many
+    """
+    store = store if store is not None else ImageStore()
+    manifest = manifest if manifest is not None else Manifest(store=store)
+    files = {
+        name[: -len(".jpeg")]: os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(".jpeg")
+    }
+    users: list[tuple[int, str, str | None]] = []
+    names = list(files)
+    for start in range(0, len(names), CHUNK):
+        users += session.query(
+            TwitscanUser.user_id,
+            TwitscanUser.screen_name,
+            TwitscanUser.user_picture_url,
+        ).filter(TwitscanUser.screen_name.in_(names[start : start + CHUNK]))
+    known = manifest.by_user_ids(user_id for user_id, _, _ in users)
+    adopted = 0
+    for user_id, screen_name, url in users:
+        if user_id in known or not url:
+            continue
+        path = files[screen_name]
+        manifest.put(
+            ManifestEntry(
+                user_id,
+                screen_name,
+                avatar_url(url),
+                store.put_file(path),
+                None,
+                None,
+                os.path.getmtime(path),
+            )
+        )
+        adopted += 1
+    return adopted
+
+
+def export(
+    entries: Iterable[ManifestEntry],
+    directory: str,
+    store: ImageStore | None = None,
+) -> int:
+    """
+    a view of pictures named <screen name>.jpeg in directory,
+    hardlinked to the store instead of copied, returns how many
+    """
+    store = store if store is not None else ImageStore()
+    os.makedirs(directory, exist_ok=True)
+    exported = 0
+    for entry in entries:
+        if entry.digest in store:
+            store.link(
+                entry.digest, os.path.join(directory, f"{entry.screen_name}.jpeg")
+            )
+            exported += 1
+    return exported
@@ -0,0 +1,299 @@
+"""
+Bulk ingestion of scanned users: one existence query per page, executemany inserts
+and a single commit per user
+"""
+
+from __future__ import annotations
+
+import logging
+from datetime import datetime
+from typing import Any, Iterable, NamedTuple
+
+from sqlalchemy import bindparam, insert
+from tweepy.models import Status, User
+
+from twitscan import aggregates, api, session
+from twitscan.errors import UserProtectedError
+from twitscan.models import (
+    Entourage,
+    Hashtag,
+    Interaction,
+    Link,
+    Mention,
+    PastEntourage,
+    TwitscanStatus,
+    TwitscanUser,
+)
+from twitscan.scanner import (
+    FetchedUser,
+    check_user_id,
+    check_user_name,
+    entity_values,
+    fetch_user,
+    interaction_values,
+    intern_entities,
+    latest_status_id,
+    scan,
+    status_values,
+    stream_entourage,
+    user_changed,
+    user_values,
+)
+from twitscan.telemetry import phase
+
+CHUNK = 500  # ids per IN clause, below sqlite's bound parameters limit
+
+
+def existing_status_ids(status_ids: Iterable[int]) -> set[int]:
+    ids = list(status_ids)
+    found: set[int] = set()
+    for start in range(0, len(ids), CHUNK):
+        found.update(
+            status_id
+            for (status_id,) in session.query(TwitscanStatus.status_id).filter(
+                TwitscanStatus.status_id.in_(ids[start : start + CHUNK])
+            )
+        )
+    return found
+
+
+def _insert(model: Any, rows: list[dict[str, Any]], ignore: bool = False) -> None:
+    if not rows:
+        return
+    stmt = insert(model.__table__)
+    if ignore:
+        stmt = stmt.prefix_with("OR IGNORE")
+    session.execute(stmt, rows)
+
+
+class EntourageDiff(NamedTuple):
+    added: set[int]
+    removed: set[int]
+    changed: set[int]  # still related, as friend or follower only
+
+
+def diff_entourage(
+    user_id: int, friends: set[int], followers: set[int]
+) -> tuple[EntourageDiff, dict[int, Entourage]]:
+    """compares fresh id lists with the stored entourage, returns the diff and stored rows"""
+    stored: dict[int, Entourage] = {
+        ent.friend_follower_id: ent
+        for ent in session.query(Entourage).filter(Entourage.user_id == user_id)
+    }
+    current = friends | followers
+    changed = {
+        ff
+        for ff in current & stored.keys()
+        if (stored[ff].friend, stored[ff].follower) != (ff in friends, ff in followers)
+    }
+    return (
+        EntourageDiff(current - stored.keys(), stored.keys() - current, changed),
+        stored,
+    )
+
+
+class Ingestor:
+    """
+    saves users like scanner.save_user but with executemany inserts,
+    statuses already ingested during this run are skipped without a query
+    """
+
+    def __init__(self) -> None:
+        self.seen_statuses: set[int] = set()
+        self.authors: set[int] = set()  # of statuses inserted since the last commit
+
+    def save_statuses(self, raw_statuses: Iterable[Status]) -> set[int]:
+        """inserts the statuses missing from the database, returns their ids"""
+        page: dict[int, Status] = {}
+        for raw_status in raw_statuses:
+            if raw_status.id not in self.seen_statuses:
+                page.setdefault(raw_status.id, raw_status)
+        new = set(page) - existing_status_ids(page)
+
+        statuses: list[dict[str, Any]] = []
+        mentions: list[dict[str, Any]] = []
+        urls: list[dict[str, Any]] = []
+        tags: list[dict[str, Any]] = []
+        for status_id in new:
+            raw_status = page[status_id]
+            statuses.append(status_values(raw_status))
+            status_mentions, status_urls, status_tags = entity_values(raw_status)
+            mentions.extend(status_mentions)
+            urls.extend(status_urls)
+            tags.extend(status_tags)
+
+        links, hashtags = intern_entities(urls, tags)
+        _insert(TwitscanStatus, statuses, ignore=True)
+        _insert(Mention, mentions)
+        _insert(Link, links, ignore=True)
+        _insert(Hashtag, hashtags, ignore=True)
+        self.authors.update(row["user_id"] for row in statuses)
+        return set(page)
+
+    def save_user(self, user: User, fetched: FetchedUser | None = None) -> TwitscanUser:
+        """Uses Tweepy User to push user info to db in a single transaction"""
+        if fetched is None:
+            with phase("Ingestor.save_user", "fetch"):
+                stream_entourage(user.id)
+                fetched = fetch_user(user, entourage=False)
+        logging.debug(f"Bulk adding {user.screen_name} to database")
+        friends, followers = fetched["friends"], fetched["followers"]
+        now = datetime.utcnow()
+        try:
+            with phase("Ingestor.save_user", "entourage"):
+                _insert(
+                    TwitscanUser, [user_values(user, fetched["timeline"])], ignore=True
+                )
+                _insert(
+                    Entourage,
+                    [
+                        dict(
+                            user_id=user.id,
+                            friend_follower_id=ff,
+                            friend=ff in friends,
+                            follower=ff in followers,
+                            first_seen=now,
+                        )
+                        for ff in friends | followers
+                    ],
+                    ignore=True,
+                )
+            with phase("Ingestor.save_user", "statuses"):
+                saved = self.save_statuses(fetched["timeline"] + fetched["favorites"])
+            with phase("Ingestor.save_user", "interactions"):
+                _insert(
+                    Interaction,
+                    interaction_values(
+                        user.id, fetched["timeline"], fetched["favorites"]
+                    ),
+                    ignore=True,
+                )
+            with phase("Ingestor.save_user", "aggregates"):
+                aggregates.refresh({user.id} | self.authors)
+            with phase("Ingestor.save_user", "commit"):
+                session.commit()
+        except BaseException:
+            session.rollback()
+            self.authors.clear()
+            raise
+        self.seen_statuses |= saved
+        with phase("Ingestor.save_user", "invalidate"):
+            user_changed(user.id, *self.authors)
+        self.authors.clear()
+
+        full_user: None | TwitscanUser = (
+            session.query(TwitscanUser).filter(TwitscanUser.user_id == user.id).first()
+        )
+        assert (
+            full_user is not None
+        ), "Could not retrieve user from database after saving it"
+        return full_user
+
+    def refresh_user(self, user: User, fetched: FetchedUser) -> TwitscanUser:
+        """
+        brings a stored user up to date in a single transaction: counters are updated in place,
+        only entourage changes are written and departed relations move to friend_history
+        """
+        friends, followers = fetched["friends"], fetched["followers"]
+        now = datetime.utcnow()
+        try:
+            stored_user = check_user_id(user.id)
+            assert stored_user is not None, f"User {user.id} was never scanned"
+            last_seen = stored_user.scanned_at
+            diff, stored = diff_entourage(user.id, friends, followers)
+            logging.debug(
+                f"Refreshing {user.screen_name}: {len(diff.added)} new, "
+                f"{len(diff.removed)} gone and {len(diff.changed)} changed relations"
+            )
+            session.query(TwitscanUser).filter(TwitscanUser.user_id == user.id).update(
+                user_values(user, fetched["timeline"]), synchronize_session=False
+            )
+            _insert(
+                Entourage,
+                [
+                    dict(
+                        user_id=user.id,
+                        friend_follower_id=ff,
+                        friend=ff in friends,
+                        follower=ff in followers,
+                        first_seen=now,
+                    )
+                    for ff in diff.added
+                ],
+                ignore=True,
+            )
+            _insert(
+                PastEntourage,
+                [
+                    dict(
+                        user_id=user.id,
+                        friend_follower_id=ff,
+                        friend=stored[ff].friend,
+                        follower=stored[ff].follower,
+                        first_seen=stored[ff].first_seen,
+                        last_seen=last_seen,
+                    )
+                    for ff in diff.removed
+                ],
+            )
+            gone = [stored[ff].entourage_id for ff in diff.removed]
+            for start in range(0, len(gone), CHUNK):
+                session.query(Entourage).filter(
+                    Entourage.entourage_id.in_(gone[start : start + CHUNK])
+                ).delete(synchronize_session=False)
+            if diff.changed:
+                table = Entourage.__table__
+                session.execute(
+                    table.update()
+                    .where(table.c.entourage_id == bindparam("row_id"))
+                    .values(
+                        friend=bindparam("is_friend"), follower=bindparam("is_follower")
+                    ),
+                    [
+                        dict(
+                            row_id=stored[ff].entourage_id,
+                            is_friend=ff in friends,
+                            is_follower=ff in followers,
+                        )
+                        for ff in diff.changed
+                    ],
+                )
+            saved = self.save_statuses(fetched["timeline"] + fetched["favorites"])
+            _insert(
+                Interaction,
+                interaction_values(user.id, fetched["timeline"], fetched["favorites"]),
+                ignore=True,
+            )
+            aggregates.refresh({user.id} | self.authors)
+            session.commit()
+        except BaseException:
+            session.rollback()
+            self.authors.clear()
+            raise
+        self.seen_statuses |= saved
+        user_changed(user.id, *self.authors)
+        self.authors.clear()
+
+        session.expire_all()
+        full_user = check_user_id(user.id)
+        assert (
+            full_user is not None
+        ), "Could not retrieve user from database after refresh"
+        return full_user
+
+
+def rescan(user_id: None | int = None, screen_name: None | str = None) -> TwitscanUser:
+    """
+    refreshes a stored user with only the tweets newer than the latest stored one
+    and the entourage changes, users not scanned yet get a full scan
+    """
+    stored: None | TwitscanUser = (
+        check_user_id(user_id) if user_id else check_user_name(screen_name)
+    )
+    if stored is None:
+        return scan(user_id=user_id, screen_name=screen_name)
+    raw_user: User = api.get_user(user_id=stored.user_id)
+    if raw_user.protected:
+        raise UserProtectedError(f"User {raw_user.screen_name} is protected")
+    fetched = fetch_user(raw_user, since_id=latest_status_id(raw_user.id))
+    return Ingestor().refresh_user(raw_user, fetched)
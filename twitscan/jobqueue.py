@@ -0,0 +1,316 @@
+"""
+Durable scan queue in the scan_job table, claimed with leases by scan worker processes
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import Iterable
+from uuid import uuid4
+
+from sqlalchemy import func, text
+from tweepy import TweepError
+
+from twitscan import session, telemetry
+from twitscan.aioscan import AsyncScanner, backoff_delay
+from twitscan.errors import UserProtectedError
+from twitscan.models import Entourage, ScanJob, TwitscanUser
+
+PENDING, LEASED, DONE, FAILED, PROTECTED = (
+    "pending",
+    "leased",
+    "done",
+    "failed",
+    "protected",
+)
+LEASE = 30 * 60  # seconds, renewed while the job is in flight
+MAX_ATTEMPTS = 5
+MAX_FOLLOWERS_SCANNED = 1600  # main users with more followers only get their own scan
+CHUNK = 500  # ids per IN clause, below sqlite's bound parameters limit
+
+
+def enqueue(
+    user_ids: Iterable[int] = (),
+    screen_names: Iterable[str] = (),
+    main: bool = False,
+    refresh: bool = False,
+) -> int:
+    """
+    adds jobs for users not queued yet and returns how many were added,
+    users already in the database are marked done unless the jobs refresh them
+    """
+    ids = list(dict.fromkeys(user_ids))
+    rows: list[dict[str, int | str]] = [dict(user_id=uid) for uid in ids]
+    rows += [dict(screen_name=name) for name in dict.fromkeys(screen_names) if name]
+    if not rows:
+        return 0
+    added: int = session.execute(
+        ScanJob.__table__.insert().prefix_with("OR IGNORE"),
+        [
+            dict(
+                user_id=row.get("user_id"),
+                screen_name=row.get("screen_name"),
+                main=main,
+                refresh=refresh,
+                state=PENDING,
+                attempts=0,
+                available_at=0.0,
+            )
+            for row in rows
+        ],
+    ).rowcount
+    if not refresh:
+        for start in range(0, len(ids), CHUNK):
+            session.query(ScanJob).filter(
+                ScanJob.user_id.in_(ids[start : start + CHUNK]),
+                ScanJob.state == PENDING,
+                ScanJob.refresh.is_(False),
+                ScanJob.user_id.in_(session.query(TwitscanUser.user_id)),
+            ).update({ScanJob.state: DONE}, synchronize_session=False)
+    session.commit()
+    return added
+
+
+def requeue_done() -> int:
+    """queues every done job again as a refresh, returns how many"""
+    requeued: int = (
+        session.query(ScanJob)
+        .filter(ScanJob.state == DONE)
+        .update(
+            {
+                ScanJob.state: PENDING,
+                ScanJob.refresh: True,
+                ScanJob.attempts: 0,
+                ScanJob.available_at: 0.0,
+            },
+            synchronize_session=False,
+        )
+    )
+    session.commit()
+    return requeued
+
+
+def claim(
+    worker: str, limit: int = 1, lease: float = LEASE, max_attempts: int = MAX_ATTEMPTS
+) -> list[ScanJob]:
+    """
+    leases up to limit available jobs to the worker in one write transaction,
+    main users first; jobs whose lease expired too many times are failed
+    """
+    now = time.time()
+    token = f"{worker}:{uuid4().hex}"
+    session.execute(
+        text(
+            "UPDATE scan_job SET state = :failed, lease = NULL, "
+            "error = 'lease expired after the last attempt' "
+            "WHERE state = :leased AND available_at <= :now AND attempts >= :max_attempts"
+        ),
+        dict(failed=FAILED, leased=LEASED, now=now, max_attempts=max_attempts),
+    )
+    session.execute(
+        text(
+            "UPDATE scan_job SET state = :leased, lease = :token, "
+            "available_at = :until, attempts = attempts + 1 "
+            "WHERE job_id IN (SELECT job_id FROM scan_job "
+            "WHERE state IN (:pending, :leased) AND available_at <= :now "
+            "ORDER BY main DESC, job_id LIMIT :limit)"
+        ),
+        dict(
+            leased=LEASED,
+            pending=PENDING,
+            token=token,
+            now=now,
+            until=now + lease,
+            limit=limit,
+        ),
+    )
+    session.commit()
+    jobs: list[ScanJob] = session.query(ScanJob).filter(ScanJob.lease == token).all()
+    return jobs
+
+
+def renew(worker: str, job_ids: Iterable[int], lease: float = LEASE) -> None:
+    """pushes back the lease expiry of jobs the worker still holds"""
+    ids = list(job_ids)
+    for start in range(0, len(ids), CHUNK):
+        session.query(ScanJob).filter(
+            ScanJob.job_id.in_(ids[start : start + CHUNK]),
+            ScanJob.state == LEASED,
+            ScanJob.lease.like(f"{worker}:%"),
+        ).update({ScanJob.available_at: time.time() + lease}, synchronize_session=False)
+    session.commit()
+
+
+def _finish(job_id: int, state: str, error: str | None = None) -> None:
+    session.query(ScanJob).filter(ScanJob.job_id == job_id).update(
+        {ScanJob.state: state, ScanJob.lease: None, ScanJob.error: error},
+        synchronize_session=False,
+    )
+    session.commit()
+
+
+def complete(job_id: int) -> None:
+    _finish(job_id, DONE)
+
+
+def protect(job_id: int, error: str) -> None:
+    """protected users can not be scanned, they are never retried"""
+    _finish(job_id, PROTECTED, error)
+
+
+def fail(
+    job: ScanJob, error: str, retry: bool = True, max_attempts: int = MAX_ATTEMPTS
+) -> None:
+    """requeues the job after a backoff delay, or fails it for good"""
+    if not retry or job.attempts >= max_attempts:
+        _finish(job.job_id, FAILED, error)
+        return
+    session.query(ScanJob).filter(ScanJob.job_id == job.job_id).update(
+        {
+            ScanJob.state: PENDING,
+            ScanJob.lease: None,
+            ScanJob.error: error,
+            ScanJob.available_at: time.time() + backoff_delay(job.attempts),
+        },
+        synchronize_session=False,
+    )
+    session.commit()
+
+
+def counts() -> dict[str, int]:
+    """number of jobs in each state"""
+    found = dict(
+        session.query(ScanJob.state, func.count()).group_by(ScanJob.state).all()
+    )
+    return {
+        state: found.get(state, 0)
+        for state in (PENDING, LEASED, DONE, FAILED, PROTECTED)
+    }
+
+
+def active() -> bool:
+    """whether jobs are still pending or leased, by any worker"""
+    return (
+        session.query(ScanJob.job_id)
+        .filter(ScanJob.state.in_((PENDING, LEASED)))
+        .first()
+        is not None
+    )
+
+
+def _permanent(err: TweepError) -> bool:
+    """client errors other than rate limits will fail again, aioscan already retried the rest"""
+    status = getattr(getattr(err, "response", None), "status_code", None)
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+def enqueue_followers(user_id: int, refresh: bool = False) -> int:
+    followers = [
+        ff
+        for (ff,) in session.query(Entourage.friend_follower_id).filter(
+            Entourage.user_id == user_id, Entourage.follower.is_(True)
+        )
+    ]
+    if len(followers) >= MAX_FOLLOWERS_SCANNED:
+        logging.info(
+            f"User {user_id} has more than allowed number of followers to scan, skipping them"
+        )
+        return 0
+    return enqueue(followers, refresh=refresh)
+
+
+async def run_job(
+    scanner: AsyncScanner, job: ScanJob, max_attempts: int = MAX_ATTEMPTS
+) -> None:
+    """scans the job's user and records the outcome, main users enqueue their followers"""
+    try:
+        user_id = job.user_id
+        if user_id is None and job.refresh:
+            stored = session.query(TwitscanUser.user_id).filter(
+                TwitscanUser.screen_name == job.screen_name
+            )
+            user_id = stored.scalar()
+        if job.refresh and user_id is not None:
+            user = await scanner.rescan(user_id)
+        else:
+            user = await scanner.scan(user_id=user_id, screen_name=job.screen_name)
+        if job.main:
+            enqueue_followers(user.user_id, job.refresh)
+    except UserProtectedError as err:
+        protect(job.job_id, err.message)
+        return
+    except TweepError as err:
+        session.rollback()
+        logging.debug(f"Got tweepy error on job {job.job_id}\n\t{err}")
+        fail(job, str(err), not _permanent(err), max_attempts)
+        return
+    except Exception as err:
+        session.rollback()
+        logging.exception(f"Job {job.job_id} failed")
+        fail(job, repr(err), True, max_attempts)
+        return
+    complete(job.job_id)
+
+
+async def _work(
+    scanner: AsyncScanner,
+    worker: str,
+    concurrency: int,
+    lease: float,
+    max_attempts: int,
+    poll: float,
+) -> None:
+    in_flight: dict[asyncio.Task[None], int] = {}
+    renewed = time.time()
+    while True:
+        jobs: list[ScanJob] = []
+        if len(in_flight) < concurrency:
+            jobs = claim(worker, concurrency - len(in_flight), lease, max_attempts)
+        for job in jobs:
+            task = asyncio.ensure_future(run_job(scanner, job, max_attempts))
+            in_flight[task] = job.job_id
+        if not in_flight:
+            if not active():
+                return
+            await asyncio.sleep(poll)  # others hold the remaining jobs
+            continue
+        done, _ = await asyncio.wait(
+            in_flight, timeout=poll, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in done:
+            del in_flight[task]
+        if in_flight and time.time() - renewed > lease / 3:
+            renew(worker, in_flight.values(), lease)
+            renewed = time.time()
+
+
+def work(
+    worker: str | None = None,
+    concurrency: int = 8,
+    lease: float = LEASE,
+    max_attempts: int = MAX_ATTEMPTS,
+    poll: float = 5.0,
+    log_file: str | None = None,
+    log_level: int = logging.INFO,
+    metrics: str | None = None,
+    metrics_interval: float = telemetry.INTERVAL,
+) -> None:
+    """
+    worker process entry point: claims and scans jobs until none is pending or leased,
+    a crashed worker's jobs are claimed again once their lease expires;
+    each worker writes its own metric snapshots, metrics.json -> metrics.<pid>.json
+    """
+    if log_file is not None:
+        logging.basicConfig(filename=log_file, level=log_level)
+    if worker is None:
+        worker = f"{socket.gethostname()}-{os.getpid()}"
+    scanner = AsyncScanner(concurrency=concurrency)
+    try:
+        with telemetry.report(telemetry.process_path(metrics), metrics_interval):
+            asyncio.run(_work(scanner, worker, concurrency, lease, max_attempts, poll))
+    finally:
+        scanner.close()
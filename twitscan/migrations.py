@@ -0,0 +1,432 @@
+"""
+Versioned schema migrations, the version is sqlite's user_version pragma
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+from argparse import ArgumentParser
+from typing import Any, Callable
+from urllib.parse import urlsplit
+
+from sqlalchemy import event
+from sqlalchemy.engine.base import Connection, Engine
+
+from twitscan import aggregates, context, session
+from twitscan.models import (
+    Base,
+    Domain,
+    EntourageCursor,
+    FeatureVersion,
+    GraphMetric,
+    Hashtag,
+    HashtagName,
+    Link,
+    PastEntourage,
+    ScanJob,
+    TargetInteractions,
+    TargetMentions,
+    Url,
+    UserAggregate,
+    UserHashtag,
+)
+from twitscan.scanner import canonical_hashtag, canonical_url
+
+
+def _dedupe(conn: Connection, table: str, pk: str, key: str, flags: str) -> None:
+    """merges the boolean flags of duplicated rows into the oldest one and drops the others"""
+    keep = f"SELECT MIN({pk}) FROM {table} GROUP BY {key} HAVING COUNT(*) > 1"
+    match = " AND ".join(f"d.{col} = {table}.{col}" for col in key.split(", "))
+    for flag in flags.split(", "):
+        conn.execute(
+            f"UPDATE {table} SET {flag} = "
+            f"(SELECT MAX(d.{flag}) FROM {table} d WHERE {match}) "
+            f"WHERE {pk} IN ({keep})"
+        )
+    removed = conn.execute(
+        f"DELETE FROM {table} WHERE {pk} NOT IN "
+        f"(SELECT MIN({pk}) FROM {table} GROUP BY {key})"
+    ).rowcount
+    logging.info(f"Removed {removed} duplicated rows from {table}")
+
+
+def add_indexes(conn: Connection) -> None:
+    _dedupe(
+        conn,
+        "friend",
+        "entourage_id",
+        "user_id, friend_follower_id",
+        "friend, follower",
+    )
+    _dedupe(
+        conn,
+        "interaction",
+        "interaction_id",
+        "user_id, status_id",
+        "fav, retweet, comment",
+    )
+    # hashtag and link were replaced by interned tables in migration 3
+    tables = set(conn.dialect.get_table_names(conn))
+    for table, stmt in (
+        (
+            "friend",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_friend_user_id_friend_follower_id "
+            "ON friend (user_id, friend_follower_id)",
+        ),
+        (
+            "friend",
+            "CREATE INDEX IF NOT EXISTS ix_friend_friend_follower_id "
+            "ON friend (friend_follower_id)",
+        ),
+        (
+            "user",
+            "CREATE INDEX IF NOT EXISTS ix_user_screen_name ON user (screen_name)",
+        ),
+        ("status", "CREATE INDEX IF NOT EXISTS ix_status_user_id ON status (user_id)"),
+        (
+            "hashtag",
+            "CREATE INDEX IF NOT EXISTS ix_hashtag_status_id ON hashtag (status_id)",
+        ),
+        (
+            "hashtag",
+            "CREATE INDEX IF NOT EXISTS ix_hashtag_hashtag_name "
+            "ON hashtag (hashtag_name)",
+        ),
+        (
+            "mention",
+            "CREATE INDEX IF NOT EXISTS ix_mention_status_id ON mention (status_id)",
+        ),
+        (
+            "mention",
+            "CREATE INDEX IF NOT EXISTS ix_mention_user_id ON mention (user_id)",
+        ),
+        ("link", "CREATE INDEX IF NOT EXISTS ix_link_status_id ON link (status_id)"),
+        (
+            "interaction",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_interaction_user_id_status_id "
+            "ON interaction (user_id, status_id)",
+        ),
+        (
+            "interaction",
+            "CREATE INDEX IF NOT EXISTS ix_interaction_status_id "
+            "ON interaction (status_id)",
+        ),
+    ):
+        if table in tables:
+            conn.execute(stmt)
+
+
+def add_full_text_search(conn: Connection) -> None:
+    """external content fts5 tables kept in sync by triggers, then backfilled"""
+    for table, pk, columns in (
+        ("status", "status_id", ("text",)),
+        ("user", "user_id", ("screen_name", "name")),
+    ):
+        fts = f"{table}_fts"
+        cols = ", ".join(columns)
+        new = ", ".join(f"new.{col}" for col in columns)
+        old = ", ".join(f"old.{col}" for col in columns)
+        conn.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} "
+            f"USING fts5({cols}, content='{table}', content_rowid='{pk}')"
+        )
+        conn.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON "{table}" '
+            f"BEGIN INSERT INTO {fts}(rowid, {cols}) VALUES (new.{pk}, {new}); END"
+        )
+        conn.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON "{table}" '
+            f"BEGIN INSERT INTO {fts}({fts}, rowid, {cols}) "
+            f"VALUES ('delete', old.{pk}, {old}); END"
+        )
+        conn.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {cols} ON "{table}" '
+            f"BEGIN INSERT INTO {fts}({fts}, rowid, {cols}) "
+            f"VALUES ('delete', old.{pk}, {old}); "
+            f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.{pk}, {new}); END"
+        )
+        conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def _intern(
+    conn: Connection,
+    raw_values: list[str],
+    intern: Callable[[list[str]], dict[str, int]],
+) -> None:
+    """fills the temporary raw -> id table used to rewrite occurrences onto dictionary ids"""
+    conn.execute("CREATE TEMP TABLE intern_map (raw VARCHAR PRIMARY KEY, id INTEGER)")
+    ids = intern(raw_values)
+    if ids:
+        conn.execute(
+            "INSERT INTO intern_map (raw, id) VALUES (?, ?)", list(ids.items())
+        )
+
+
+def intern_entities(conn: Connection) -> None:
+    """
+    moves hashtag and link occurrences to integer link tables
+    pointing at lowercased hashtag_dict, url_dict and domain rows
+    """
+    for model in (HashtagName, Hashtag, Domain, Url, Link):
+        model.__table__.create(conn, checkfirst=True)
+    tables = set(conn.dialect.get_table_names(conn))
+
+    if "hashtag" in tables:
+        names = [
+            name
+            for (name,) in conn.execute(
+                "SELECT DISTINCT hashtag_name FROM hashtag WHERE hashtag_name IS NOT NULL"
+            )
+        ]
+
+        def intern_hashtags(raw: list[str]) -> dict[str, int]:
+            canonical = {name: canonical_hashtag(name) for name in raw}
+            conn.execute(
+                "INSERT OR IGNORE INTO hashtag_dict (name) VALUES (?)",
+                [(name,) for name in set(canonical.values())],
+            )
+            ids = dict(
+                conn.execute(
+                    "SELECT name, hashtag_dict_id FROM hashtag_dict"
+                ).fetchall()
+            )
+            return {name: ids[canonical[name]] for name in raw}
+
+        _intern(conn, names, intern_hashtags)
+        conn.execute(
+            "INSERT OR IGNORE INTO status_hashtag (status_id, hashtag_dict_id) "
+            "SELECT h.status_id, m.id FROM hashtag h JOIN intern_map m ON m.raw = h.hashtag_name"
+        )
+        conn.execute("DROP TABLE intern_map")
+        conn.execute("DROP TABLE hashtag")
+
+    if "link" in tables:
+        links = [
+            link
+            for (link,) in conn.execute(
+                "SELECT DISTINCT link FROM link WHERE link IS NOT NULL AND link != ''"
+            )
+        ]
+
+        def intern_urls(raw: list[str]) -> dict[str, int]:
+            canonical = {link: canonical_url(link) for link in raw}
+            domains = {url: urlsplit(url).hostname or "" for url in canonical.values()}
+            conn.execute(
+                "INSERT OR IGNORE INTO domain (name) VALUES (?)",
+                [(name,) for name in set(domains.values())],
+            )
+            domain_ids = dict(
+                conn.execute("SELECT name, domain_id FROM domain").fetchall()
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO url_dict (url, domain_id) VALUES (?, ?)",
+                [(url, domain_ids[domain]) for url, domain in domains.items()],
+            )
+            ids = dict(conn.execute("SELECT url, url_id FROM url_dict").fetchall())
+            return {link: ids[canonical[link]] for link in raw}
+
+        _intern(conn, links, intern_urls)
+        conn.execute(
+            "INSERT OR IGNORE INTO status_url (status_id, url_id) "
+            "SELECT l.status_id, m.id FROM link l JOIN intern_map m ON m.raw = l.link"
+        )
+        conn.execute("DROP TABLE intern_map")
+        conn.execute("DROP TABLE link")
+
+
+def track_entourage_changes(conn: Connection) -> None:
+    """scan timestamps for incremental rescans and the table of departed relations"""
+    for table, column in (("friend", "first_seen"), ("user", "scanned_at")):
+        columns = {info[1] for info in conn.execute(f'PRAGMA table_info("{table}")')}
+        if column not in columns:
+            conn.execute(f'ALTER TABLE "{table}" ADD COLUMN {column} DATETIME')
+    PastEntourage.__table__.create(conn, checkfirst=True)
+
+
+def add_entourage_cursors(conn: Connection) -> None:
+    EntourageCursor.__table__.create(conn, checkfirst=True)
+
+
+def add_scan_queue(conn: Connection) -> None:
+    ScanJob.__table__.create(conn, checkfirst=True)
+
+
+def add_graph_metrics(conn: Connection) -> None:
+    GraphMetric.__table__.create(conn, checkfirst=True)
+
+
+def add_feature_aggregates(conn: Connection) -> None:
+    for model in (UserAggregate, UserHashtag, TargetMentions, TargetInteractions):
+        model.__table__.create(conn, checkfirst=True)
+    add_feature_versions(conn)  # the rebuild bumps them
+    aggregates.rebuild(conn)
+
+
+def add_feature_versions(conn: Connection) -> None:
+    FeatureVersion.__table__.create(conn, checkfirst=True)
+
+
+def add_timeline_watermark(conn: Connection) -> None:
+    """since_id of the rescans, the newest stored status of a user may be a favorite"""
+    columns = {info[1] for info in conn.execute('PRAGMA table_info("user")')}
+    if "timeline_status_id" not in columns:
+        conn.execute('ALTER TABLE "user" ADD COLUMN timeline_status_id INTEGER')
+
+
+# applied in order, a database at user_version n has run the first n migrations,
+# each one must also run cleanly on a database freshly created from the models
+MIGRATIONS: list[Callable[[Connection], None]] = [
+    add_indexes,
+    add_full_text_search,
+    intern_entities,
+    track_entourage_changes,
+    add_entourage_cursors,
+    add_scan_queue,
+    add_graph_metrics,
+    add_feature_aggregates,
+    add_feature_versions,
+    add_timeline_watermark,
+]
+
+
+def version(conn: Connection) -> int:
+    result: int = conn.execute("PRAGMA user_version").scalar()
+    return result
+
+
+def migrate(bind: Engine | None = None) -> int:
+    """
+    brings the database schema up to date and returns its version,
+    a new database is created from the models then goes through every migration
+    """
+    bind = bind if bind is not None else context.engine
+    with bind.begin() as conn:
+        current = version(conn)
+        if not bind.dialect.has_table(conn, "user"):
+            Base.metadata.create_all(conn)
+            current = 0
+        for number, migration in enumerate(MIGRATIONS[current:], start=current + 1):
+            logging.info(f"Applying migration {number}: {migration.__name__}")
+            migration(conn)
+        conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+    with bind.connect() as conn:
+        conn.execute("ANALYZE")
+    return len(MIGRATIONS)
+
+
+# counting whole tables can not use an index
+FULL_SCANS_EXPECTED = {"db_info"}
+_FULL_SCAN = re.compile(r"^SCAN (TABLE )?(\w+)( AS \w+)?$")
+
+
+def sample_calls() -> dict[str, Callable[[], Any]]:
+    """one call of every twitscan.query function on rows taken from the database"""
+    from twitscan import query
+    from twitscan.models import TwitscanStatus, TwitscanUser
+
+    users = session.query(TwitscanUser).limit(2).all()
+    assert len(users) == 2, "Query plans are checked against at least two users"
+    a, b = users
+    status = session.query(TwitscanStatus).first()
+    hashtag = session.query(HashtagName).first()
+    session.expunge_all()  # relationships must be loaded during the checked call
+
+    def load(user: TwitscanUser) -> TwitscanUser:
+        loaded = query.user_by_id(user.user_id)
+        assert loaded is not None, f"User {user} vanished from the database"
+        return loaded
+
+    return {
+        "user_by_screen_name": lambda: query.user_by_screen_name(a.screen_name),
+        "user_by_id": lambda: query.user_by_id(a.user_id),
+        "status_by_id": lambda: query.status_by_id(status.status_id if status else 0),
+        "statuses_by_hashtag": lambda: query.statuses_by_hashtag(
+            hashtag.name if hashtag else ""
+        ),
+        "statuses": lambda: query.statuses("hello"),
+        "followers": lambda: query.followers(a.user_id),
+        "users": lambda: query.users(a.screen_name),
+        "hashtags_used": lambda: query.hashtags_used(load(a)),
+        "n_mentions": lambda: query.n_mentions(load(a), b.user_id),
+        "n_interactions": lambda: query.n_interactions(load(a), b.user_id),
+        "proximity": lambda: query.proximity(load(a), load(b)),
+        "db_info": query.db_info,
+    }
+
+
+def check_query_plans(bind: Engine | None = None) -> dict[str, list[str]]:
+    """
+    runs every query function, EXPLAIN QUERY PLAN its statements
+    and returns the full table scans found for each function,
+    plans are made without the ANALYZE statistics as sqlite rightly scans
+    tables of a few rows, which would make the check depend on the database size
+    """
+    bind = bind if bind is not None else context.engine
+    captured: list[tuple[str, Any]] = []
+
+    def capture(conn: Any, cursor: Any, stmt: str, params: Any, *_: Any) -> None:
+        if stmt.lstrip().upper().startswith("SELECT"):
+            captured.append((stmt, params))
+
+    statements: dict[str, list[tuple[str, Any]]] = {}
+    calls = sample_calls()
+    event.listen(bind, "before_cursor_execute", capture)
+    try:
+        for name, call in calls.items():
+            captured.clear()
+            session.expire_all()
+            call()
+            statements[name] = list(captured)
+    finally:
+        event.remove(bind, "before_cursor_execute", capture)
+
+    scans: dict[str, list[str]] = {}
+    with bind.connect() as conn:
+        analyzed = bind.dialect.has_table(conn, "sqlite_stat1")
+        transaction = conn.begin()
+        try:
+            if analyzed:
+                conn.execute("DELETE FROM sqlite_stat1")
+                conn.execute("ANALYZE sqlite_master")  # reloads the statistics
+            for name, captured_statements in statements.items():
+                scans[name] = []
+                for stmt, params in captured_statements:
+                    plan = conn.execute(f"EXPLAIN QUERY PLAN {stmt}", params)
+                    for row in plan.fetchall():
+                        detail: str = row[-1]
+                        if _FULL_SCAN.match(detail):
+                            scans[name].append(f"{detail} in: {' '.join(stmt.split())}")
+        finally:
+            transaction.rollback()
+            if analyzed:
+                conn.execute("ANALYZE sqlite_master")
+    return scans
+
+
+def main() -> None:
+    parser = ArgumentParser(description="migrate the twitscan database schema")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        default=False,
+        help="verify that query functions use indexes",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(f"Database schema at version {migrate()}")
+    if args.check:
+        failed = False
+        for name, found in check_query_plans().items():
+            if found and name not in FULL_SCANS_EXPECTED:
+                failed = True
+                print(f"{name} does full table scans:")
+                for scan in found:
+                    print(f"\t{scan}")
+        if failed:
+            exit(1)
+        print("Every query function uses indexes")
+
+
+if __name__ == "__main__":
+    main()
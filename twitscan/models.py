@@ -1,6 +1,16 @@
 from typing import Any, Iterable
 
-from sqlalchemy import Boolean, Column, Date, ForeignKey, Integer, String
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref, relationship
 
@@ -16,22 +26,63 @@ if __name__ == "__main__":
 class Mention(Base):
     __tablename__ = "mention"
     mention_id = Column(Integer, primary_key=True)
-    status_id = Column(Integer, ForeignKey("status.status_id"), nullable=False)
-    user_id = Column(Integer)  # might not be analysed user
+    status_id = Column(
+        Integer, ForeignKey("status.status_id"), nullable=False, index=True
+    )
+    user_id = Column(Integer, index=True)  # might not be analysed user
+
+
+class HashtagName(Base):
+    __tablename__ = "hashtag_dict"
+    hashtag_dict_id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)  # lowercased
 
 
 class Hashtag(Base):
-    __tablename__ = "hashtag"
-    hashtag_id = Column(Integer, primary_key=True)
-    status_id = Column(Integer, ForeignKey("status.status_id"), nullable=False)
-    hashtag_name = Column(String)
+    __tablename__ = "status_hashtag"
+    status_id = Column(Integer, ForeignKey("status.status_id"), primary_key=True)
+    hashtag_dict_id = Column(
+        Integer,
+        ForeignKey("hashtag_dict.hashtag_dict_id"),
+        primary_key=True,
+        index=True,
+    )
+    tag: HashtagName = relationship("HashtagName", lazy="joined")
+
+    @property
+    def hashtag_name(self) -> str:
+        name: str = self.tag.name
+        return name
+
+
+class Domain(Base):
+    __tablename__ = "domain"
+    domain_id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+
+
+class Url(Base):
+    __tablename__ = "url_dict"
+    url_id = Column(Integer, primary_key=True)
+    url = Column(String, nullable=False, unique=True)  # scheme and host lowercased
+    domain_id = Column(
+        Integer, ForeignKey("domain.domain_id"), nullable=False, index=True
+    )
+    domain: Domain = relationship("Domain", lazy=True)
 
 
 class Link(Base):
-    __tablename__ = "link"
-    link_id = Column(Integer, primary_key=True)
-    status_id = Column(Integer, ForeignKey("status.status_id"), nullable=False)
-    link = Column(String)
+    __tablename__ = "status_url"
+    status_id = Column(Integer, ForeignKey("status.status_id"), primary_key=True)
+    url_id = Column(
+        Integer, ForeignKey("url_dict.url_id"), primary_key=True, index=True
+    )
+    url: Url = relationship("Url", lazy="joined")
+
+    @property
+    def link(self) -> str:
+        link: str = self.url.url
+        return link
 
 
 class TwitscanStatus(Base):
@@ -44,7 +95,7 @@ class TwitscanStatus(Base):
     in_reply_to_status_id = Column(Integer)
     in_reply_to_user_id = Column(Integer)
     is_retweet = Column(Boolean, nullable=False)
-    user_id = Column(Integer, ForeignKey("user.user_id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("user.user_id"), nullable=False, index=True)
     user_mentions: Iterable[Mention] = relationship(
         "Mention", backref=backref("status"), lazy=True
     )
@@ -59,9 +110,12 @@ class TwitscanStatus(Base):
 
 class Interaction(Base):
     __tablename__ = "interaction"
+    __table_args__ = (
+        Index("ux_interaction_user_id_status_id", "user_id", "status_id", unique=True),
+    )
     interaction_id = Column("interaction_id", Integer, primary_key=True)
     user_id = Column("user_id", Integer, ForeignKey("user.user_id"))
-    status_id = Column("status_id", Integer, ForeignKey("status.status_id"))
+    status_id = Column("status_id", Integer, ForeignKey("status.status_id"), index=True)
     fav = Column("fav", Boolean, nullable=False)
     retweet = Column("retweet", Boolean, nullable=False)
     comment = Column("comment", Boolean, nullable=False)
@@ -69,17 +123,126 @@ class Interaction(Base):
 
 class Entourage(Base):
     __tablename__ = "friend"
+    __table_args__ = (
+        Index(
+            "ux_friend_user_id_friend_follower_id",
+            "user_id",
+            "friend_follower_id",
+            unique=True,
+        ),
+    )
     entourage_id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("user.user_id"), nullable=False)
-    friend_follower_id = Column(Integer, nullable=False)
+    friend_follower_id = Column(Integer, nullable=False, index=True)
     friend = Column(Boolean, nullable=False)  # might not be analysed user
     follower = Column(Boolean, nullable=False)  # might not be analysed user
+    # unknown for rows scanned before it was recorded, last seen at user.scanned_at
+    first_seen = Column(DateTime, nullable=True)
+
+
+class PastEntourage(Base):
+    """relation found missing from the entourage when the user was rescanned"""
+
+    __tablename__ = "friend_history"
+    history_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("user.user_id"), nullable=False, index=True)
+    friend_follower_id = Column(Integer, nullable=False)
+    friend = Column(Boolean, nullable=False)
+    follower = Column(Boolean, nullable=False)
+    first_seen = Column(DateTime, nullable=True)
+    last_seen = Column(DateTime, nullable=True)
+
+
+class EntourageCursor(Base):
+    """where a paginated entourage fetch stopped"""
+
+    __tablename__ = "entourage_cursor"
+    user_id = Column(Integer, primary_key=True)
+    kind = Column(String, primary_key=True)  # friends or followers
+    next_cursor = Column(Integer, nullable=False)  # 0 once every page is stored
+
+
+class ScanJob(Base):
+    """one user to scan, claimed by scan workers through twitscan.jobqueue"""
+
+    __tablename__ = "scan_job"
+    __table_args__ = (Index("ix_scan_job_state_available_at", "state", "available_at"),)
+    job_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, unique=True)  # main users may only have a screen name
+    screen_name = Column(String, unique=True)
+    main = Column(Boolean, nullable=False, default=False)  # followers get enqueued
+    refresh = Column(Boolean, nullable=False, default=False)
+    state = Column(String, nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    # pending: not claimable before, leased: lease expiry, both in epoch seconds
+    available_at = Column(Float, nullable=False, default=0.0)
+    lease = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+
+
+class GraphMetric(Base):
+    """position of an account in the follow graph, computed by twitscan.graph"""
+
+    __tablename__ = "graph_metric"
+    user_id = Column(Integer, primary_key=True)  # might not be analysed user
+    in_degree = Column(Integer, nullable=False)  # followers seen in the friend table
+    out_degree = Column(Integer, nullable=False)
+    pagerank = Column(Float, nullable=False)
+    component = Column(Integer, nullable=False)  # 0 is the largest one
+    community = Column(Integer, nullable=False)  # 0 is the largest one
+    reach = Column(Integer, nullable=True)  # only computed for analysed users
+    computed_at = Column(DateTime, nullable=False)
+
+
+class UserAggregate(Base):
+    """per user facts of twitscan.aggregates, kept up to date when statuses are saved"""
+
+    __tablename__ = "user_features"
+    user_id = Column(Integer, primary_key=True)  # author, might not be analysed user
+    hashtags = Column(Integer, nullable=False, default=0)  # distinct hashtags used
+    mentions = Column(Integer, nullable=False, default=0)  # mentions in their statuses
+
+
+class UserHashtag(Base):
+    __tablename__ = "user_hashtags"
+    user_id = Column(Integer, primary_key=True)
+    hashtag_dict_id = Column(Integer, primary_key=True)
+    uses = Column(Integer, nullable=False)
+
+
+class TargetMentions(Base):
+    __tablename__ = "user_target_mentions"
+    user_id = Column(Integer, primary_key=True)  # author of the statuses
+    target_id = Column(Integer, primary_key=True)  # mentioned user
+    mentions = Column(Integer, nullable=False)
+
+
+class TargetInteractions(Base):
+    """interactions of a user with the statuses of an author"""
+
+    __tablename__ = "user_target_interactions"
+    user_id = Column(Integer, primary_key=True)
+    author_id = Column(Integer, primary_key=True)
+    favs = Column(Integer, nullable=False)
+    retweets = Column(Integer, nullable=False)
+    comments = Column(Integer, nullable=False)
+
+
+class FeatureVersion(Base):
+    """
+    bumped by every save changing what the features of a user are derived from,
+    cached features are only reused while the version they were computed at holds
+    """
+
+    __tablename__ = "feature_version"
+    user_id = Column(Integer, primary_key=True)  # might not be analysed user
+    version = Column(Integer, nullable=False, default=0)
 
 
 class TwitscanUser(Base):
     __tablename__ = "user"
     user_id = Column(Integer, primary_key=True)
-    screen_name = Column(String, nullable=False)
+    screen_name = Column(String, nullable=False, index=True)
     name = Column(String, nullable=True)
     created_at = Column(Date, nullable=False)
     verified = Column(Boolean, nullable=False)
@@ -88,6 +251,10 @@ class TwitscanUser(Base):
     friends_count = Column(Integer, nullable=False, default=0)
     followers_count = Column(Integer, nullable=False, default=0)
     user_picture_url = Column(String, nullable=True)
+    scanned_at = Column(DateTime, nullable=True)  # last scan or rescan
+    # newest status of the last fetched timeline, unknown for users scanned before
+    # it was recorded whose next rescan fetches the whole timeline again
+    timeline_status_id = Column(Integer, nullable=True)
     chirps: Iterable[TwitscanStatus] = relationship(
         "TwitscanStatus", backref=backref("user"), lazy=True
     )  # either tweets or retweets
@@ -0,0 +1,108 @@
+"""
+Proximity of a main user with their followers computed by a process pool,
+followers are sharded across workers reading the database through read-only connections
+"""
+
+from __future__ import annotations
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from twitscan import configure, context, session
+from twitscan.cache import FeatureCache, UserFeatures, compute_features
+from twitscan.entourage import EntourageIndex
+from twitscan.models import TwitscanUser
+from twitscan.proximity import (
+    COLUMN,
+    FEATURES,
+    ProximityMatrix,
+    fill_features,
+    follower_matrix,
+    index_features,
+)
+
+SHARDS_PER_PROCESS = 4  # smaller shards even out followers with large entourages
+
+
+def _init_worker(db_url: str) -> None:
+    configure(db_url=db_url, readonly=True)
+
+
+def score_shard(
+    uid: int, main: UserFeatures, ids: np.ndarray, entourage: bool = True
+) -> np.ndarray:
+    """
+    feature rows of a shard of followers, favorites counts are left to the parent
+    as are the entourage features unless entourage is set
+    """
+    features = np.zeros((len(ids), len(FEATURES)), dtype=np.float64)
+    fill_features(uid, main, compute_features(ids.tolist()), ids, features, entourage)
+    session.close()
+    return features
+
+
+class ParallelRanker:
+    """
+    process pool scoring the followers of one main user at a time,
+    the main user's features are computed once by the parent and sent with every shard,
+    entourage features are read by the parent from the sparse index when one is given
+    """
+
+    def __init__(
+        self,
+        processes: int,
+        db_url: str | None = None,
+        cache: FeatureCache | None = None,
+        index: EntourageIndex | None = None,
+    ):
+        self.processes = processes
+        self.cache = cache
+        self.index = index
+        self.executor = ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(db_url or context.db_url,),
+        )
+
+    def bulk_proximity(self, user: TwitscanUser) -> ProximityMatrix:
+        """proximity.bulk_proximity with follower rows in the same sorted order"""
+        matrix = follower_matrix(user)
+        ids = matrix.follower_ids
+        if len(ids) == 0:
+            return matrix
+        uid: int = user.user_id
+        main = (
+            self.cache.get(uid)
+            if self.cache is not None
+            else compute_features([uid])[uid]
+        )
+        shards = [
+            shard
+            for shard in np.array_split(ids, self.processes * SHARDS_PER_PROCESS)
+            if len(shard)
+        ]
+        scored = np.vstack(
+            list(
+                self.executor.map(
+                    score_shard,
+                    repeat(uid),
+                    repeat(main),
+                    shards,
+                    repeat(self.index is None),
+                )
+            )
+        )
+        # favorites counts come from the user rows read by the parent
+        favs = [COLUMN["user_favs_count"], COLUMN["follower_favs_count"]]
+        scored[:, favs] = matrix.features[:, favs]
+        matrix.features[:] = scored
+        if self.index is not None:
+            index_features(self.index, uid, ids, matrix.features)
+        return matrix
+
+    def close(self) -> None:
+        self.executor.shutdown()
@@ -0,0 +1,317 @@
+"""
+Bulk proximity features between a main user and all of their scanned followers
+"""
+
+from __future__ import annotations
+
+from typing import Any, Iterator, Mapping, NamedTuple
+
+import numpy as np
+from sqlalchemy import distinct, func
+from sqlalchemy.orm import aliased
+
+from twitscan import session
+from twitscan.cache import FeatureCache, UserFeatures
+from twitscan.entourage import EntourageIndex
+from twitscan.models import (
+    Entourage,
+    TargetInteractions,
+    TargetMentions,
+    TwitscanUser,
+    UserAggregate,
+    UserHashtag,
+)
+
+FEATURES: tuple[str, ...] = (
+    "common_entourage",
+    "entourage_user",
+    "entourage_follower",
+    "common_hashtags",
+    "hashtags_user",
+    "hashtags_follower",
+    "user_mentions_follower",
+    "follower_mentions_user",
+    "user_mentions_counter",
+    "follower_mentions_counter",
+    "user_favs_follower",
+    "follower_favs_user",
+    "user_favs_count",
+    "follower_favs_count",
+    "user_rt_follower",
+    "follower_rt_user",
+    "user_cmt_follower",
+    "follower_cmt_user",
+)
+RATIOS = frozenset({"common_entourage", "common_hashtags"})
+COLUMN: dict[str, int] = {name: i for i, name in enumerate(FEATURES)}
+
+
+class ProximityMatrix(NamedTuple):
+    user: TwitscanUser
+    follower_ids: np.ndarray  # sorted, one row of features per follower
+    screen_names: list[str]
+    features: np.ndarray  # shape (len(follower_ids), len(FEATURES))
+
+    def rows(self) -> Iterator[tuple[str, tuple[int | float, ...]]]:
+        """yields (follower screen name, features) with counts as ints and ratios as floats"""
+        for name, row in zip(self.screen_names, self.features.tolist()):
+            yield name, tuple(
+                value if feature in RATIOS else int(value)
+                for feature, value in zip(FEATURES, row)
+            )
+
+
+def followers_query(user_id: int) -> Any:
+    """ids of the user's followers, usable inside an IN clause"""
+    ent = aliased(Entourage)
+    return session.query(ent.friend_follower_id).filter(
+        ent.user_id == user_id, ent.follower.is_(True)
+    )
+
+
+def _scalar(query: Any) -> int:
+    result: int | None = query.scalar()
+    return result if result is not None else 0
+
+
+def _scatter(
+    ids: np.ndarray, features: np.ndarray, rows: list[Any], *columns: str
+) -> None:
+    """writes aggregated (user_id, value, ...) rows into the given feature columns"""
+    if not rows or len(ids) == 0:
+        return
+    keys = np.array([row[0] for row in rows], dtype=np.int64)
+    values = np.array([row[1:] for row in rows], dtype=np.float64)
+    pos = np.minimum(np.searchsorted(ids, keys), len(ids) - 1)
+    found = ids[pos] == keys
+    features[np.ix_(pos[found], [COLUMN[c] for c in columns])] = values[found]
+
+
+def _ratio(features: np.ndarray, common: str, a: str, b: str) -> None:
+    total = features[:, COLUMN[a]] + features[:, COLUMN[b]]
+    shared = features[:, COLUMN[common]]
+    features[:, COLUMN[common]] = np.divide(
+        shared, total, out=np.zeros_like(shared), where=total != 0
+    )
+
+
+def index_features(
+    index: EntourageIndex, uid: int, ids: np.ndarray, features: np.ndarray
+) -> None:
+    """writes the entourage features read from the sparse index"""
+    scores = index.scores(uid, ids)
+    (row,), (indexed,) = index.rows([uid])
+    features[:, COLUMN["entourage_user"]] = index.sizes[row] if indexed else 0
+    pos, present = index.rows(ids)
+    features[:, COLUMN["entourage_follower"]] = 0
+    features[present, COLUMN["entourage_follower"]] = index.sizes[pos[present]]
+    features[:, COLUMN["common_entourage"]] = scores.common
+
+
+def fill_features(
+    uid: int,
+    main: UserFeatures,
+    others: Mapping[int, UserFeatures],
+    ids: np.ndarray,
+    features: np.ndarray,
+    entourage: bool = True,
+) -> None:
+    """
+    derives every feature but the favorites counts from per-user features,
+    entourage features are left to the caller unless entourage is set
+    """
+    for row, follower_id in enumerate(ids.tolist()):
+        other = others[follower_id]
+        if entourage:
+            common = len(
+                np.intersect1d(
+                    main["entourage"], other["entourage"], assume_unique=True
+                )
+            )
+            features[row, COLUMN["common_entourage"]] = common
+            features[row, COLUMN["entourage_follower"]] = len(other["entourage"])
+        features[row, COLUMN["common_hashtags"]] = len(
+            main["hashtags"] & other["hashtags"]
+        )
+        features[row, COLUMN["hashtags_follower"]] = len(other["hashtags"])
+        features[row, COLUMN["user_mentions_follower"]] = main["mentions"].get(
+            follower_id, 0
+        )
+        features[row, COLUMN["follower_mentions_user"]] = other["mentions"].get(uid, 0)
+        features[row, COLUMN["follower_mentions_counter"]] = other["mentions_total"]
+        (
+            features[row, COLUMN["user_favs_follower"]],
+            features[row, COLUMN["user_rt_follower"]],
+            features[row, COLUMN["user_cmt_follower"]],
+        ) = main["interactions"].get(follower_id, (0, 0, 0))
+        (
+            features[row, COLUMN["follower_favs_user"]],
+            features[row, COLUMN["follower_rt_user"]],
+            features[row, COLUMN["follower_cmt_user"]],
+        ) = other["interactions"].get(uid, (0, 0, 0))
+    features[:, COLUMN["hashtags_user"]] = len(main["hashtags"])
+    features[:, COLUMN["user_mentions_counter"]] = main["mentions_total"]
+    if entourage:
+        features[:, COLUMN["entourage_user"]] = len(main["entourage"])
+        _ratio(features, "common_entourage", "entourage_user", "entourage_follower")
+    _ratio(features, "common_hashtags", "hashtags_user", "hashtags_follower")
+
+
+def follower_matrix(user: TwitscanUser) -> ProximityMatrix:
+    """the user's scanned followers with only their favorites counts filled in"""
+    scanned = (
+        session.query(
+            TwitscanUser.user_id, TwitscanUser.screen_name, TwitscanUser.favorites_count
+        )
+        .filter(TwitscanUser.user_id.in_(followers_query(user.user_id)))
+        .order_by(TwitscanUser.user_id)
+        .all()
+    )
+    ids = np.array([row[0] for row in scanned], dtype=np.int64)
+    names: list[str] = [row[1] for row in scanned]
+    features = np.zeros((len(ids), len(FEATURES)), dtype=np.float64)
+    features[:, COLUMN["user_favs_count"]] = user.favorites_count
+    features[:, COLUMN["follower_favs_count"]] = [row[2] for row in scanned]
+    return ProximityMatrix(user, ids, names, features)
+
+
+def bulk_proximity(
+    user: TwitscanUser,
+    index: EntourageIndex | None = None,
+    cache: FeatureCache | None = None,
+) -> ProximityMatrix:
+    """
+    computes the proximity features of query.proximity between user and every scanned follower,
+    reading the aggregate tables with a few queries instead of walking relationships pair by pair,
+    entourage features are read from the sparse index when one is given,
+    the other features are derived from the cached per-user features when a cache is given
+    """
+    uid: int = user.user_id
+    followers = followers_query(uid)
+    matrix = follower_matrix(user)
+    ids, names, features = matrix.follower_ids, matrix.screen_names, matrix.features
+    if len(ids) == 0:
+        return matrix
+    if cache is not None:
+        cached = cache.get_many([uid, *ids.tolist()])
+        fill_features(uid, cached[uid], cached, ids, features, index is None)
+        if index is not None:
+            index_features(index, uid, ids, features)
+        return matrix
+
+    # entourage
+    if index is not None:
+        index_features(index, uid, ids, features)
+    else:
+        features[:, COLUMN["entourage_user"]] = _scalar(
+            session.query(func.count(distinct(Entourage.friend_follower_id))).filter(
+                Entourage.user_id == uid
+            )
+        )
+        rows = (
+            session.query(
+                Entourage.user_id, func.count(distinct(Entourage.friend_follower_id))
+            )
+            .filter(Entourage.user_id.in_(followers))
+            .group_by(Entourage.user_id)
+            .all()
+        )
+        _scatter(ids, features, rows, "entourage_follower")
+        main_ent = aliased(Entourage)
+        rows = (
+            session.query(
+                Entourage.user_id, func.count(distinct(Entourage.friend_follower_id))
+            )
+            .join(main_ent, main_ent.friend_follower_id == Entourage.friend_follower_id)
+            .filter(main_ent.user_id == uid, Entourage.user_id.in_(followers))
+            .group_by(Entourage.user_id)
+            .all()
+        )
+        _scatter(ids, features, rows, "common_entourage")
+        _ratio(features, "common_entourage", "entourage_user", "entourage_follower")
+
+    # hashtags
+    main_tags = session.query(UserHashtag.hashtag_dict_id).filter(
+        UserHashtag.user_id == uid
+    )
+    features[:, COLUMN["hashtags_user"]] = _scalar(
+        session.query(UserAggregate.hashtags).filter(UserAggregate.user_id == uid)
+    )
+    rows = (
+        session.query(UserAggregate.user_id, UserAggregate.hashtags)
+        .filter(UserAggregate.user_id.in_(followers))
+        .all()
+    )
+    _scatter(ids, features, rows, "hashtags_follower")
+    rows = (
+        session.query(UserHashtag.user_id, func.count())
+        .filter(
+            UserHashtag.user_id.in_(followers),
+            UserHashtag.hashtag_dict_id.in_(main_tags),
+        )
+        .group_by(UserHashtag.user_id)
+        .all()
+    )
+    _scatter(ids, features, rows, "common_hashtags")
+    _ratio(features, "common_hashtags", "hashtags_user", "hashtags_follower")
+
+    # mentions
+    features[:, COLUMN["user_mentions_counter"]] = _scalar(
+        session.query(UserAggregate.mentions).filter(UserAggregate.user_id == uid)
+    )
+    rows = (
+        session.query(TargetMentions.target_id, TargetMentions.mentions)
+        .filter(TargetMentions.user_id == uid)
+        .all()
+    )
+    _scatter(ids, features, rows, "user_mentions_follower")
+    rows = (
+        session.query(UserAggregate.user_id, UserAggregate.mentions)
+        .filter(UserAggregate.user_id.in_(followers))
+        .all()
+    )
+    _scatter(ids, features, rows, "follower_mentions_counter")
+    rows = (
+        session.query(TargetMentions.user_id, TargetMentions.mentions)
+        .filter(TargetMentions.user_id.in_(followers), TargetMentions.target_id == uid)
+        .all()
+    )
+    _scatter(ids, features, rows, "follower_mentions_user")
+
+    # interactions, attributed to the author of the interacted status
+    counts = (
+        TargetInteractions.favs,
+        TargetInteractions.retweets,
+        TargetInteractions.comments,
+    )
+    rows = (
+        session.query(TargetInteractions.author_id, *counts)
+        .filter(TargetInteractions.user_id == uid)
+        .all()
+    )
+    _scatter(
+        ids,
+        features,
+        rows,
+        "user_favs_follower",
+        "user_rt_follower",
+        "user_cmt_follower",
+    )
+    rows = (
+        session.query(TargetInteractions.user_id, *counts)
+        .filter(
+            TargetInteractions.author_id == uid,
+            TargetInteractions.user_id.in_(followers),
+        )
+        .all()
+    )
+    _scatter(
+        ids,
+        features,
+        rows,
+        "follower_favs_user",
+        "follower_rt_user",
+        "follower_cmt_user",
+    )
+
+    return ProximityMatrix(user, ids, names, features)
@@ -1,17 +1,22 @@
 from __future__ import annotations
 
-from typing import TypedDict
-
-from twitscan import session
-from twitscan.models import Entourage, TwitscanStatus, TwitscanUser
-from twitscan.scanner import check_user_id
-
-
-class CacheRecord(TypedDict):
-    entourage: set[int]
-    hashtags: set[str]
-
-cache: dict[int, CacheRecord] = {}
+import numpy as np
+
+from twitscan import search, session
+from twitscan.cache import features_cache
+from twitscan.models import (
+    Entourage,
+    Hashtag,
+    HashtagName,
+    TargetInteractions,
+    TargetMentions,
+    TwitscanStatus,
+    TwitscanUser,
+    UserAggregate,
+    UserHashtag,
+)
+from twitscan.scanner import canonical_hashtag, check_user_id
+from twitscan.telemetry import phase
 
 
 def user_by_screen_name(screen_name: str) -> TwitscanUser | None:
@@ -44,108 +49,118 @@ def status_by_id(status_id: int) -> TwitscanStatus | None:
 def statuses_by_hashtag(hashtag: str) -> list[TwitscanStatus]:
     statuses: list[TwitscanStatus] = (
         session.query(TwitscanStatus)
-        .filter(hashtag in map(lambda ht: ht.hashtag_name, TwitscanStatus.hashtags))
+        .join(Hashtag, Hashtag.status_id == TwitscanStatus.status_id)
+        .join(HashtagName, HashtagName.hashtag_dict_id == Hashtag.hashtag_dict_id)
+        .filter(HashtagName.name == canonical_hashtag(hashtag))
         .all()
     )
     return statuses
 
 
 def statuses(string: str) -> list[TwitscanStatus]:
-    statuses: list[TwitscanStatus] = (
-        session.query(TwitscanStatus)
-        .filter(TwitscanStatus.text.like(f"%{string}%"))
-        .all()
-    )
-    return statuses
+    """statuses containing words starting with those of string, most relevant first"""
+    if not search.match_expression(string):
+        matching: list[TwitscanStatus] = (
+            session.query(TwitscanStatus)
+            .filter(TwitscanStatus.text.like(f"%{string}%"))
+            .all()
+        )
+        return matching
+    return [st for st, _ in search.search_statuses(string, prefix=True, limit=None)]
 
 
 def followers(user_id: int) -> list[TwitscanUser]:
-    entourage = (
-        session.query(Entourage)
-        .filter(Entourage.user_id == user_id and Entourage.follower)
-        .all()
-    )
-    followers_ids = set(map(lambda ent: ent.friend_follower_id, entourage))
     follower_users: list[TwitscanUser] = (
         session.query(TwitscanUser)
-        .filter(TwitscanUser.user_id.in_(followers_ids))
+        .join(Entourage, Entourage.friend_follower_id == TwitscanUser.user_id)
+        .filter(Entourage.user_id == user_id, Entourage.follower)
         .all()
     )
     return follower_users
 
 
 def users(name: str) -> list[TwitscanUser]:
-    usrs: list[TwitscanUser] = (
-        session.query(TwitscanUser)
-        .filter(TwitscanUser.screen_name.like(f"%{name}%"))
-        .all()
-    )
-    return usrs
+    """users whose screen name or name have words starting with those of name"""
+    if not search.match_expression(name):
+        matching: list[TwitscanUser] = (
+            session.query(TwitscanUser)
+            .filter(TwitscanUser.screen_name.like(f"%{name}%"))
+            .all()
+        )
+        return matching
+    return [usr for usr, _ in search.search_users(name, prefix=True, limit=None)]
 
 
 def hashtags_used(user: TwitscanUser) -> set[str]:
-    used: set[str] = set()
-    for status in user.chirps:
-        for hashtag in status.hashtags:
-            used.add(hashtag.hashtag_name)
+    used: set[str] = set(
+        name
+        for (name,) in session.query(HashtagName.name)
+        .join(UserHashtag, UserHashtag.hashtag_dict_id == HashtagName.hashtag_dict_id)
+        .filter(UserHashtag.user_id == user.user_id)
+    )
     return used
 
 
 def n_mentions(user: TwitscanUser, target_id: int) -> tuple[int, int]:
-    mention_counter = 0
-    total_mentions = 0
-    for status in user.chirps:
-        for mention in status.user_mentions:
-            if mention.user_id == target_id:
-                mention_counter += 1
-            total_mentions += 1
-    return mention_counter, total_mentions
+    mention_counter: int | None = (
+        session.query(TargetMentions.mentions)
+        .filter(
+            TargetMentions.user_id == user.user_id,
+            TargetMentions.target_id == target_id,
+        )
+        .scalar()
+    )
+    total_mentions: int | None = (
+        session.query(UserAggregate.mentions)
+        .filter(UserAggregate.user_id == user.user_id)
+        .scalar()
+    )
+    return mention_counter or 0, total_mentions or 0
 
 
 def n_interactions(user: TwitscanUser, target_user: int) -> tuple[int, int, int]:
-    fav, retweet, comment = 0, 0, 0
-    for interaction in user.interacted_tweets:
-        maybe_status: None | TwitscanStatus = (
-            session.query(TwitscanStatus)
-            .filter(TwitscanStatus.status_id == interaction.status_id)
-            .one_or_none()
+    counts = (
+        session.query(
+            TargetInteractions.favs,
+            TargetInteractions.retweets,
+            TargetInteractions.comments,
         )
-        if maybe_status is None:
-            continue
-        if maybe_status.user_id == target_user:
-            if interaction.fav:
-                fav += 1
-            if interaction.retweet:
-                retweet += 1
-            if interaction.comment:
-                comment += 1
-    return fav, retweet, comment, rt_counter, comment_counter
+        .filter(
+            TargetInteractions.user_id == user.user_id,
+            TargetInteractions.author_id == target_user,
+        )
+        .one_or_none()
+    )
+    if counts is None:
+        return 0, 0, 0
+    fav, retweet, comment = counts
+    return fav, retweet, comment
 
 
 def proximity(user_a: TwitscanUser, user_b: TwitscanUser) -> tuple[float, ...]:
     """
-    computes proximity score between two users, stores user a general information inside cache
+    computes proximity score between two users from their cached features
     """
-    global cache
-    for user in (user_a, user_b):
-        assert check_user_id(user.user_id) is not None, f"User {user} not in db"
-
-    if cache.get(user_a.user_id) is None:
-        entourage_a = set(map(lambda ent: ent.friend_follower_id, user_a.entourage))
-        hashtags_a = hashtags_used(user_a)
-        cache[user_a.user_id] = CacheRecord(entourage=entourage_a, hashtags=hashtags_a)
-    else:
-        cr = cache[user_a.user_id]
-        entourage_a = cr["entourage"]
-        hashtags_a = cr["hashtags"]
-
-    a_mentions_b, a_mentions_counter = n_mentions(user_a, user_b.user_id)
-    a_favs_b, a_rt_b, a_cmt_b = n_interactions(user_a, user_b.user_id)
-
-    entourage_b = set([ent.friend_follower_id for ent in user_b.entourage])
-    hashtags_b = hashtags_used(user_b)
-    b_mentions_a, b_mentions_counter = n_mentions(user_b, user_a.user_id)
-    b_favs_a, b_rt_a, b_cmt_a = n_interactions(user_b, user_a.user_id)
+    with phase("query.proximity", "check_users"):
+        for user in (user_a, user_b):
+            assert check_user_id(user.user_id) is not None, f"User {user} not in db"
+
+    with phase("query.proximity", "features"):
+        found = features_cache.get_many([user_a.user_id, user_b.user_id])
+    features_a, features_b = found[user_a.user_id], found[user_b.user_id]
+    entourage_a, entourage_b = features_a["entourage"], features_b["entourage"]
+    hashtags_a, hashtags_b = features_a["hashtags"], features_b["hashtags"]
+
+    a_mentions_b = features_a["mentions"].get(user_b.user_id, 0)
+    a_mentions_counter = features_a["mentions_total"]
+    a_favs_b, a_rt_b, a_cmt_b = features_a["interactions"].get(
+        user_b.user_id, (0, 0, 0)
+    )
+    b_mentions_a = features_b["mentions"].get(user_a.user_id, 0)
+    b_mentions_counter = features_b["mentions_total"]
+    b_favs_a, b_rt_a, b_cmt_a = features_b["interactions"].get(
+        user_a.user_id, (0, 0, 0)
+    )
 
     ent_a_len = len(entourage_a)
     ent_b_len = len(entourage_b)
@@ -155,8 +170,15 @@ def proximity(user_a: TwitscanUser, user_b: TwitscanUser) -> tuple[float, ...]:
     hash_b_len = len(hashtags_b)
     hash_len = hash_b_len + hash_a_len
     # weigh common entourage / hashtags by number of entourage acquired / hashtags used
-    common_entourage = len(entourage_a.intersection(entourage_b)) / ent_len if ent_len != 0 else 0
-    common_hashtags = len(hashtags_a.intersection(hashtags_b)) / hash_len if hash_len != 0 else 0
+    with phase("query.proximity", "intersections"):
+        common_entourage = (
+            len(np.intersect1d(entourage_a, entourage_b, assume_unique=True)) / ent_len
+            if ent_len != 0
+            else 0
+        )
+        common_hashtags = (
+            len(hashtags_a.intersection(hashtags_b)) / hash_len if hash_len != 0 else 0
+        )
 
     total_mentions = a_mentions_b + b_mentions_a
     total_favs = a_favs_b + b_favs_a
@@ -215,7 +237,10 @@ def db_info() -> dict[str, int]:
         "interaction": count("interaction"),
         "status": count("status"),
         "mention": count("mention"),
-        "urls": count("link"),
-        "hashtags": count("hashtag"),
+        "urls": count("status_url"),
+        "hashtags": count("status_hashtag"),
+        "distinct_urls": count("url_dict"),
+        "domains": count("domain"),
+        "distinct_hashtags": count("hashtag_dict"),
     }
     return info
@@ -1,13 +1,56 @@
 from __future__ import annotations
 
 import logging
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Callable, Iterable, TypedDict
+from urllib.parse import urlsplit, urlunsplit
 
-from tweepy.models import Status, User
+from sqlalchemy import func, insert
 
-from twitscan import api, config, session
+from twitscan import aggregates, api, config, session
 from twitscan.errors import UserProtectedError
-from twitscan.models import (Entourage, Hashtag, Interaction, Link, Mention,
-                             TwitscanStatus, TwitscanUser)
+from twitscan.models import (
+    Domain,
+    Entourage,
+    EntourageCursor,
+    Hashtag,
+    HashtagName,
+    Interaction,
+    Link,
+    Mention,
+    TwitscanStatus,
+    TwitscanUser,
+    Url,
+)
+from twitscan.telemetry import phase
+
+if TYPE_CHECKING:
+    from tweepy.models import Status, User
+
+
+class FetchedUser(TypedDict):
+    friends: set[int]
+    followers: set[int]
+    timeline: list[Status]
+    favorites: list[Status]
+
+
+# cursored id endpoint and the flag its ids set, per entourage kind
+ENTOURAGE_PAGES = {"friends": "friends_ids", "followers": "followers_ids"}
+ENTOURAGE_FLAGS = {
+    "friends": ("friend", "follower"),
+    "followers": ("follower", "friend"),
+}
+ENTOURAGE_CHUNK = 500  # ids per IN clause, below sqlite's bound parameters limit
+
+# called with the id of every user whose statuses, entourage or interactions changed
+invalidation_hooks: list[Callable[[int], None]] = []
+
+
+def user_changed(*user_ids: int) -> None:
+    for user_id in set(user_ids):
+        for hook in invalidation_hooks:
+            hook(user_id)
 
 
 def check_status(raw_status: Status) -> None | TwitscanStatus:
@@ -22,20 +65,13 @@ def check_status(raw_status: Status) -> None | TwitscanStatus:
     return existing_status
 
 
-def save_status(raw_status: Status) -> TwitscanStatus:
-    """Save the tweepy status in database if does not exist
-    Add mentions in database if they exist
-    Return it anyway
-    """
-    existing_status: None | TwitscanStatus = check_status(raw_status)
-    if existing_status is not None:
-        return existing_status
-
+def status_values(raw_status: Status) -> dict[str, Any]:
+    """Column values of the status row for a tweepy status"""
     is_retweet: bool = True if hasattr(raw_status, "retweeted_status") else False
     text: str = (
         raw_status.full_text if hasattr(raw_status, "full_text") else raw_status.text
     )
-    status: TwitscanStatus = TwitscanStatus(
+    return dict(
         user_id=raw_status.user.id,
         text=text,
         status_id=raw_status.id,
@@ -47,27 +83,133 @@ def save_status(raw_status: Status) -> TwitscanStatus:
         is_retweet=is_retweet,
     )
 
-    mentions: list[Mention] = [
-        Mention(status_id=raw_status.id, user_id=user["id"])
+
+def canonical_hashtag(name: str) -> str:
+    return name.lower()
+
+
+def canonical_url(url: str) -> str:
+    """lowercases the case insensitive parts of an url: scheme and host"""
+    parts = urlsplit(url)
+    return urlunsplit(
+        (
+            parts.scheme.lower(),
+            parts.netloc.lower(),
+            parts.path,
+            parts.query,
+            parts.fragment,
+        )
+    )
+
+
+def entity_values(
+    raw_status: Status,
+) -> tuple[list[dict[str, Any]], list[dict[str, Any]], list[dict[str, Any]]]:
+    """Column values of the mention rows for a tweepy status,
+    its canonical urls and hashtags to be interned with intern_entities
+    """
+    mentions = [
+        dict(status_id=raw_status.id, user_id=user["id"])
         for user in raw_status.entities["user_mentions"]
     ]
-
-    urls: list[Link] = [
-        Link(status_id=raw_status.id, link=url["expanded_url"])
-        for url in raw_status.entities["urls"]
+    urls = [
+        dict(status_id=raw_status.id, url=url)
+        for url in sorted(
+            set(
+                canonical_url(url["expanded_url"])
+                for url in raw_status.entities["urls"]
+                if url.get("expanded_url")
+            )
+        )
     ]
+    tags = [
+        dict(status_id=raw_status.id, name=name)
+        for name in sorted(
+            set(
+                canonical_hashtag(hashtag["text"])
+                for hashtag in raw_status.entities["hashtags"]
+            )
+        )
+    ]
+    return mentions, urls, tags
+
 
-    tags: list[Hashtag] = [
-        Hashtag(status_id=raw_status.id, hashtag_name=hashtag["text"])
-        for hashtag in raw_status.entities["hashtags"]
+def _insert_ignore(model: Any, rows: list[dict[str, Any]]) -> None:
+    if rows:
+        session.execute(insert(model.__table__).prefix_with("OR IGNORE"), rows)
+
+
+def intern_hashtags(names: Iterable[str]) -> dict[str, int]:
+    """hashtag_dict ids of the canonical hashtag names, adding the new ones"""
+    wanted = set(names)
+    if not wanted:
+        return {}
+    _insert_ignore(HashtagName, [dict(name=name) for name in wanted])
+    return dict(
+        session.query(HashtagName.name, HashtagName.hashtag_dict_id).filter(
+            HashtagName.name.in_(wanted)
+        )
+    )
+
+
+def intern_urls(urls: Iterable[str]) -> dict[str, int]:
+    """url_dict ids of the canonical urls, adding the new ones and their domains"""
+    wanted = set(urls)
+    if not wanted:
+        return {}
+    domains = {url: urlsplit(url).hostname or "" for url in wanted}
+    _insert_ignore(Domain, [dict(name=name) for name in set(domains.values())])
+    domain_ids = dict(
+        session.query(Domain.name, Domain.domain_id).filter(
+            Domain.name.in_(set(domains.values()))
+        )
+    )
+    _insert_ignore(
+        Url, [dict(url=url, domain_id=domain_ids[domains[url]]) for url in wanted]
+    )
+    return dict(session.query(Url.url, Url.url_id).filter(Url.url.in_(wanted)))
+
+
+def intern_entities(
+    url_rows: list[dict[str, Any]], tag_rows: list[dict[str, Any]]
+) -> tuple[list[dict[str, Any]], list[dict[str, Any]]]:
+    """integer link and hashtag rows for the url and hashtag rows of entity_values"""
+    url_ids = intern_urls(row["url"] for row in url_rows)
+    tag_ids = intern_hashtags(row["name"] for row in tag_rows)
+    links = [
+        dict(status_id=row["status_id"], url_id=url_ids[row["url"]]) for row in url_rows
     ]
+    tags = [
+        dict(status_id=row["status_id"], hashtag_dict_id=tag_ids[row["name"]])
+        for row in tag_rows
+    ]
+    return links, tags
+
+
+def save_status(raw_status: Status) -> TwitscanStatus:
+    """Save the tweepy status in database if does not exist
+    Add mentions in database if they exist
+    Return it anyway
+    """
+    existing_status: None | TwitscanStatus = check_status(raw_status)
+    if existing_status is not None:
+        return existing_status
+
+    status: TwitscanStatus = TwitscanStatus(**status_values(raw_status))
+    mention_rows, url_rows, tag_rows = entity_values(raw_status)
+    link_rows, hashtag_rows = intern_entities(url_rows, tag_rows)
+    mentions: list[Mention] = [Mention(**row) for row in mention_rows]
+    urls: list[Link] = [Link(**row) for row in link_rows]
+    tags: list[Hashtag] = [Hashtag(**row) for row in hashtag_rows]
 
     session.add(status)
     session.add_all(mentions)
     session.add_all(urls)
     session.add_all(tags)
 
+    aggregates.refresh([status.user_id])
     session.commit()
+    user_changed(status.user_id)
 
     return status
 
@@ -128,16 +270,118 @@ def scan(user_id: None | int = None, screen_name: None | str = None) -> Twitscan
     return maybe_user
 
 
-def save_entourage(user: User) -> None:
-    """Calls twitter api to get friends and followers
-    Pushes those ids in user's entourage
+def latest_status_id(user_id: int) -> None | int:
+    """
+    id of the newest status of the user's last fetched timeline, statuses of the user
+    stored as someone else's favorite do not count as their timeline may not reach them
+    """
+    latest: None | int = (
+        session.query(TwitscanUser.timeline_status_id)
+        .filter(TwitscanUser.user_id == user_id)
+        .scalar()
+    )
+    return latest
+
+
+def stored_cursor(user_id: int, kind: str) -> int:
+    """cursor of the next entourage page to fetch, -1 for the first one and 0 once done"""
+    cursor: None | int = (
+        session.query(EntourageCursor.next_cursor)
+        .filter(EntourageCursor.user_id == user_id, EntourageCursor.kind == kind)
+        .scalar()
+    )
+    return cursor if cursor is not None else -1
+
+
+def save_entourage_page(user_id: int, kind: str, ids: list[int], cursor: int) -> None:
     """
-    logging.debug(f"Fetching friends (followees) for {user.screen_name}")
-    friends: set[int] = set(api.friends_ids(user.id))
-    logging.debug(f"Fetching followers for {user.screen_name}")
-    followers: set[int] = set(api.followers_ids(user.id))
+    merges one page of friends or followers ids into the user's entourage
+    and stores the cursor of the next page in the same transaction
+    """
+    flag, other = ENTOURAGE_FLAGS[kind]
+    now = datetime.utcnow()
+    for start in range(0, len(ids), ENTOURAGE_CHUNK):
+        session.query(Entourage).filter(
+            Entourage.user_id == user_id,
+            Entourage.friend_follower_id.in_(ids[start : start + ENTOURAGE_CHUNK]),
+        ).update({flag: True}, synchronize_session=False)
+    _insert_ignore(
+        Entourage,
+        [
+            {
+                "user_id": user_id,
+                "friend_follower_id": ff,
+                flag: True,
+                other: False,
+                "first_seen": now,
+            }
+            for ff in ids
+        ],
+    )
+    session.execute(
+        insert(EntourageCursor.__table__).prefix_with("OR REPLACE"),
+        [dict(user_id=user_id, kind=kind, next_cursor=cursor)],
+    )
+    aggregates.bump([user_id])
+    session.commit()
+
 
+def stream_entourage(user_id: int) -> None:
+    """
+    pages through every friends and followers cursor, writing each page as it arrives,
+    an interrupted stream resumes from the last stored cursor
+    """
+    for kind, method in ENTOURAGE_PAGES.items():
+        cursor = stored_cursor(user_id, kind)
+        while cursor != 0:
+            logging.debug(f"Fetching {kind} of {user_id} at cursor {cursor}")
+            ids, (_, cursor) = getattr(api, method)(user_id=user_id, cursor=cursor)
+            save_entourage_page(user_id, kind, ids, cursor)
+
+
+def fetch_ids(method: str, user_id: int) -> set[int]:
+    """every page of friends_ids or followers_ids"""
+    ids: set[int] = set()
+    cursor = -1
+    while cursor != 0:
+        page, (_, cursor) = getattr(api, method)(user_id=user_id, cursor=cursor)
+        ids.update(page)
+    return ids
+
+
+def fetch_user(
+    user: User, since_id: None | int = None, entourage: bool = True
+) -> FetchedUser:
+    """Calls twitter api for everything save_user stores about the user
+    only tweets newer than since_id are fetched when it is given,
+    friends and followers are left empty without entourage
+    """
+    friends: set[int] = set()
+    followers: set[int] = set()
+    if entourage:
+        logging.debug(f"Fetching friends (followees) for {user.screen_name}")
+        friends = fetch_ids("friends_ids", user.id)
+        logging.debug(f"Fetching followers for {user.screen_name}")
+        followers = fetch_ids("followers_ids", user.id)
+    logging.debug(f"Fetching tweets for {user.screen_name}")
+    timeline: list[Status] = api.user_timeline(
+        screen_name=user.screen_name,
+        count=config["MAX_TWEETS"],
+        since_id=since_id,
+        include_rts=True,
+        tweet_mode="extended",
+    )
+    logging.debug(f"Fetching favorites for {user.screen_name}")
+    favorites: list[Status] = api.favorites(user.screen_name)
+    return FetchedUser(
+        friends=friends, followers=followers, timeline=timeline, favorites=favorites
+    )
+
+
+def save_entourage(user: User, friends: set[int], followers: set[int]) -> None:
+    """Pushes friends and followers ids in user's entourage"""
     friends_followers = followers | friends
+    now = datetime.utcnow()
     persons: list[Entourage] = []
     for ff in friends_followers:
         is_friend = ff in friends
@@ -147,32 +391,22 @@ def save_entourage(user: User) -> None:
             friend_follower_id=ff,
             friend=is_friend,
             follower=is_follower,
+            first_seen=now,
         )
         persons.append(person)
 
     session.add_all(persons)
 
 
-def save_interactions(user: User) -> None:
-    """Uses twitter api to get latest tweets and retweets / comments / likes
-    Stores user's related interactions in database
+def save_interactions(
+    user: User, timeline: list[Status], favorites: list[Status]
+) -> None:
+    """Stores latest tweets and retweets / comments / likes
+    and user's related interactions in database
     """
-    logging.debug(f"Fetching tweets for {user.screen_name}")
-    chirps: list[TwitscanStatus] = [
-        save_status(st)
-        for st in api.user_timeline(
-            screen_name=user.screen_name,
-            count=config["MAX_TWEETS"],
-            include_rts=True,
-            tweet_mode="extended",
-        )
-    ]
+    chirps: list[TwitscanStatus] = [save_status(st) for st in timeline]
 
-    logging.debug(f"Fetching favorites for {user.screen_name}")
-
-    liked: set[int] = set(
-        [save_status(st).status_id for st in api.favorites(user.screen_name)]
-    )
+    liked: set[int] = set([save_status(st).status_id for st in favorites])
 
     retweeted: set[int] = set([chirp.status_id for chirp in chirps if chirp.is_retweet])
     comments: set[int] = set(
@@ -197,10 +431,12 @@ def save_interactions(user: User) -> None:
     session.add_all(interactions)
 
 
-def save_user(user: User) -> TwitscanUser:
-    """Uses Tweepy User to create and push user info to db"""
-    logging.debug(f"Adding {user.screen_name} to database")
-    twitscan_user: TwitscanUser = TwitscanUser(
+def user_values(user: User, timeline: list[Status] | None = None) -> dict[str, Any]:
+    """
+    Column values of the user row for a tweepy user,
+    the timeline watermark moves to the newest of the fetched timeline if any
+    """
+    values = dict(
         user_id=user.id,
         screen_name=user.screen_name,
         name=user.name,
@@ -211,12 +447,55 @@ def save_user(user: User) -> TwitscanUser:
         friends_count=user.friends_count,
         followers_count=user.followers_count,
         user_picture_url=user.profile_image_url,
+        scanned_at=datetime.utcnow(),
     )
-    session.add(twitscan_user)
-    save_entourage(user)
-    save_interactions(user)
+    if timeline:
+        values["timeline_status_id"] = max(status.id for status in timeline)
+    return values
+
+
+def interaction_values(
+    user_id: int, timeline: list[Status], favorites: list[Status]
+) -> list[dict[str, Any]]:
+    """Same interactions as scanner.save_interactions, as rows"""
+    liked = {st.id for st in favorites}
+    retweeted = {st.id for st in timeline if hasattr(st, "retweeted_status")}
+    comments = {st.id for st in timeline if st.in_reply_to_status_id}
+    return [
+        dict(
+            user_id=user_id,
+            status_id=status_id,
+            fav=status_id in liked,
+            retweet=status_id in retweeted,
+            comment=status_id in comments,
+        )
+        for status_id in liked | retweeted | comments
+    ]
 
-    session.commit()
+
+def save_user(user: User, fetched: FetchedUser | None = None) -> TwitscanUser:
+    """Uses Tweepy User to create and push user info to db
+    Entourage is streamed to the database page by page
+    and statuses are fetched from twitter unless already given
+    """
+    if fetched is None:
+        with phase("scanner.save_user", "fetch"):
+            stream_entourage(user.id)
+            fetched = fetch_user(user, entourage=False)
+    logging.debug(f"Adding {user.screen_name} to database")
+    twitscan_user: TwitscanUser = TwitscanUser(**user_values(user, fetched["timeline"]))
+    session.add(twitscan_user)
+    with phase("scanner.save_user", "entourage"):
+        save_entourage(user, fetched["friends"], fetched["followers"])
+    with phase("scanner.save_user", "interactions"):
+        save_interactions(user, fetched["timeline"], fetched["favorites"])
+
+    with phase("scanner.save_user", "aggregates"):
+        aggregates.refresh([user.id])
+    with phase("scanner.save_user", "commit"):
+        session.commit()
+    with phase("scanner.save_user", "invalidate"):
+        user_changed(user.id)
 
     full_user: None | TwitscanUser = (
         session.query(TwitscanUser).filter(TwitscanUser.user_id == user.id).first()
@@ -0,0 +1,124 @@
+"""
+Score of each (main user, follower) pair as a weighted sum of its proximity features,
+and the ranked.tsv of the highest and lowest scored followers of every main user,
+streamed from the ranking sink part by part
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import Iterable, Mapping
+
+import numpy as np
+import pandas as pd
+
+from twitscan.proximity import FEATURES, RATIOS
+from twitscan.sink import RankingSink
+
+RANKED_PATH = "data/ranked.tsv"
+TOP = 50  # followers kept at each end of a main user's ranking
+# reciprocal interactions weigh the most, sizes and counters only normalize
+WEIGHTS: dict[str, float] = {
+    "common_entourage": 10.0,
+    "common_hashtags": 10.0,
+    "user_mentions_follower": 1.0,
+    "follower_mentions_user": 1.0,
+    "user_favs_follower": 1.0,
+    "follower_favs_user": 1.0,
+    "user_rt_follower": 1.5,
+    "follower_rt_user": 1.5,
+    "user_cmt_follower": 1.5,
+    "follower_cmt_user": 1.5,
+}
+
+
+class ScoringModel:
+    """
+    score = features . weights, counts enter as log(1 + count)
+    so that a few very active followers do not flatten everyone else
+    """
+
+    def __init__(self, weights: Mapping[str, float] = WEIGHTS):
+        unknown = set(weights) - set(FEATURES)
+        if unknown:
+            raise ValueError(f"Unknown features in the weights: {sorted(unknown)}")
+        self.weights = dict(weights)
+        self.vector = np.array([weights.get(name, 0.0) for name in FEATURES])
+        self.counts = np.array([name not in RATIOS for name in FEATURES])
+
+    @classmethod
+    def load(cls, path: str) -> ScoringModel:
+        """weights from a json object of feature name -> weight"""
+        with open(path) as file:
+            return cls(json.load(file))
+
+    def score(self, features: np.ndarray) -> np.ndarray:
+        """one score per row of a (rows, len(FEATURES)) matrix"""
+        values = np.asarray(features, dtype=np.float64)
+        values = np.where(self.counts, np.log1p(np.maximum(values, 0)), values)
+        scores: np.ndarray = values @ self.vector
+        return scores
+
+
+class Extremes:
+    """the k highest and k lowest scored rows seen so far for one main user"""
+
+    def __init__(self, k: int = TOP):
+        self.k = k
+        self.top: pd.DataFrame | None = None
+        self.bottom: pd.DataFrame | None = None
+
+    def _keep(
+        self, kept: pd.DataFrame | None, rows: pd.DataFrame, sign: int
+    ) -> pd.DataFrame:
+        frame = rows if kept is None else pd.concat([kept, rows], ignore_index=True)
+        if len(frame) <= self.k:
+            return frame
+        keys = sign * frame["score"].to_numpy()
+        return frame.iloc[np.argpartition(-keys, self.k - 1)[: self.k]]
+
+    def push(self, rows: pd.DataFrame) -> None:
+        """rows with a score column, any number of them"""
+        if rows.empty:
+            return
+        self.top = self._keep(self.top, rows, 1)
+        self.bottom = self._keep(self.bottom, rows, -1)
+
+    def ranked(self) -> pd.DataFrame:
+        """top rows then bottom rows, by decreasing score, each follower once"""
+        if self.top is None or self.bottom is None:
+            return pd.DataFrame()
+        bottom = self.bottom[~self.bottom["follower_id"].isin(self.top["follower_id"])]
+        frame = pd.concat([self.top, bottom], ignore_index=True)
+        return frame.sort_values(
+            ["score", "follower_id"], ascending=[False, True], kind="stable"
+        )
+
+
+def rank(
+    sink: RankingSink,
+    model: ScoringModel | None = None,
+    k: int = TOP,
+    path: str = RANKED_PATH,
+    users: Iterable[str] | None = None,
+) -> int:
+    """
+    scores the sink one part at a time, keeping k rows at each end per main user,
+    then writes them to path; returns the number of rows written
+    """
+    model = model if model is not None else ScoringModel()
+    extremes: dict[str, Extremes] = {}
+    for part in sink.parts(users):
+        part["score"] = model.score(part[list(FEATURES)].to_numpy())
+        user = part["user"].iat[0]
+        extremes.setdefault(user, Extremes(k)).push(part)
+    written = 0
+    partial = f"{path}.tmp"
+    with open(partial, "w") as file:
+        for number, user in enumerate(extremes):
+            frame = extremes[user].ranked()
+            frame.to_csv(file, sep="\t", index=False, header=number == 0)
+            written += len(frame)
+    os.replace(partial, path)
+    return written
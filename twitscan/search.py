@@ -0,0 +1,111 @@
+"""
+Ranked full text search over statuses and users, backed by the fts5 tables of migration 2
+"""
+
+from __future__ import annotations
+
+import re
+from sys import argv
+from typing import Any
+
+from sqlalchemy import Float, column, text
+
+from twitscan import session
+from twitscan.models import TwitscanStatus, TwitscanUser
+
+
+def match_expression(terms: str, phrase: bool = False, prefix: bool = False) -> str:
+    """
+    fts5 MATCH expression for free text: every word must appear,
+    or the words must appear in sequence for a phrase, prefix matches the last or every word
+    """
+    words = re.findall(r"\w+", terms)
+    if not words:
+        return ""
+    star = "*" if prefix else ""
+    if phrase:
+        return '"' + " ".join(words) + '"' + star
+    return " ".join(f'"{word}"{star}' for word in words)
+
+
+def _search(
+    model: Any,
+    pk: Any,
+    fts: str,
+    weights: str,
+    terms: str,
+    phrase: bool,
+    prefix: bool,
+    limit: int | None,
+    offset: int,
+) -> list[tuple[Any, float]]:
+    expression = match_expression(terms, phrase, prefix)
+    if not expression:
+        return []
+    table = model.__tablename__
+    # one join on the rowid instead of loading the matches with an IN list,
+    # on which sqlite scans the whole table once the list is long enough
+    statement = text(
+        f'SELECT "{table}".*, bm25({fts}{weights}) AS score FROM {fts} '
+        f'JOIN "{table}" ON "{table}".{pk.key} = {fts}.rowid '
+        f"WHERE {fts} MATCH :expression ORDER BY score LIMIT :limit OFFSET :offset"
+    ).bindparams(
+        expression=expression, limit=-1 if limit is None else limit, offset=offset
+    )
+    ranked = session.query(model, column("score", Float)).from_statement(statement)
+    # bm25 is lower for better matches, scores are returned higher is better
+    return [(row, -score) for row, score in ranked]
+
+
+def search_statuses(
+    terms: str,
+    phrase: bool = False,
+    prefix: bool = False,
+    limit: int | None = 20,
+    offset: int = 0,
+) -> list[tuple[TwitscanStatus, float]]:
+    """statuses matching the terms with their relevance, best first"""
+    return _search(
+        TwitscanStatus,
+        TwitscanStatus.status_id,
+        "status_fts",
+        "",
+        terms,
+        phrase,
+        prefix,
+        limit,
+        offset,
+    )
+
+
+def search_users(
+    terms: str,
+    phrase: bool = False,
+    prefix: bool = False,
+    limit: int | None = 20,
+    offset: int = 0,
+) -> list[tuple[TwitscanUser, float]]:
+    """users whose screen name (weighted twice) or name match the terms, best first"""
+    return _search(
+        TwitscanUser,
+        TwitscanUser.user_id,
+        "user_fts",
+        ", 2.0, 1.0",
+        terms,
+        phrase,
+        prefix,
+        limit,
+        offset,
+    )
+
+
+def rebuild() -> None:
+    """backfills the fts tables from the status and user tables"""
+    for fts in ("status_fts", "user_fts"):
+        session.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+    session.commit()
+
+
+if __name__ == "__main__":
+    assert argv[1:] == ["rebuild"], "usage: python -m twitscan.search rebuild"
+    rebuild()
@@ -0,0 +1,198 @@
+"""
+Typed, columnar ranking output: one parquet file per scored batch, partitioned by main user,
+with an index of scored (user, follower) pairs for resuming
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+from typing import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from twitscan import session
+from twitscan.models import TwitscanUser
+from twitscan.proximity import FEATURES, RATIOS, ProximityMatrix
+
+RANKING_DIR = "data/ranking"
+INDEX_FILE = "_index.db"
+CHUNK = 500  # ids per IN clause, below sqlite's bound parameters limit
+
+SCHEMA = pa.schema(
+    [
+        pa.field("user", pa.string()),
+        pa.field("follower", pa.string()),
+        pa.field("follower_id", pa.int64()),
+        *(
+            pa.field(name, pa.float64() if name in RATIOS else pa.int64())
+            for name in FEATURES
+        ),
+    ]
+)
+
+
+def _partition(user: str) -> str:
+    return f"user={user}"
+
+
+class RankingSink:
+    """
+    appends ranking batches under directory/user=<screen name>/part-<n>.parquet,
+    a part is only visible once the index transaction listing it and its pairs commits
+    """
+
+    def __init__(self, directory: str = RANKING_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index = sqlite3.connect(os.path.join(directory, INDEX_FILE))
+        self.index.executescript(
+            "CREATE TABLE IF NOT EXISTS scored (user TEXT NOT NULL, "
+            "follower_id INTEGER NOT NULL, PRIMARY KEY (user, follower_id)) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS part (path TEXT PRIMARY KEY);"
+        )
+        self._discard_uncommitted()
+
+    def _parts(self) -> list[str]:
+        return [path for (path,) in self.index.execute("SELECT path FROM part")]
+
+    def _discard_uncommitted(self) -> None:
+        """removes part files written by a run interrupted before its index commit"""
+        committed = set(self._parts())
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.relpath(os.path.join(root, name), self.directory)
+                if name.endswith((".parquet", ".tmp")) and path not in committed:
+                    os.remove(os.path.join(root, name))
+
+    def __len__(self) -> int:
+        count: int = self.index.execute("SELECT COUNT(*) FROM scored").fetchone()[0]
+        return count
+
+    def is_scored(self, user: str, follower_id: int) -> bool:
+        return (
+            self.index.execute(
+                "SELECT 1 FROM scored WHERE user = ? AND follower_id = ?",
+                (user, follower_id),
+            ).fetchone()
+            is not None
+        )
+
+    def scored(self, user: str) -> set[int]:
+        """ids of the followers of user already written"""
+        return {
+            follower_id
+            for (follower_id,) in self.index.execute(
+                "SELECT follower_id FROM scored WHERE user = ?", (user,)
+            )
+        }
+
+    def _next_part(self, user: str) -> str:
+        """
+        path of the next part of user, numbered from the committed parts only
+        as files left by an interrupted write are not part of the ranking
+        """
+        prefix = _partition(user) + os.sep
+        (number,) = self.index.execute(
+            "SELECT COUNT(*) FROM part WHERE substr(path, 1, length(?)) = ?",
+            (prefix, prefix),
+        ).fetchone()
+        while True:
+            path = os.path.join(_partition(user), f"part-{number:05d}.parquet")
+            if (
+                self.index.execute(
+                    "SELECT 1 FROM part WHERE path = ?", (path,)
+                ).fetchone()
+                is None
+            ):
+                return path
+            number += 1  # numbers skipped by an earlier numbering
+
+    def write(self, table: pa.Table) -> int:
+        """
+        appends the rows of pairs not written yet, at most one part per main user,
+        returns the number of rows written
+        """
+        written = 0
+        frame = table.to_pandas()
+        for user, rows in frame.groupby("user", sort=False):
+            done = self.scored(user)
+            rows = rows[~rows["follower_id"].isin(done)].drop_duplicates("follower_id")
+            if rows.empty:
+                continue
+            partition = os.path.join(self.directory, _partition(user))
+            os.makedirs(partition, exist_ok=True)
+            path = self._next_part(user)
+            full = os.path.join(self.directory, path)
+            part = pa.Table.from_pandas(rows, schema=SCHEMA, preserve_index=False)
+            pq.write_table(part.drop(["user"]), full + ".tmp")
+            with self.index:
+                self.index.executemany(
+                    "INSERT INTO scored (user, follower_id) VALUES (?, ?)",
+                    [(user, int(fid)) for fid in rows["follower_id"]],
+                )
+                self.index.execute("INSERT INTO part (path) VALUES (?)", (path,))
+                os.replace(full + ".tmp", full)
+            written += len(rows)
+        return written
+
+    def write_matrix(self, matrix: ProximityMatrix) -> int:
+        return self.write(matrix_table(matrix))
+
+    def parts(self, users: Iterable[str] | None = None) -> Iterator[pd.DataFrame]:
+        """the written rows one part at a time, with user restored from the partition"""
+        wanted = set(users) if users is not None else None
+        for path in self._parts():
+            user = path.split(os.sep)[0][len("user=") :]
+            if wanted is not None and user not in wanted:
+                continue
+            frame = pq.read_table(os.path.join(self.directory, path)).to_pandas()
+            frame.insert(0, "user", user)
+            yield frame
+
+    def read(self, users: Iterable[str] | None = None) -> pd.DataFrame:
+        """every written row"""
+        frames = list(self.parts(users))
+        if not frames:
+            return SCHEMA.empty_table().to_pandas()
+        return pd.concat(frames, ignore_index=True)
+
+    def export_tsv(self, path: str = "data/ranking.tsv") -> None:
+        """the former ranking.tsv layout, as a view of the parquet files"""
+        frame = self.read()
+        frame.drop(columns=["follower_id"]).to_csv(path, sep="\t", index=False)
+
+    def import_tsv(self, path: str = "data/ranking.tsv") -> int:
+        """adds the rows of a ranking.tsv written before the parquet sink existed"""
+        frame = pd.read_csv(path, sep="\t")
+        names = frame["follower"].astype(str).unique().tolist()
+        ids: dict[str, int] = {}
+        for start in range(0, len(names), CHUNK):
+            ids.update(
+                session.query(TwitscanUser.screen_name, TwitscanUser.user_id).filter(
+                    TwitscanUser.screen_name.in_(names[start : start + CHUNK])
+                )
+            )
+        frame["follower_id"] = frame["follower"].map(ids)
+        frame = frame.dropna(subset=["follower_id"]).astype({"follower_id": "int64"})
+        return self.write(
+            pa.Table.from_pandas(frame, schema=SCHEMA, preserve_index=False)
+        )
+
+    def close(self) -> None:
+        self.index.close()
+
+
+def matrix_table(matrix: ProximityMatrix) -> pa.Table:
+    columns = {
+        "user": [matrix.user.screen_name] * len(matrix.follower_ids),
+        "follower": matrix.screen_names,
+        "follower_id": matrix.follower_ids,
+    }
+    for i, name in enumerate(FEATURES):
+        values = matrix.features[:, i]
+        columns[name] = values if name in RATIOS else np.rint(values).astype(np.int64)
+    return pa.table(columns, schema=SCHEMA)
@@ -0,0 +1,298 @@
+"""
+Database content generated in bulk from a SyntheticGraph, as if its users had been scanned,
+for benchmarks at scales a scan through the fake api would take hours to reach
+"""
+
+from __future__ import annotations
+
+import logging
+from datetime import datetime, timedelta
+from itertools import chain
+from typing import Any, Iterable
+
+import numpy as np
+from sqlalchemy.engine.base import Engine
+
+from twitscan import aggregates, context
+from twitscan.fake import DOMAINS, EPOCH, SyntheticGraph
+
+RETWEETS = 0.15  # share of tweets that are retweets of a friend's tweet
+REPLIES = 0.15  # share of tweets replying to a friend's tweet
+LINKS = 0.2  # share of tweets with an url
+HASHTAGS_PER_TWEET = (0, 0, 1, 1, 2, 3)
+MENTIONS_PER_TWEET = (0, 0, 0, 1, 2)
+
+
+def _date(hours: np.ndarray) -> list[str]:
+    """Date column values, the way sqlalchemy stores them in sqlite"""
+    days = np.datetime64(EPOCH.date()) + (hours // 24).astype("timedelta64[D]")
+    dates: list[str] = days.astype(str).tolist()
+    return dates
+
+
+def _insert(
+    cursor: Any, table: str, columns: tuple[str, ...], rows: Iterable[Any]
+) -> None:
+    cursor.executemany(
+        f'INSERT INTO "{table}" ({", ".join(columns)}) '
+        f'VALUES ({", ".join("?" * len(columns))})',
+        rows,
+    )
+
+
+def _per_item(
+    counts: tuple[int, ...], size: int, rng: np.random.Generator
+) -> np.ndarray:
+    return np.asarray(counts)[rng.integers(0, len(counts), size)]
+
+
+def populate(
+    graph: SyntheticGraph, scanned: int | None = None, bind: Engine | None = None
+) -> dict[str, int]:
+    """
+    stores users 1..scanned of the graph (all of them by default) with their entourage,
+    tweets, entities and interactions in one transaction then rebuilds the aggregates,
+    returns the rows added per table;
+    the database must be migrated and hold none of these users yet
+    """
+    bind = bind if bind is not None else context.engine
+    users = graph.users if scanned is None else min(scanned, graph.users)
+    rng = np.random.default_rng(graph.seed + 1)
+    stride = graph.users + 1  # status id = (number + 1) * stride + author
+    ids = np.arange(1, users + 1, dtype=np.int64)
+
+    # entourage: a row per scanned user and friend or follower, flags merged
+    follower, followed = graph.edges()
+    as_friend = follower <= users
+    as_follower = followed <= users
+    keys = np.concatenate(
+        (
+            follower[as_friend] * stride + followed[as_friend],
+            followed[as_follower] * stride + follower[as_follower],
+        )
+    )
+    flags = np.concatenate(
+        (
+            np.ones(as_friend.sum(), dtype=np.int8),
+            np.full(as_follower.sum(), 2, dtype=np.int8),
+        )
+    )
+    keys, inverse = np.unique(keys, return_inverse=True)
+    merged = np.zeros(len(keys), dtype=np.int8)
+    np.bitwise_or.at(merged, inverse, flags)
+
+    # tweets of scanned users, retweets and replies target tweets of friends
+    author = np.repeat(ids, graph.statuses)
+    number = np.tile(np.arange(graph.statuses, dtype=np.int64), users)
+    status_id = (number + 1) * stride + author
+    target_author = graph.random_friends(author, rng)
+    target_number = (rng.random(len(author)) * (number + 1)).astype(np.int64)
+    target = (target_number + 1) * stride + target_author
+    roll = rng.random(len(author))
+    retweet = (roll < RETWEETS) & (target_author > 0)
+    reply = (roll >= RETWEETS) & (roll < RETWEETS + REPLIES) & (target_author > 0)
+    shared = retweet | reply
+
+    # likes of friends' tweets, whose authors may not be scanned
+    liker = np.repeat(ids, graph.favorites)
+    liked_author = graph.random_friends(liker, rng)
+    liked = (rng.integers(0, graph.statuses, len(liker)) + 1) * stride + liked_author
+    bound = (graph.statuses + 1) * stride  # above every status id
+    likes = np.unique((liker * bound + liked)[liked_author > 0])
+    liker, liked = likes // bound, likes % bound
+    extra = np.setdiff1d(liked[liked % stride > users], status_id)
+
+    all_ids = np.concatenate((status_id, extra))
+    all_author = all_ids % stride
+    all_number = all_ids // stride - 1
+    all_retweet = np.concatenate((retweet, np.zeros(len(extra), dtype=bool)))
+    all_reply = np.concatenate((reply, np.zeros(len(extra), dtype=bool)))
+    all_target = np.concatenate((target, np.zeros(len(extra), dtype=np.int64)))
+
+    # entities, on every tweet but retweets
+    own = np.flatnonzero(~all_retweet)
+    tagged = np.repeat(own, _per_item(HASHTAGS_PER_TWEET, len(own), rng))
+    tag = (graph.hashtags * rng.random(len(tagged)) ** 3).astype(np.int64)
+    tag_keys = np.unique(all_ids[tagged] * graph.hashtags + tag)
+    mentioning = np.repeat(own, _per_item(MENTIONS_PER_TWEET, len(own), rng))
+    mentioned = graph.random_friends(all_author[mentioning], rng)
+    mentioning, mentioned = mentioning[mentioned > 0], mentioned[mentioned > 0]
+    linking = own[rng.random(len(own)) < LINKS]
+    url_domain = rng.integers(0, len(DOMAINS), len(linking))
+    url_path = all_ids[linking]  # one distinct url per linking tweet
+
+    now = datetime.utcnow().isoformat(sep=" ")
+    first_seen = (EPOCH + timedelta(days=1)).isoformat(sep=" ", timespec="microseconds")
+    created = _date(all_number)
+    counts: dict[str, int] = {}
+    connection = bind.raw_connection()
+    try:
+        cursor = connection.cursor()
+        _insert(
+            cursor,
+            "user",
+            (
+                "user_id",
+                "screen_name",
+                "name",
+                "created_at",
+                "verified",
+                "favorites_count",
+                "status_count",
+                "friends_count",
+                "followers_count",
+                "user_picture_url",
+                "scanned_at",
+            ),
+            (
+                (
+                    uid,
+                    f"user{uid}",
+                    f"User {uid}",
+                    str((EPOCH - timedelta(days=uid % 3000)).date()),
+                    uid % 97 == 0,
+                    graph.favorites,
+                    graph.statuses,
+                    len(graph.friends(uid)),
+                    len(graph.followers(uid)),
+                    f"http://pbs.twimg.com/profile_images/{uid}/photo_normal.jpg",
+                    now,
+                )
+                for uid in ids.tolist()
+            ),
+        )
+        counts["user"] = users
+        _insert(
+            cursor,
+            "friend",
+            ("user_id", "friend_follower_id", "friend", "follower", "first_seen"),
+            zip(
+                (keys // stride).tolist(),
+                (keys % stride).tolist(),
+                (merged & 1).astype(bool).tolist(),
+                (merged & 2).astype(bool).tolist(),
+                [first_seen] * len(keys),
+            ),
+        )
+        counts["friend"] = len(keys)
+        texts = (
+            (
+                f"RT @user{t % stride}: tweet {t // stride - 1} of user {t % stride}"
+                if rt
+                else f"tweet {n} of user {a}"
+            )
+            for a, n, rt, t in zip(
+                all_author.tolist(),
+                all_number.tolist(),
+                all_retweet.tolist(),
+                all_target.tolist(),
+            )
+        )
+        _insert(
+            cursor,
+            "status",
+            (
+                "status_id",
+                "text",
+                "created_at",
+                "favorite_count",
+                "retweet_count",
+                "in_reply_to_status_id",
+                "in_reply_to_user_id",
+                "is_retweet",
+                "user_id",
+            ),
+            zip(
+                all_ids.tolist(),
+                texts,
+                created,
+                (rng.pareto(1.5, len(all_ids))).astype(np.int64).tolist(),
+                (rng.pareto(2.0, len(all_ids))).astype(np.int64).tolist(),
+                [
+                    t if r else None
+                    for t, r in zip(all_target.tolist(), all_reply.tolist())
+                ],
+                [
+                    t % stride if r else None
+                    for t, r in zip(all_target.tolist(), all_reply.tolist())
+                ],
+                all_retweet.tolist(),
+                all_author.tolist(),
+            ),
+        )
+        counts["status"] = len(all_ids)
+        _insert(
+            cursor,
+            "hashtag_dict",
+            ("hashtag_dict_id", "name"),
+            ((i + 1, f"tag{i}") for i in range(graph.hashtags)),
+        )
+        _insert(
+            cursor,
+            "status_hashtag",
+            ("status_id", "hashtag_dict_id"),
+            zip(
+                (tag_keys // graph.hashtags).tolist(),
+                (tag_keys % graph.hashtags + 1).tolist(),
+            ),
+        )
+        counts["status_hashtag"] = len(tag_keys)
+        _insert(
+            cursor,
+            "mention",
+            ("status_id", "user_id"),
+            zip(all_ids[mentioning].tolist(), mentioned.tolist()),
+        )
+        counts["mention"] = len(mentioning)
+        _insert(
+            cursor,
+            "domain",
+            ("domain_id", "name"),
+            ((i + 1, name.lower()) for i, name in enumerate(DOMAINS)),
+        )
+        _insert(
+            cursor,
+            "url_dict",
+            ("url_id", "url", "domain_id"),
+            (
+                (i + 1, f"https://{DOMAINS[d].lower()}/{p}", d + 1)
+                for i, (d, p) in enumerate(zip(url_domain.tolist(), url_path.tolist()))
+            ),
+        )
+        _insert(
+            cursor,
+            "status_url",
+            ("status_id", "url_id"),
+            zip(all_ids[linking].tolist(), range(1, len(linking) + 1)),
+        )
+        counts["status_url"] = len(linking)
+        # same rows as scanner.interaction_values: likes, own retweets and replies
+        _insert(
+            cursor,
+            "interaction",
+            ("user_id", "status_id", "fav", "retweet", "comment"),
+            chain(
+                (
+                    (u, s, True, False, False)
+                    for u, s in zip(liker.tolist(), liked.tolist())
+                ),
+                (
+                    (a, s, False, rt, rp)
+                    for a, s, rt, rp in zip(
+                        author[shared].tolist(),
+                        status_id[shared].tolist(),
+                        retweet[shared].tolist(),
+                        reply[shared].tolist(),
+                    )
+                ),
+            ),
+        )
+        counts["interaction"] = len(liker) + int(shared.sum())
+        connection.commit()
+    finally:
+        connection.close()
+    aggregates.rebuild(bind)
+    with bind.connect() as conn:
+        conn.execute("ANALYZE")
+    logging.info(f"Populated the database with {counts}")
+    return counts
@@ -0,0 +1,393 @@
+"""
+Counters and timers of the hot paths: twitter calls and rate-limit waits per endpoint,
+database queries per calling function and the phases of a save or a proximity,
+exported as json or prometheus text snapshots
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from types import FrameType
+from typing import Any, Callable, Iterator
+
+from sqlalchemy import event
+from sqlalchemy.engine.base import Engine
+
+API_CALLS = "twitscan_api_calls_total"
+API_SECONDS = "twitscan_api_call_seconds"
+RATE_LIMIT_WAITS = "twitscan_api_rate_limit_wait_seconds"
+DB_SECONDS = "twitscan_db_query_seconds"
+PHASE_SECONDS = "twitscan_phase_seconds"
+INTERVAL = 30.0  # seconds between two snapshots of a reporter
+RESET_MARGIN = 1  # seconds slept past a rate limit reset, for clock skew
+
+
+class Timer:
+    """count, sum and max of the observed durations"""
+
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+def _escape(label: str) -> str:
+    return label.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Registry:
+    """every counter, gauge and timer of the process, by name and labels"""
+
+    def __init__(self) -> None:
+        # keyed by name and sorted (label, value) pairs
+        self.counters: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+        self.gauges: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+        self.timers: dict[tuple[str, tuple[tuple[str, str], ...]], Timer] = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                timer = self.timers[key] = Timer()
+            timer.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timers.clear()
+            self.started = time.time()
+
+    def snapshot(self) -> dict[str, Any]:
+        """plain data of every metric, sorted by name then labels"""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            timers = sorted(
+                (key, (timer.count, timer.total, timer.max))
+                for key, timer in self.timers.items()
+            )
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "pid": os.getpid(),
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in counters
+            ],
+            "gauges": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in gauges
+            ],
+            "timers": [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": count,
+                    "sum": total,
+                    "max": longest,
+                }
+                for (name, labels), (count, total, longest) in timers
+            ],
+        }
+
+    def prometheus(self) -> str:
+        """
+        text exposition format, timers as summaries without quantiles
+        followed by a <name>_max gauge family of their longest observation
+        """
+        snapshot = self.snapshot()
+        lines: list[str] = []
+        typed: set[str] = set()
+
+        def sample(name: str, labels: dict[str, str], value: float) -> None:
+            text = ",".join(
+                f'{key}="{_escape(label)}"' for key, label in labels.items()
+            )
+            lines.append(f"{name}{{{text}}} {value!r}" if text else f"{name} {value!r}")
+
+        def family(name: str, kind: str) -> None:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for kind in ("counter", "gauge"):
+            for metric in snapshot[f"{kind}s"]:
+                family(metric["name"], kind)
+                sample(metric["name"], metric["labels"], metric["value"])
+        # every sample of a family is contiguous, timers are sorted by name
+        timers: dict[str, list[dict[str, Any]]] = {}
+        for timer in snapshot["timers"]:
+            timers.setdefault(timer["name"], []).append(timer)
+        for name, series in timers.items():
+            family(name, "summary")
+            for timer in series:
+                sample(f"{name}_count", timer["labels"], timer["count"])
+                sample(f"{name}_sum", timer["labels"], timer["sum"])
+            family(f"{name}_max", "gauge")
+            for timer in series:
+                sample(f"{name}_max", timer["labels"], timer["max"])
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def phase(function: str, name: str) -> Any:
+    """times one phase of a function: with phase("scanner.save_user", "commit"): ..."""
+    return registry.timer(PHASE_SECONDS, function=function, phase=name)
+
+
+class InstrumentedAPI:
+    """
+    tweepy.API proxy counting and timing every endpoint call, with the rate-limit
+    waits tweepy would do itself: before a call to an endpoint left without calls,
+    and after a 429, both timed as waits instead of hidden in the call
+    """
+
+    def __init__(self, api: Any, wait_on_rate_limit: bool = False):
+        self.api = api
+        self.wait_on_rate_limit = wait_on_rate_limit
+        self._resets: dict[str, float] = {}  # exhausted endpoint -> reset time
+
+    def __getattr__(self, attr: str) -> Any:
+        value = getattr(self.api, attr)
+        if attr.startswith("_") or not callable(value):
+            return value
+        return lambda *args, **kwargs: self.call(attr, value, *args, **kwargs)
+
+    def _wait(self, endpoint: str, until: float) -> None:
+        delay = until - time.time()
+        if delay <= 0:
+            return
+        logging.warning(f"Rate limit of {endpoint} reached, sleeping for {delay:.0f}s")
+        with registry.timer(RATE_LIMIT_WAITS, endpoint=endpoint):
+            time.sleep(delay)
+
+    def _headers(self, source: Any) -> Any:
+        return getattr(getattr(source, "last_response", source), "headers", None)
+
+    def call(
+        self, endpoint: str, method: Callable[..., Any], *args: Any, **kwargs: Any
+    ) -> Any:
+        from tweepy import RateLimitError
+
+        while True:
+            if self.wait_on_rate_limit and endpoint in self._resets:
+                self._wait(endpoint, self._resets.pop(endpoint) + RESET_MARGIN)
+            started = time.perf_counter()
+            status = "ok"
+            try:
+                result = method(*args, **kwargs)
+            except RateLimitError as err:
+                status = "rate_limited"
+                headers = self._headers(getattr(err, "response", None))
+                reset = headers.get("x-rate-limit-reset") if headers else None
+                if not self.wait_on_rate_limit:
+                    raise
+                self._resets[endpoint] = (
+                    float(reset) if reset is not None else time.time() + 60
+                )
+                continue
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                registry.inc(API_CALLS, endpoint=endpoint, status=status)
+                registry.observe(
+                    API_SECONDS, time.perf_counter() - started, endpoint=endpoint
+                )
+            headers = self._headers(self.api)
+            remaining = headers.get("x-rate-limit-remaining") if headers else None
+            reset = headers.get("x-rate-limit-reset") if headers else None
+            if remaining is not None and int(remaining) == 0 and reset is not None:
+                self._resets[endpoint] = float(reset)
+            return result
+
+
+def instrument(api: Any, wait_on_rate_limit: bool = False) -> Any:
+    """
+    wraps an api once, an already instrumented one is returned as is,
+    as are apis instrumenting their calls themselves like credential pools
+    """
+    if isinstance(api, InstrumentedAPI) or getattr(api, "instrumented", False):
+        return api
+    return InstrumentedAPI(api, wait_on_rate_limit)
+
+
+def caller() -> str:
+    """module.function of the innermost twitscan or jobs frame calling the database"""
+    frame: FrameType | None = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        name = frame.f_code.co_name
+        # jobs run with python -m are __main__, comprehensions belong to their function
+        if (
+            module.startswith(("twitscan", "jobs", "__main__"))
+            and module != __name__
+            and not name.startswith("<")
+        ):
+            return f"{module}.{name}"
+        frame = frame.f_back
+    return "other"
+
+
+def _before_execute(conn: Any, *_: Any) -> None:
+    conn.info.setdefault("telemetry_started", []).append(time.perf_counter())
+
+
+def _after_execute(conn: Any, *_: Any) -> None:
+    stack = conn.info.get("telemetry_started")
+    if stack:  # empty for a query started before profiling was turned on
+        registry.observe(DB_SECONDS, time.perf_counter() - stack.pop(), caller=caller())
+
+
+def _handle_error(context: Any) -> None:
+    connection = context.connection
+    if connection is not None and connection.info.get("telemetry_started"):
+        connection.info["telemetry_started"].pop()
+
+
+_profiling = False
+
+
+def profile_queries(enabled: bool = True) -> None:
+    """
+    counts and times the queries of every engine per calling function,
+    off by default as finding the caller walks the stack of every query
+    """
+    global _profiling
+    if enabled == _profiling:
+        return
+    hooks = (
+        ("before_cursor_execute", _before_execute),
+        ("after_cursor_execute", _after_execute),
+        ("handle_error", _handle_error),
+    )
+    for name, hook in hooks:
+        (event.listen if enabled else event.remove)(Engine, name, hook)
+    _profiling = enabled
+
+
+def write(path: str) -> None:
+    """one snapshot, prometheus text for a .prom path, json otherwise"""
+    text = (
+        registry.prometheus()
+        if path.endswith(".prom")
+        else json.dumps(registry.snapshot(), indent=1)
+    )
+    partial = f"{path}.tmp"
+    with open(partial, "w") as file:
+        file.write(text)
+    os.replace(partial, path)
+
+
+class Reporter:
+    """
+    rewrites the snapshot file every interval from a daemon thread, and once more
+    when stopped, so that a scraper or `watch cat` always reads a whole snapshot
+    """
+
+    def __init__(self, path: str, interval: float = INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                write(self.path)
+            except OSError as err:
+                logging.warning(f"Could not write metrics to {self.path}: {err}")
+
+    def start(self) -> Reporter:
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+        write(self.path)
+
+    def __enter__(self) -> Reporter:
+        return self.start()
+
+    def __exit__(self, *_: Any) -> None:
+        self.stop()
+
+
+@contextmanager
+def report(
+    path: str | None, interval: float = INTERVAL, queries: bool = True
+) -> Iterator[None]:
+    """
+    snapshots to path while the block runs, queries are profiled meanwhile,
+    nothing is reported without a path
+    """
+    if path is None:
+        yield
+        return
+    profile_queries(queries)
+    try:
+        with Reporter(path, interval):
+            yield
+    finally:
+        profile_queries(False)
+
+
+def process_path(path: str | None) -> str | None:
+    """path of the snapshots of one worker process: metrics.json -> metrics.1234.json"""
+    if path is None:
+        return None
+    root, ext = os.path.splitext(path)
+    return f"{root}.{os.getpid()}{ext}"
+
+
+def add_arguments(parser: ArgumentParser) -> None:
+    """--metrics and --metrics-interval options of the jobs"""
+    parser.add_argument(
+        "--metrics",
+        help="write metric snapshots to this file, prometheus text if it ends in .prom",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=INTERVAL,
+        help="seconds between two metric snapshots",
+    )